@@ -0,0 +1,141 @@
+import argparse
+import ast
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from models import AARMVSNet, set_deform_backend
+from utils import setup_device
+
+parser = argparse.ArgumentParser(description='Time the AA-RMVSNet inference path on a small synthetic scene')
+parser.add_argument('--device', default='cpu', help='device the model runs on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads of the cpu kernels, 0 for the torch default')
+parser.add_argument('--channels_last', help='True or False flag, run the model in channels-last memory format.',
+                    type=ast.literal_eval, default=False)
+parser.add_argument('--depth_chunk', type=int, default=1, help='depth planes warped and reweighted together')
+parser.add_argument('--chunk_mb', type=int, default=0,
+                    help='derive the depth chunk from this memory budget in MB, 0 to use --depth_chunk')
+parser.add_argument('--deform_backend', default=None, choices=['torchvision', 'native'],
+                    help='deformable convolution backend, torchvision if it is installed by default')
+parser.add_argument('--coarse_planes', type=int, default=0,
+                    help='planes of the coarse pass of the two-pass sweep, 0 for a single sweep over all planes')
+parser.add_argument('--fine_planes', type=int, default=32, help='per pixel planes of the fine pass')
+parser.add_argument('--band_sigma', type=float, default=3.0,
+                    help='half width of the fine band in standard deviations of the coarse plane index')
+parser.add_argument('--min_visible', type=int, default=0,
+                    help='skip the depth planes without a pixel seen by this many source views, 0 to sweep all planes')
+parser.add_argument('--compare_full', help='True or False flag, also time the full sweep and compare the depths.',
+                    type=ast.literal_eval, default=True)
+parser.add_argument('--loadckpt', default=None, help='checkpoint to time, random weights if not given')
+parser.add_argument('--batch_size', type=int, default=1, help='samples per forward')
+parser.add_argument('--view_num', type=int, default=3, help='views per sample')
+parser.add_argument('--max_h', type=int, default=128, help='image height')
+parser.add_argument('--max_w', type=int, default=160, help='image width')
+parser.add_argument('--numdepth', type=int, default=32, help='the number of depth values')
+parser.add_argument('--warmup', type=int, default=1, help='untimed forwards')
+parser.add_argument('--iters', type=int, default=3, help='timed forwards')
+
+
+def synthetic_scene(batch_size, view_num, height, width, numdepth, seed=0):
+    """
+    a textured plane slanted from depth 1.5 (top row) to 2.5 (bottom row), seen by views translated along x and
+    looking at the depth range 1 to 3
+    :return: imgs (B, V, 3, H, W), proj_matrices (B, V, 4, 4) and depth_values (B, D) as fed by the eval datasets,
+    and the depth map of the reference view (H, W)
+    """
+    rng = np.random.RandomState(seed)
+    focal = 0.8 * width
+    depth_gt = np.repeat(np.linspace(1.5, 2.5, height, dtype=np.float32)[:, None], width, axis=1)
+    # the farthest view sees the plane shifted by up to focal * baseline / 1.5 pixels
+    baseline = 0.25
+    pad = int(np.ceil(focal * baseline * (view_num - 1) / 1.5))
+    texture = cv2.resize(rng.rand(height // 2, (width + pad) // 2, 3).astype(np.float32), (width + pad, height),
+                         interpolation=cv2.INTER_CUBIC)
+    intrinsics = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]], dtype=np.float32)
+    x, y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    imgs = np.zeros((batch_size, view_num, 3, height, width), dtype=np.float32)
+    proj_matrices = np.tile(np.eye(4, dtype=np.float32), (batch_size, view_num, 1, 1))
+    for view in range(view_num):
+        extrinsics = np.eye(4, dtype=np.float32)
+        extrinsics[0, 3] = -baseline * view
+        proj_matrices[:, view, :3, :4] = np.matmul(intrinsics, extrinsics[:3, :4])
+        # a point of the plane at reference pixel x is seen at x + focal * tx / depth
+        img = cv2.remap(texture, x - focal * extrinsics[0, 3] / depth_gt, y, cv2.INTER_LINEAR)
+        img = (img - img.mean(axis=(0, 1))) / img.std(axis=(0, 1))
+        imgs[:, view] = img.transpose(2, 0, 1)
+    depth_values = np.tile(np.linspace(1.0, 3.0, numdepth, dtype=np.float32), (batch_size, 1))
+    return torch.from_numpy(imgs), torch.from_numpy(proj_matrices), torch.from_numpy(depth_values), depth_gt
+
+
+def build_model(args, device, coarse_planes=0):
+    model = AARMVSNet(image_scale=1.0, max_h=args.max_h, max_w=args.max_w, return_depth=True,
+                      depth_chunk=args.depth_chunk, chunk_bytes=args.chunk_mb * 2 ** 20, coarse_planes=coarse_planes,
+                      fine_planes=args.fine_planes, band_sigma=args.band_sigma, min_visible=args.min_visible)
+    if args.loadckpt:
+        state_dict = torch.load(args.loadckpt, map_location=device)['model']
+        model.load_state_dict({k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()})
+    model.to(device)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model.eval()
+
+
+def time_forwards(args, device, model, imgs, proj_matrices, depth_values):
+    times = []
+    with torch.no_grad():
+        for i in range(args.warmup + args.iters):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            time_s = time.time()
+            outputs = model(imgs, proj_matrices, depth_values)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if i >= args.warmup:
+                times.append(time.time() - time_s)
+    return outputs, times
+
+
+def benchmark(args):
+    device = setup_device(args.device, args.threads)
+    if args.deform_backend is not None:
+        set_deform_backend(args.deform_backend)
+    torch.manual_seed(0)
+    model = build_model(args, device, coarse_planes=args.coarse_planes)
+
+    imgs, proj_matrices, depth_values, depth_gt = synthetic_scene(args.batch_size, args.view_num, args.max_h,
+                                                                  args.max_w, args.numdepth)
+    imgs, proj_matrices, depth_values = imgs.to(device), proj_matrices.to(device), depth_values.to(device)
+    outputs, times = time_forwards(args, device, model, imgs, proj_matrices, depth_values)
+    return outputs, times, depth_gt
+
+
+def depth_errors(depth, depth_gt, interval):
+    # mean absolute error and the fraction of pixels within 1 and 4 plane intervals of the ground truth
+    errors = np.abs(depth - depth_gt)
+    return 'mae {:.4f}, <1 interval {:.3f}, <4 intervals {:.3f}'.format(errors.mean(), (errors < interval).mean(),
+                                                                        (errors < 4 * interval).mean())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    outputs, times, depth_gt = benchmark(args)
+    interval = 2.0 / (args.numdepth - 1)
+    print('device {}, threads {}, channels_last {}, depth_chunk {}, chunk_mb {}, coarse_planes {}, {}x{}x{}x{}x{}'.format(
+        args.device, torch.get_num_threads(), args.channels_last, args.depth_chunk, args.chunk_mb, args.coarse_planes,
+        args.batch_size, args.view_num, args.max_h, args.max_w, args.numdepth))
+    print('forward: mean {:.3f}s, min {:.3f}s over {} iters, {:.3f}s per view, {}'.format(
+        np.mean(times), np.min(times), len(times), np.mean(times) / args.batch_size,
+        depth_errors(outputs['depth'].cpu().numpy(), depth_gt, interval)))
+    if args.compare_full and args.coarse_planes:
+        # the single full sweep with the same weights
+        args.coarse_planes = 0
+        full_outputs, full_times, _ = benchmark(args)
+        print('full sweep: mean {:.3f}s, {:.3f}s per view, {}; two-pass vs full: {}'.format(
+            np.mean(full_times), np.mean(full_times) / args.batch_size,
+            depth_errors(full_outputs['depth'].cpu().numpy(), depth_gt, interval),
+            depth_errors(outputs['depth'].cpu().numpy(), full_outputs['depth'].cpu().numpy(), interval)))
+    if torch.device(args.device).type == 'cuda':
+        print('cuda memory: peak allocated {:.1f} MB, {} allocations'.format(
+            torch.cuda.max_memory_allocated() / 2 ** 20, torch.cuda.memory_stats()['allocation.all.allocated']))
@@ -4,6 +4,9 @@
 from __future__ import print_function
 
 import collections
+import hashlib
+import itertools
+import json
 import struct
 import numpy as np
 import multiprocessing as mp
@@ -11,6 +14,10 @@ import os
 import argparse
 import shutil
 import cv2
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from datasets.data_io import CAM_BUNDLE_FILE, write_cam_bundle
 
 # ============================ read_model.py ============================#
 CameraModel = collections.namedtuple("CameraModel", ["model_id", "model_name", "num_params"])
@@ -217,6 +224,206 @@ def read_model(path, ext):
     return cameras, images, points3D
 
 
+# ======================== columnar model reader ========================#
+# The readers above build one namedtuple per image and per 3D point, which is far too slow for models with millions
+# of tracks. The columnar readers below parse the whole file at once into flat arrays. Per-image observations and
+# per-point tracks are stored CSR-style: the entries of row k are [offsets[k], offsets[k + 1]).
+ImageColumns = collections.namedtuple("ImageColumns", ["ids", "qvecs", "tvecs", "camera_ids", "names", "obs_offsets",
+                                                       "xys", "point3D_ids"])
+Point3DColumns = collections.namedtuple("Point3DColumns", ["ids", "xyz", "rgb", "error", "track_offsets",
+                                                           "track_image_ids", "track_point2D_idxs"])
+
+IMAGE_OBS_DTYPE = np.dtype([("x", "<f8"), ("y", "<f8"), ("point3D_id", "<i8")])
+POINT3D_DTYPE = np.dtype([("id", "<u8"), ("xyz", "<f8", (3,)), ("rgb", "u1", (3,)), ("error", "<f8")])
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def _range_mask(length, starts, ends):
+    """Boolean mask of size `length` which is True inside the disjoint ranges [starts[k], ends[k])."""
+    # every range boundary toggles the mask; touching or empty ranges toggle twice and cancel out
+    marks = np.zeros(length + 1, dtype=bool)
+    marks[starts] ^= True
+    marks[ends] ^= True
+    return np.logical_xor.accumulate(marks[:-1])
+
+
+def _counts_to_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _split_text_rows(lines):
+    """Split whitespace separated rows into one flat token list and the per-row token counts."""
+    rows = [line.split() for line in lines]
+    counts = np.array([len(row) for row in rows], dtype=np.int64)
+    return rows, list(itertools.chain.from_iterable(rows)), counts
+
+
+def _filter_observations(obs_offsets, point3D_ids, xys, keep_unmatched):
+    if keep_unmatched:
+        return obs_offsets, point3D_ids, xys
+    matched = point3D_ids != -1
+    rows = np.repeat(np.arange(len(obs_offsets) - 1), np.diff(obs_offsets))
+    obs_offsets = _counts_to_offsets(np.bincount(rows[matched], minlength=len(obs_offsets) - 1))
+    return obs_offsets, point3D_ids[matched], None if xys is None else xys[matched]
+
+
+def _sort_image_columns(images):
+    """Reorder the image rows by image id, as the dict based readers are indexed."""
+    order = np.argsort(images.ids, kind="stable")
+    if np.all(order == np.arange(len(order))):
+        return images
+    counts = np.diff(images.obs_offsets)[order]
+    obs_order = np.concatenate([np.arange(images.obs_offsets[k], images.obs_offsets[k + 1]) for k in order] +
+                               [np.zeros(0, dtype=np.int64)])
+    return ImageColumns(ids=images.ids[order], qvecs=images.qvecs[order], tvecs=images.tvecs[order],
+                        camera_ids=images.camera_ids[order], names=[images.names[k] for k in order],
+                        obs_offsets=_counts_to_offsets(counts),
+                        xys=None if images.xys is None else images.xys[obs_order],
+                        point3D_ids=images.point3D_ids[obs_order])
+
+
+def read_images_text_columnar(path, read_xys=True, keep_unmatched=True):
+    """Columnar version of read_images_text.
+    :param path: images.txt
+    :param read_xys: If False, the 2D keypoint coordinates are not parsed and `xys` is None.
+    :param keep_unmatched: If False, observations without a 3D point (point3D_id == -1) are dropped.
+    :return: ImageColumns sorted by image id.
+    """
+    with open(path, "r") as fid:
+        lines = [line.strip() for line in fid.read().splitlines() if not line.startswith("#")]
+    # every image takes two lines: the properties and the (possibly empty) list of observations
+    lines = lines[:len(lines) - len(lines) % 2]
+    headers = [line.split() for line in lines[0::2]]
+    ids = np.array([int(elems[0]) for elems in headers], dtype=np.int64)
+    props = np.array([elems[1:8] for elems in headers], dtype=np.float64).reshape(-1, 7)
+    camera_ids = np.array([int(elems[8]) for elems in headers], dtype=np.int64)
+    names = [elems[9] for elems in headers]
+
+    # converting the tokens dominates, so the keypoint coordinates are only converted when asked for
+    _, tokens, counts = _split_text_rows(lines[1::2])
+    obs_offsets = _counts_to_offsets(counts // 3)
+    point3D_ids = np.array(tokens[2::3], dtype=np.int64)
+    xys = np.array([tokens[0::3], tokens[1::3]], dtype=np.float64).T.copy() if read_xys else None
+    obs_offsets, point3D_ids, xys = _filter_observations(obs_offsets, point3D_ids, xys, keep_unmatched)
+    return _sort_image_columns(ImageColumns(ids=ids, qvecs=props[:, 0:4], tvecs=props[:, 4:7], camera_ids=camera_ids,
+                                            names=names, obs_offsets=obs_offsets, xys=xys, point3D_ids=point3D_ids))
+
+
+def read_images_binary_columnar(path_to_model_file, read_xys=True, keep_unmatched=True):
+    """Columnar version of read_images_binary, see read_images_text_columnar for the parameters."""
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+    image_properties = struct.Struct("<idddddddi")
+    num_reg_images = struct.unpack_from("<Q", data, 0)[0]
+    ids = np.empty(num_reg_images, dtype=np.int64)
+    props = np.empty((num_reg_images, 7), dtype=np.float64)
+    camera_ids = np.empty(num_reg_images, dtype=np.int64)
+    names = []
+    starts = np.empty(num_reg_images, dtype=np.int64)
+    counts = np.empty(num_reg_images, dtype=np.int64)
+    # only the small per-image headers are walked in Python, the observations are viewed in bulk below
+    pos = 8
+    for image_index in range(num_reg_images):
+        binary_image_properties = image_properties.unpack_from(data, pos)
+        ids[image_index] = binary_image_properties[0]
+        props[image_index] = binary_image_properties[1:8]
+        camera_ids[image_index] = binary_image_properties[8]
+        pos += image_properties.size
+        name_end = data.index(b"\x00", pos)
+        names.append(data[pos:name_end].decode("utf-8"))
+        counts[image_index] = struct.unpack_from("<Q", data, name_end + 1)[0]
+        starts[image_index] = name_end + 9
+        pos = name_end + 9 + IMAGE_OBS_DTYPE.itemsize * counts[image_index]
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    obs = buf[_range_mask(len(buf), starts, starts + IMAGE_OBS_DTYPE.itemsize * counts)].view(IMAGE_OBS_DTYPE)
+    point3D_ids = obs["point3D_id"].astype(np.int64)
+    xys = np.stack([obs["x"], obs["y"]], axis=1) if read_xys else None
+    obs_offsets, point3D_ids, xys = _filter_observations(_counts_to_offsets(counts), point3D_ids, xys, keep_unmatched)
+    return _sort_image_columns(ImageColumns(ids=ids, qvecs=props[:, 0:4], tvecs=props[:, 4:7], camera_ids=camera_ids,
+                                            names=names, obs_offsets=obs_offsets, xys=xys, point3D_ids=point3D_ids))
+
+
+def read_points3D_text_columnar(path, read_tracks=True):
+    """Columnar version of read_points3D_text.
+    :param path: points3D.txt
+    :param read_tracks: If False, the tracks are not returned (track_* are None).
+    :return: Point3DColumns in file order.
+    """
+    with open(path, "r") as fid:
+        lines = [line for line in fid.read().splitlines() if line.strip() and not line.startswith("#")]
+    rows = [line.split(None, 8) for line in lines]
+    fixed = np.array([row[:8] for row in rows], dtype=np.float64).reshape(-1, 8)
+    track_offsets, track_image_ids, track_point2D_idxs = None, None, None
+    if read_tracks:
+        _, tokens, counts = _split_text_rows([row[8] if len(row) > 8 else "" for row in rows])
+        track = np.array(tokens, dtype=np.int64).reshape(-1, 2)
+        track_offsets = _counts_to_offsets(counts // 2)
+        track_image_ids, track_point2D_idxs = track[:, 0], track[:, 1]
+    return Point3DColumns(ids=fixed[:, 0].astype(np.int64), xyz=fixed[:, 1:4], rgb=fixed[:, 4:7].astype(np.uint8),
+                          error=fixed[:, 7], track_offsets=track_offsets, track_image_ids=track_image_ids,
+                          track_point2D_idxs=track_point2D_idxs)
+
+
+def read_points3d_binary_columnar(path_to_model_file, read_tracks=True):
+    """Columnar version of read_points3d_binary, see read_points3D_text_columnar for the parameters."""
+    with open(path_to_model_file, "rb") as fid:
+        data = fid.read()
+    num_points = struct.unpack_from("<Q", data, 0)[0]
+    # a point record is 43 bytes of properties, the 8 byte track length and 8 bytes per track element; only the
+    # record boundaries are found in Python, everything else is a bulk view of the buffer
+    track_length = struct.Struct("<Q").unpack_from
+    fixed_size = POINT3D_DTYPE.itemsize
+    starts = []
+    lengths = []
+    pos = 8
+    for point_line_index in range(num_points):
+        starts.append(pos)
+        n = track_length(data, pos + fixed_size)[0]
+        lengths.append(n)
+        pos += fixed_size + 8 + TRACK_ELEM_DTYPE.itemsize * n
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    points = buf[_range_mask(len(buf), starts, starts + fixed_size)].view(POINT3D_DTYPE)
+    track_offsets, track_image_ids, track_point2D_idxs = None, None, None
+    if read_tracks:
+        track_starts = starts + fixed_size + 8
+        track = buf[_range_mask(len(buf), track_starts, track_starts + TRACK_ELEM_DTYPE.itemsize * lengths)].view(
+            TRACK_ELEM_DTYPE)
+        track_offsets = _counts_to_offsets(lengths)
+        track_image_ids = track["image_id"].astype(np.int64)
+        track_point2D_idxs = track["point2D_idx"].astype(np.int64)
+    return Point3DColumns(ids=points["id"].astype(np.int64), xyz=points["xyz"].copy(), rgb=points["rgb"].copy(),
+                          error=points["error"].copy(), track_offsets=track_offsets, track_image_ids=track_image_ids,
+                          track_point2D_idxs=track_point2D_idxs)
+
+
+def read_model_columnar(path, ext, read_xys=False, keep_unmatched=False, read_tracks=False):
+    """Read a model into columns. By default only the columns needed for view selection are parsed."""
+    if ext == ".txt":
+        cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
+        images = read_images_text_columnar(os.path.join(path, "images" + ext), read_xys, keep_unmatched)
+        points3D = read_points3D_text_columnar(os.path.join(path, "points3D") + ext, read_tracks)
+    else:
+        cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
+        images = read_images_binary_columnar(os.path.join(path, "images" + ext), read_xys, keep_unmatched)
+        points3D = read_points3d_binary_columnar(os.path.join(path, "points3D") + ext, read_tracks)
+    return cameras, images, points3D
+
+
+def point3D_id_to_index(points3D, point3D_ids):
+    """Map COLMAP point3D ids to rows of the Point3DColumns; -1 (unmatched) stays -1."""
+    lookup = np.full(max(points3D.ids.max(initial=0), point3D_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+    lookup[points3D.ids] = np.arange(len(points3D.ids))
+    index = lookup[np.maximum(point3D_ids, 0)]
+    index[point3D_ids < 0] = -1
+    return index
+
+
 def qvec2rotmat(qvec):
     return np.array([[1 - 2 * qvec[2] ** 2 - 2 * qvec[3] ** 2, 2 * qvec[1] * qvec[2] - 2 * qvec[0] * qvec[3],
                       2 * qvec[3] * qvec[1] + 2 * qvec[0] * qvec[2]],
@@ -238,6 +445,412 @@ def rotmat2qvec(R):
     return qvec
 
 
+# ============================= depth range =============================#
+def compute_depth_ranges(obs_offsets, obs_points, extrinsics, intrinsics, xyz, max_d, interval_scale, views=None):
+    """Relaxed depth range of every image from the depths of the 3D points it observes.
+    depth_min and depth_max are the 1% and 99% order statistics of the point depths. If max_d is 0, the number of
+    depth planes is determined by the inverse depth setting, see MVSNet supplementary material.
+    :param obs_offsets: observation offsets of every image, see ImageColumns
+    :param obs_points: point row of every observation, -1 for unmatched keypoints, see point3D_id_to_index
+    :param extrinsics: (num_images, 4, 4) world to camera transforms
+    :param intrinsics: (num_images, 3, 3) camera matrices
+    :param xyz: (num_points, 3) point coordinates
+    :param views: If given, only the depth ranges of these images are computed
+    :return: depth_min, depth_interval, both of shape (num_images,) or (len(views),) in increasing view order
+    """
+    num_images = len(extrinsics)
+    views = np.arange(num_images) if views is None else np.sort(views)
+    selected = np.zeros(num_images, dtype=bool)
+    selected[views] = True
+    rows = np.repeat(np.arange(num_images), np.diff(obs_offsets))
+    valid = (obs_points >= 0) & selected[rows]
+    rows, points = rows[valid], obs_points[valid]
+    counts = np.bincount(rows, minlength=num_images)[views]
+    if not counts.all():
+        raise ValueError('image %d does not observe any 3D point' % views[np.flatnonzero(counts == 0)[0]])
+
+    # depth of every observed point in its image, sorted per image
+    zs = np.einsum('ij,ij->i', extrinsics[rows, 2, :3], xyz[points]) + extrinsics[rows, 2, 3]
+    zs = zs[np.lexsort((zs, rows))]
+    starts = _counts_to_offsets(counts)[:-1]
+    depth_min = zs[starts + (counts * .01).astype(np.int64)]
+    depth_max = zs[starts + (counts * .99).astype(np.int64)]
+
+    extrinsics, intrinsics = extrinsics[views], intrinsics[views]
+    if max_d == 0:
+        # back-project the principal point and its right neighbour at depth_min
+        inv_k = np.linalg.inv(intrinsics)
+        inv_r = np.linalg.inv(extrinsics[:, :3, :3])
+        t = extrinsics[:, :3, 3]
+        p1 = np.stack([intrinsics[:, 0, 2], intrinsics[:, 1, 2], np.ones(len(views))], axis=1)
+        p2 = p1 + [1, 0, 0]
+        P1 = np.matmul(inv_k, p1[:, :, None])[:, :, 0] * depth_min[:, None]
+        P1 = np.matmul(inv_r, (P1 - t)[:, :, None])[:, :, 0]
+        P2 = np.matmul(inv_k, p2[:, :, None])[:, :, 0] * depth_min[:, None]
+        P2 = np.matmul(inv_r, (P2 - t)[:, :, None])[:, :, 0]
+        depth_num = (1 / depth_min - 1 / depth_max) / (
+                1 / depth_min - 1 / (depth_min + np.linalg.norm(P2 - P1, axis=1)))
+    else:
+        depth_num = max_d
+    depth_interval = (depth_max - depth_min) / (depth_num - 1) / interval_scale
+    return depth_min, depth_interval
+
+
+# ============================ view selection ===========================#
+# number of (image pair, shared point) combinations scored at once
+VIEW_SEL_CHUNK = 1 << 22
+
+
+def build_incidence_matrix(obs_offsets, obs_points, num_points):
+    """Sparse image x point incidence matrix, 1 where an image observes a 3D point.
+    :param obs_offsets: observation offsets of every image, see ImageColumns
+    :param obs_points: point row of every observation, -1 for unmatched keypoints, see point3D_id_to_index
+    :param num_points: number of 3D points
+    :return: (num_images, num_points) scipy.sparse.csr_matrix
+    """
+    num_images = len(obs_offsets) - 1
+    rows = np.repeat(np.arange(num_images), np.diff(obs_offsets))
+    valid = obs_points >= 0
+    incidence = sparse.csr_matrix((np.ones(np.count_nonzero(valid), dtype=np.int32), (rows[valid], obs_points[valid])),
+                                  shape=(num_images, num_points))
+    # a point observed twice by the same image still counts once
+    incidence.data[:] = 1
+    return incidence
+
+
+def covisibility_matrix(incidence):
+    """Number of 3D points shared by every pair of images, as a sparse (num_images, num_images) matrix."""
+    return (incidence @ incidence.T).tocsr()
+
+
+def _in_frustum(extrinsics, intrinsics, image_sizes, points):
+    """Whether points[k] projects inside image k, in front of the camera."""
+    cam = np.einsum('nij,nj->ni', extrinsics[:, :3, :3], points) + extrinsics[:, :3, 3]
+    pix = np.einsum('nij,nj->ni', intrinsics, cam)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x, y = pix[:, 0] / pix[:, 2], pix[:, 1] / pix[:, 2]
+    return (cam[:, 2] > 0) & (x >= 0) & (x < image_sizes[:, 0]) & (y >= 0) & (y < image_sizes[:, 1])
+
+
+def candidate_pairs(extrinsics, intrinsics, image_sizes, look_at, num_neighbors, max_view_angle):
+    """Propose the image pairs worth scoring, so that view selection grows linearly with the number of images.
+    Every image is paired with its num_neighbors nearest cameras (KD-tree over the camera centers) whose viewing
+    directions differ by at most max_view_angle degrees and whose frustums overlap, i.e. the look-at point of one of
+    the two views projects inside the other one.
+    :param extrinsics: (num_images, 4, 4) world to camera transforms
+    :param intrinsics: (num_images, 3, 3) camera matrices
+    :param image_sizes: (num_images, 2) width and height
+    :param look_at: (num_images, 3) a point in front of every camera, e.g. the centroid of its observed points
+    :return: symmetric boolean (num_images, num_images) scipy.sparse.csr_matrix of the candidate pairs and the
+        (num_images, <= num_neighbors) nearest neighbors of every image, nearest first
+    """
+    num_images = len(extrinsics)
+    rotations = extrinsics[:, :3, :3]
+    centers = -np.einsum('nji,nj->ni', rotations, extrinsics[:, :3, 3])
+    # the optical axis is the third row of the world to camera rotation
+    view_dirs = rotations[:, 2, :]
+
+    k = min(num_neighbors + 1, num_images)
+    _, neighbors = cKDTree(centers).query(centers, k=k)
+    neighbors = neighbors.reshape(num_images, k)
+    # drop every image from its own neighbors, it is not necessarily the first one if cameras coincide
+    not_self = neighbors != np.arange(num_images)[:, None]
+    neighbors = np.stack([row[keep][:k - 1] for row, keep in zip(neighbors, not_self)]) if k > 1 \
+        else np.zeros((num_images, 0), dtype=np.int64)
+
+    rows = np.repeat(np.arange(num_images), neighbors.shape[1])
+    cols = neighbors.ravel()
+    keep = np.einsum('ij,ij->i', view_dirs[rows], view_dirs[cols]) >= np.cos(np.deg2rad(max_view_angle))
+    keep &= _in_frustum(extrinsics[rows], intrinsics[rows], image_sizes[rows], look_at[cols]) | \
+        _in_frustum(extrinsics[cols], intrinsics[cols], image_sizes[cols], look_at[rows])
+    candidates = sparse.csr_matrix((np.ones(np.count_nonzero(keep), dtype=bool), (rows[keep], cols[keep])),
+                                   shape=(num_images, num_images))
+    return (candidates + candidates.T).tocsr(), neighbors
+
+
+def _candidate_tracks(incidence, xyz, rows, cols):
+    """The observations and points which can contribute to the candidate pairs (rows[k], cols[k]): the rows of the
+    images without a candidate pair are cleared, and the tracks without an image of a vertex cover of the pairs
+    (each pair contributes its endpoint with the most pairs, e.g. the changed image of the pairs with a changed image)
+    are dropped.
+    """
+    num_images = incidence.shape[0]
+    degree = np.bincount(rows, minlength=num_images) + np.bincount(cols, minlength=num_images)
+    paired = np.zeros(num_images, dtype=incidence.dtype)
+    paired[rows] = paired[cols] = 1
+    cover = np.zeros(num_images, dtype=incidence.dtype)
+    cover[np.where(degree[rows] >= degree[cols], rows, cols)] = 1
+    incidence = (sparse.diags(paired, dtype=incidence.dtype) @ incidence).tocsr()
+    incidence.eliminate_zeros()
+    keep = cover @ incidence > 0
+    return incidence[:, keep], xyz[keep]
+
+
+def view_selection_scores(incidence, cam_centers, xyz, theta0, sigma1, sigma2, candidates=None):
+    """Score of every image pair from the triangulation angles of their shared points, see MVSNet supplementary.
+    For each 3D point seen by both views, the angle theta between the rays to the two camera centers contributes
+    exp(-(theta - theta0)^2 / (2 * sigma^2)), sigma being sigma1 if theta <= theta0 else sigma2.
+    :param incidence: image x point incidence matrix, see build_incidence_matrix
+    :param cam_centers: (num_images, 3) camera centers
+    :param xyz: (num_points, 3) point coordinates
+    :param candidates: If given, only these pairs are scored, see candidate_pairs
+    :return: symmetric (num_images, num_images) scipy.sparse.csr_matrix, non-zero only for co-visible pairs
+    """
+    num_images = incidence.shape[0]
+    if candidates is None:
+        # the co-visible pairs (i < j) are the only ones which get a score
+        pairs = sparse.triu(covisibility_matrix(incidence), k=1).tocoo()
+    else:
+        pairs = sparse.triu(candidates, k=1).tocoo()
+        incidence, xyz = _candidate_tracks(incidence, xyz, pairs.row, pairs.col)
+    pair_keys = np.sort(pairs.row.astype(np.int64) * num_images + pairs.col)
+    pair_scores = np.zeros(len(pair_keys))
+
+    # every track as a run of image rows, sorted so that the pairs below always have i < j
+    tracks = incidence.tocsc()
+    tracks.sort_indices()
+    track_lens = np.diff(tracks.indptr)
+    rays = cam_centers[tracks.indices] - xyz[np.repeat(np.arange(tracks.shape[1]), track_lens)]
+    ray_norms = np.linalg.norm(rays, axis=1)
+
+    # all the pairs of a track of length n are the same upper triangle, so tracks are scored grouped by length
+    for track_len in np.unique(track_lens[track_lens > 1]) if len(pair_keys) else []:
+        starts = tracks.indptr[:-1][track_lens == track_len]
+        first, second = np.triu_indices(track_len, 1)
+        step = max(1, VIEW_SEL_CHUNK // len(first))
+        for k in range(0, len(starts), step):
+            obs_i = (starts[k:k + step, None] + first).ravel()
+            obs_j = (starts[k:k + step, None] + second).ravel()
+            keys = tracks.indices[obs_i].astype(np.int64) * num_images + tracks.indices[obs_j]
+            index = np.minimum(np.searchsorted(pair_keys, keys), len(pair_keys) - 1)
+            if candidates is not None:
+                scored = pair_keys[index] == keys
+                obs_i, obs_j, index = obs_i[scored], obs_j[scored], index[scored]
+            cos = np.einsum('ij,ij->i', rays[obs_i], rays[obs_j]) / ray_norms[obs_i] / ray_norms[obs_j]
+            theta = (180 / np.pi) * np.arccos(np.clip(cos, -1, 1))
+            sigma = np.where(theta <= theta0, sigma1, sigma2)
+            weights = np.exp(-(theta - theta0) * (theta - theta0) / (2 * sigma ** 2))
+            pair_scores += np.bincount(index, weights, minlength=len(pair_keys))
+
+    score = sparse.csr_matrix((pair_scores, (pair_keys // num_images, pair_keys % num_images)),
+                              shape=(num_images, num_images))
+    # candidate pairs without a shared point
+    score.eliminate_zeros()
+    return (score + score.T).tocsr()
+
+
+def top_k_views(score, k, neighbors):
+    """Select the k best source views of every image from a sparse score matrix.
+    Views are sorted by decreasing score; images with less than k scored views are completed with their nearest
+    unscored neighbors (score 0), like the dense selection which also lists views with a zero score.
+    :param score: (num_images, num_images) scipy.sparse.csr_matrix, see view_selection_scores
+    :param neighbors: (num_images, n) nearest neighbors of every image, see candidate_pairs
+    :return: list of [(view, score), ...] per image
+    """
+    view_sel = []
+    for i in range(score.shape[0]):
+        row = score.getrow(i)
+        positive = row.data > 0
+        views, scores = row.indices[positive], row.data[positive]
+        order = np.lexsort((views, -scores))[:k]
+        sel = [(v, s) for v, s in zip(views[order], scores[order])]
+        selected = set(views[order])
+        sel += [(v, 0.0) for v in neighbors[i] if v not in selected][:k - len(sel)]
+        view_sel.append(sel)
+    return view_sel
+
+
+# ============================= image export ============================#
+EXPORT_MANIFEST = '.export_manifest.json'
+LINK_MODES = ['hard', 'soft', 'copy']
+
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _link_or_copy(src, dst, link):
+    """Hardlink or symlink src to dst, falling back to the next mode of LINK_MODES, e.g. across file systems."""
+    for mode in LINK_MODES[LINK_MODES.index(link):]:
+        try:
+            if mode == 'hard':
+                os.link(src, dst)
+            elif mode == 'soft':
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                shutil.copyfile(src, dst)
+            return mode
+        except OSError:
+            if mode == 'copy':
+                raise
+
+
+def _export_image(job):
+    src, dst, convert, link = job
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if convert:
+        img = cv2.imread(src)
+        if img is None:
+            raise IOError('Cannot read image ' + src)
+        cv2.imwrite(dst, img)
+        return 'convert'
+    return _link_or_copy(src, dst, link)
+
+
+def export_images(sources, out_dir, convert_format, link='hard', workers=1, use_hash=False):
+    """Export the images as out_dir/%08d.jpg, in parallel and incrementally.
+    Images are re-encoded to jpg if convert_format, else linked (see _link_or_copy). Outputs whose source path, size,
+    mtime and requested export mode did not change since the last export are skipped; with use_hash, a source whose
+    mtime changed but whose sha1 did not is skipped as well. The export state is kept in out_dir/.export_manifest.json,
+    with the mode each image was actually exported with after the fallbacks of _link_or_copy.
+    :param sources: source image path of every view
+    :return: collections.Counter of the number of images per action
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, EXPORT_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    new_manifest, jobs = {}, []
+    for i, src in enumerate(sources):
+        name = '%08d.jpg' % i
+        dst = os.path.join(out_dir, name)
+        stat = os.stat(src)
+        entry = {'source': os.path.abspath(src), 'request': 'convert' if convert_format else link,
+                 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        old = manifest.get(name, {})
+        same_source = os.path.exists(dst) and all(old.get(key) == entry[key] for key in ('source', 'request', 'size'))
+        unchanged = same_source and old.get('mtime_ns') == entry['mtime_ns']
+        if use_hash:
+            entry['sha1'] = old['sha1'] if unchanged and 'sha1' in old else _file_sha1(src)
+            unchanged = unchanged or (same_source and old.get('sha1') == entry['sha1'])
+        new_manifest[name] = entry
+        if unchanged:
+            entry['export'] = old['export']
+        else:
+            jobs.append((src, dst, convert_format, link))
+
+    # outputs of views which do not exist anymore
+    for name in set(manifest) - set(new_manifest):
+        if os.path.lexists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+
+    if workers > 1 and len(jobs) > 1:
+        with mp.Pool(min(workers, len(jobs))) as pool:
+            modes = pool.map(_export_image, jobs, chunksize=max(1, len(jobs) // (4 * workers)))
+    else:
+        modes = list(map(_export_image, jobs))
+    # the mode each image was exported with, e.g. copy when a hardlink crosses file systems
+    for (_, dst, _, _), mode in zip(jobs, modes):
+        new_manifest[os.path.basename(dst)]['export'] = mode
+    counts = collections.Counter(modes, skip=len(sources) - len(jobs))
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(new_manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return counts
+
+
+# ========================== incremental update =========================#
+STATE_FILE = 'colmap_input_state.npz'
+
+
+def image_fingerprints(images, obs_points, points3D, intrinsics, image_sizes):
+    """Hash of everything the cam file and the pair scores of an image depend on: its name, camera, pose and the ids
+    and coordinates of its observed 3D points.
+    :return: (num_images,) array of hex digests
+    """
+    fingerprints = []
+    for i in range(len(images.ids)):
+        p3d = obs_points[images.obs_offsets[i]:images.obs_offsets[i + 1]]
+        p3d = p3d[p3d >= 0]
+        # point rows move when points are added to the model, their ids do not
+        p3d = p3d[np.argsort(points3D.ids[p3d], kind='stable')]
+        sha1 = hashlib.sha1(images.names[i].encode('utf-8'))
+        for array in (intrinsics[i], image_sizes[i], images.qvecs[i], images.tvecs[i], points3D.ids[p3d],
+                      points3D.xyz[p3d]):
+            sha1.update(np.ascontiguousarray(array).tobytes())
+        fingerprints.append(sha1.hexdigest())
+    return np.array(fingerprints)
+
+
+def load_state(path, params):
+    """State saved by the previous incremental run, None if there is none or if it was made with other parameters."""
+    if not os.path.exists(path):
+        return None
+    state = dict(np.load(path))
+    if str(state['params']) != json.dumps(params, sort_keys=True):
+        print('conversion parameters changed, all images are updated')
+        return None
+    return state
+
+
+def save_state(path, params, names, fingerprints, depth_min, depth_interval, score, candidates, view_sel):
+    score = sparse.triu(score, k=1).tocoo()
+    state = {'params': json.dumps(params, sort_keys=True), 'names': np.array(names), 'fingerprints': fingerprints,
+             'depth_min': depth_min, 'depth_interval': depth_interval, 'score_rows': score.row,
+             'score_cols': score.col, 'score_data': score.data,
+             'pair_offsets': _counts_to_offsets([len(sel) for sel in view_sel]),
+             'pair_views': np.array([v for sel in view_sel for v, _ in sel], dtype=np.int64)}
+    if candidates is not None:
+        candidates = sparse.triu(candidates, k=1).tocoo()
+        state.update(candidate_rows=candidates.row, candidate_cols=candidates.col)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **state)
+    os.replace(path + '.tmp', path)
+
+
+def _remap_pairs(rows, cols, data, old_to_new, keep, num_images):
+    """Symmetric sparse matrix of the pairs of the previous run whose images both still exist and have keep set."""
+    rows, cols = old_to_new[rows], old_to_new[cols]
+    valid = (rows >= 0) & (cols >= 0)
+    valid[valid] = keep[rows[valid]] & keep[cols[valid]]
+    pairs = sparse.csr_matrix((data[valid], (rows[valid], cols[valid])), shape=(num_images, num_images))
+    return (pairs + pairs.T).tocsr()
+
+
+def incremental_update(state, names, fingerprints):
+    """Match the images to the ones of the previous run by name.
+    :return: index of every image in the previous run (-1 if new), mask of the images to recompute (new or changed)
+        and index of every previous image in the current run (-1 if removed)
+    """
+    old_names = list(state['names'])
+    old_position = {name: i for i, name in enumerate(old_names)}
+    old_index = np.array([old_position.get(name, -1) for name in names], dtype=np.int64)
+    recompute = (old_index < 0) | (state['fingerprints'][np.maximum(old_index, 0)] != fingerprints)
+    old_to_new = np.full(len(old_names), -1, dtype=np.int64)
+    old_to_new[old_index[old_index >= 0]] = np.flatnonzero(old_index >= 0)
+    return old_index, recompute, old_to_new
+
+
+def reused_scores(state, old_to_new, unchanged, num_images):
+    """Scores of the previous run between images which did not change, and the pairs which were scored among them
+    (None if all pairs were scored).
+    """
+    score = _remap_pairs(state['score_rows'], state['score_cols'], state['score_data'], old_to_new, unchanged,
+                         num_images)
+    scored = None
+    if 'candidate_rows' in state:
+        scored = _remap_pairs(state['candidate_rows'], state['candidate_cols'],
+                              np.ones(len(state['candidate_rows']), dtype=np.int8), old_to_new, unchanged, num_images)
+    return score, scored
+
+
+def pairs_with(views, num_images):
+    """Symmetric sparse matrix of all the pairs which involve one of the views."""
+    rows = np.repeat(views, num_images)
+    cols = np.tile(np.arange(num_images), len(views))
+    pairs = sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_images, num_images))
+    return ((pairs + pairs.T) > 0).astype(np.int8)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert colmap results into input for PatchmatchNet')
 
@@ -250,11 +863,30 @@ if __name__ == '__main__':
     parser.add_argument('--theta0', type=float, default=5)
     parser.add_argument('--sigma1', type=float, default=1)
     parser.add_argument('--sigma2', type=float, default=10)
+    parser.add_argument('--view_num', type=int, default=10, help='number of source views written to pair.txt')
+    # 候选邻域帧: all 对所有图像对打分, kdtree 只对相机中心的近邻打分 (大场景)
+    parser.add_argument('--candidates', type=str, default='all', choices=['all', 'kdtree'],
+                        help='score all image pairs, or only the pairs proposed by a KD-tree over camera centers')
+    parser.add_argument('--candidate_num', type=int, default=50, help='nearest cameras proposed for every image')
+    parser.add_argument('--max_view_angle', type=float, default=90,
+                        help='max angle (degree) between the viewing directions of a candidate pair')
     # 如果只执行这段代码结果不保存
     parser.add_argument('--test', action='store_true', default=False, help='If set, do not write to file.')
     # 将图像转换为jpg格式
     parser.add_argument('--convert_format', action='store_true', default=False,
                         help='If set, convert image to jpg format.')
+    # 不转换格式时图像以硬链接/软链接/复制的方式导出, 未改变的图像不再重复导出
+    parser.add_argument('--link', type=str, default='hard', choices=LINK_MODES,
+                        help='how images are exported without --convert_format, falls back to the next mode on error')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='processes used to export images')
+    parser.add_argument('--export_hash', action='store_true', default=False,
+                        help='If set, also compare the sha1 of source images to skip unchanged exports.')
+    # 相机参数另存为单个二进制文件 cams/cams.npy, 数据读取时优先使用
+    parser.add_argument('--cam_bundle', action='store_true', default=False,
+                        help='If set, also write all cameras to cams/cams.npy, which the loaders read first.')
+    # 增量模式: 只重新计算新增或改变的图像, 其余沿用上次的结果
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='If set, reuse the results of the previous --incremental run for unchanged images.')
 
     args = parser.parse_args()
 
@@ -264,10 +896,12 @@ if __name__ == '__main__':
     cam_dir = os.path.join(args.folder, 'cams')
     renamed_dir = os.path.join(args.folder, 'images')
     # the colmap results may be stored in '.bin' or '.txt' format
-    cameras, images, points3d = read_model(model_dir, '.txt')
-    # cameras, images, points3d = read_model(model_dir, '.bin')
+    cameras, images, points3d = read_model_columnar(model_dir, '.txt')
+    # cameras, images, points3d = read_model_columnar(model_dir, '.bin')
+    # row of every observation's 3D point in the points3d columns
+    obs_points = point3D_id_to_index(points3d, images.point3D_ids)
 
-    num_images = len(list(images.items()))
+    num_images = len(images.ids)
     # 选择相机模型
     param_type = {'SIMPLE_PINHOLE': ['f', 'cx', 'cy'], 'PINHOLE': ['fx', 'fy', 'cx', 'cy'],
         'SIMPLE_RADIAL': ['f', 'cx', 'cy', 'k'], 'SIMPLE_RADIAL_FISHEYE': ['f', 'cx', 'cy', 'k'],
@@ -292,78 +926,78 @@ if __name__ == '__main__':
 
     # extrinsic
     extrinsic = {}
-    for image_id, image in images.items():
+    for image_id, qvec, tvec in zip(images.ids, images.qvecs, images.tvecs):
         e = np.zeros((4, 4))
-        e[:3, :3] = qvec2rotmat(image.qvec)
-        e[:3, 3] = image.tvec
+        e[:3, :3] = qvec2rotmat(qvec)
+        e[:3, 3] = tvec
         e[3, 3] = 1
         extrinsic[image_id] = e
     print('extrinsic[1]\n', extrinsic[1], end='\n\n')
 
+    extrinsics = np.stack([extrinsic[i + 1] for i in range(num_images)])
+    intrinsics = np.stack([intrinsic[camera_id] for camera_id in images.camera_ids])
+    image_sizes = np.array([[cameras[camera_id].width, cameras[camera_id].height] for camera_id in images.camera_ids])
+
+    # incremental update: the images which did not change since the previous run keep their results
+    state_path = os.path.join(args.folder, STATE_FILE)
+    state_params = {key: getattr(args, key) for key in ('max_d', 'interval_scale', 'theta0', 'sigma1', 'sigma2',
+                                                        'candidates', 'candidate_num', 'max_view_angle')}
+    fingerprints = image_fingerprints(images, obs_points, points3d, intrinsics, image_sizes)
+    state = load_state(state_path, state_params) if args.incremental else None
+    if state is None:
+        old_index, recompute = np.full(num_images, -1), np.ones(num_images, dtype=bool)
+    else:
+        old_index, recompute, old_to_new = incremental_update(state, images.names, fingerprints)
+        print('incremental update: %d of %d images new or changed' % (np.count_nonzero(recompute), num_images),
+              end='\n\n')
+    changed = np.flatnonzero(recompute)
+
     # depth range and interval
-    depth_ranges = {}
-    for i in range(num_images):
-        zs = []
-        for p3d_id in images[i + 1].point3D_ids:
-            if p3d_id == -1:
-                continue
-            transformed = np.matmul(extrinsic[i + 1],
-                                    [points3d[p3d_id].xyz[0], points3d[p3d_id].xyz[1], points3d[p3d_id].xyz[2], 1])
-            zs.append(np.asscalar(transformed[2]))
-        zs_sorted = sorted(zs)
-        # relaxed depth range
-        depth_min = zs_sorted[int(len(zs) * .01)]
-        depth_max = zs_sorted[int(len(zs) * .99)]
-        # determine depth number by inverse depth setting, see supplementary material
-        if args.max_d == 0:
-            image_int = intrinsic[images[i + 1].camera_id]
-            image_ext = extrinsic[i + 1]
-            image_r = image_ext[0:3, 0:3]
-            image_t = image_ext[0:3, 3]
-            p1 = [image_int[0, 2], image_int[1, 2], 1]
-            p2 = [image_int[0, 2] + 1, image_int[1, 2], 1]
-            P1 = np.matmul(np.linalg.inv(image_int), p1) * depth_min
-            P1 = np.matmul(np.linalg.inv(image_r), (P1 - image_t))
-            P2 = np.matmul(np.linalg.inv(image_int), p2) * depth_min
-            P2 = np.matmul(np.linalg.inv(image_r), (P2 - image_t))
-            depth_num = (1 / depth_min - 1 / depth_max) / (1 / depth_min - 1 / (depth_min + np.linalg.norm(P2 - P1)))
-        else:
-            depth_num = args.max_d
-        depth_interval = (depth_max - depth_min) / (depth_num - 1) / args.interval_scale
-        depth_ranges[i + 1] = (depth_min, depth_interval)
+    depth_min, depth_interval = np.zeros(num_images), np.zeros(num_images)
+    if state is not None:
+        depth_min[~recompute] = state['depth_min'][old_index[~recompute]]
+        depth_interval[~recompute] = state['depth_interval'][old_index[~recompute]]
+    if len(changed):
+        depth_min[changed], depth_interval[changed] = compute_depth_ranges(
+            images.obs_offsets, obs_points, extrinsics, intrinsics, points3d.xyz, args.max_d, args.interval_scale,
+            views=changed)
+    depth_ranges = {i + 1: (depth_min[i], depth_interval[i]) for i in range(num_images)}
     print('depth_ranges[1]\n', depth_ranges[1], end='\n\n')
 
     # view selection
-    score = np.zeros((len(images), len(images)))
-    queue = []
-    for i in range(len(images)):
-        for j in range(i + 1, len(images)):
-            queue.append((i, j))
-
-    for i, j in queue:
-        id_i = images[i + 1].point3D_ids
-        id_j = images[j + 1].point3D_ids
-        id_intersect = [it for it in id_i if it in id_j]
-        cam_center_i = -np.matmul(extrinsic[i + 1][:3, :3].transpose(), extrinsic[i + 1][:3, 3:4])[:, 0]
-        cam_center_j = -np.matmul(extrinsic[j + 1][:3, :3].transpose(), extrinsic[j + 1][:3, 3:4])[:, 0]
-        s = 0
-        for pid in id_intersect:
-            if pid == -1:
-                continue
-            p = points3d[pid].xyz
-            theta = (180 / np.pi) * np.arccos(
-                np.dot(cam_center_i - p, cam_center_j - p) / np.linalg.norm(cam_center_i - p) / np.linalg.norm(
-                    cam_center_j - p))
-            s += np.exp(-(theta - args.theta0) * (theta - args.theta0) / (
-                    2 * (args.sigma1 if theta <= args.theta0 else args.sigma2) ** 2))
-
-        score[i, j] = s
-        score[j, i] = s
-
-    view_sel = []
-    for i in range(len(images)):
-        sorted_score = np.argsort(score[i])[::-1]
-        view_sel.append([(k, score[i, k]) for k in sorted_score[:10]])
+    cam_centers = np.stack([-np.matmul(extrinsic[i + 1][:3, :3].transpose(), extrinsic[i + 1][:3, 3])
+                            for i in range(num_images)])
+    incidence = build_incidence_matrix(images.obs_offsets, obs_points, len(points3d.ids))
+    candidates = None
+    if args.candidates == 'kdtree':
+        # centroid of the observed points as look-at point of every view
+        look_at = (incidence @ points3d.xyz) / np.asarray(incidence.sum(axis=1))
+        candidates, neighbors = candidate_pairs(extrinsics, intrinsics, image_sizes, look_at, args.candidate_num,
+                                                args.max_view_angle)
+        print('candidate pairs', candidates.nnz // 2, end='\n\n')
+    if state is None:
+        score = view_selection_scores(incidence, cam_centers, points3d.xyz, args.theta0, args.sigma1, args.sigma2,
+                                      candidates)
+    else:
+        # only the pairs which were not scored between two unchanged images are scored
+        score, scored = reused_scores(state, old_to_new, ~recompute, num_images)
+        if candidates is None:
+            todo = pairs_with(changed, num_images)
+        else:
+            score = score.multiply(candidates).tocsr()
+            todo = candidates.astype(np.int8) - candidates.multiply(scored).astype(np.int8)
+            todo.eliminate_zeros()
+        if todo.nnz:
+            score = score + view_selection_scores(incidence, cam_centers, points3d.xyz, args.theta0, args.sigma1,
+                                                  args.sigma2, todo)
+    if candidates is not None:
+        view_sel = top_k_views(score, args.view_num, neighbors)
+    else:
+        dense_score = score.toarray()
+        view_sel = []
+        for i in range(num_images):
+            sorted_score = np.argsort(dense_score[i])[::-1]
+            view_sel.append([(k, dense_score[i, k]) for k in sorted_score[:args.view_num]])
     print('view_sel[0]\n', view_sel[0], end='\n\n')
 
     # write
@@ -372,7 +1006,21 @@ if __name__ == '__main__':
     except os.error:
         print(cam_dir + ' already exist.')
 
-    for i in range(num_images):
+    # the cam file of an image is rewritten if the image changed, if its index did or if the file is missing
+    write_cam = recompute | (old_index != np.arange(num_images)) | np.array(
+        [not os.path.exists(os.path.join(cam_dir, '%08d_cam.txt' % i)) for i in range(num_images)], dtype=bool)
+    changed_views = set(np.flatnonzero(write_cam))
+    if state is not None:
+        # and the views whose source views changed
+        old_num_images = len(state['names'])
+        old_pairs = np.split(old_to_new[state['pair_views']], state['pair_offsets'][1:-1])
+        changed_views.update(i for i in np.flatnonzero(~write_cam)
+                             if list(old_pairs[old_index[i]]) != [v for v, _ in view_sel[i]])
+        for i in range(num_images, old_num_images):
+            if os.path.exists(os.path.join(cam_dir, '%08d_cam.txt' % i)):
+                os.remove(os.path.join(cam_dir, '%08d_cam.txt' % i))
+
+    for i in np.flatnonzero(write_cam):
         with open(os.path.join(cam_dir, '%08d_cam.txt' % i), 'w') as f:
             f.write('extrinsic\n')
             for j in range(4):
@@ -383,25 +1031,36 @@ if __name__ == '__main__':
             f.write('\nintrinsic\n')
             for j in range(3):
                 for k in range(3):
-                    f.write(str(intrinsic[images[i + 1].camera_id][j, k]) + ' ')
+                    f.write(str(intrinsic[images.camera_ids[i]][j, k]) + ' ')
                 f.write('\n')
 
             f.write('\n%f %f \n' % (depth_ranges[i + 1][0], depth_ranges[i + 1][1]))
 
+    # the bundle holds the values written to the text files, so that both give the same cameras
+    bundle_path = os.path.join(cam_dir, CAM_BUNDLE_FILE)
+    if args.cam_bundle:
+        write_cam_bundle(cam_dir, np.arange(num_images), extrinsics, intrinsics,
+                         [[float('%f' % depth_ranges[i + 1][0]), float('%f' % depth_ranges[i + 1][1])]
+                          for i in range(num_images)])
+    elif os.path.exists(bundle_path):
+        # a bundle left from a previous run would shadow the new text files
+        os.remove(bundle_path)
+
     with open(os.path.join(args.folder, 'pair.txt'), 'w') as f:
-        f.write('%d\n' % len(images))
+        f.write('%d\n' % num_images)
         for i, sorted_score in enumerate(view_sel):
             f.write('%d\n%d ' % (i, len(sorted_score)))
             for image_id, s in sorted_score:
                 f.write('%d %f ' % (image_id, s))
             f.write('\n')
-    for i in range(num_images):
-        if args.convert_format:
-            img = cv2.imread(os.path.join(image_dir, images[i + 1].name))
-            cv2.imwrite(os.path.join(renamed_dir, '%08d.jpg' % i), img)
-        else:
-            if not os.path.exists(renamed_dir):
-                os.makedirs(renamed_dir)
-                shutil.copyfile(os.path.join(image_dir, images[i + 1].name), os.path.join(renamed_dir, '%08d.jpg' % i))
-            else:
-                shutil.copyfile(os.path.join(image_dir, images[i + 1].name), os.path.join(renamed_dir, '%08d.jpg' % i))
+    with open(os.path.join(args.folder, 'changed_views.txt'), 'w') as f:
+        f.write('%d\n' % len(changed_views))
+        for i in sorted(changed_views):
+            f.write('%d\n' % i)
+    if args.incremental:
+        save_state(state_path, state_params, images.names, fingerprints, depth_min, depth_interval, score, candidates,
+                   view_sel)
+
+    counts = export_images([os.path.join(image_dir, name) for name in images.names], renamed_dir,
+                           args.convert_format, args.link, args.workers, args.export_hash)
+    print('images', dict(counts))
@@ -6,3 +6,10 @@ def find_dataset_def(dataset_name):
     module_name = 'datasets.{}'.format(dataset_name)
     module = importlib.import_module(module_name)
     return getattr(module, "MVSDataset")
+
+
+# find the depth hypotheses of a dataset by name, for example depth_hypotheses of dtu_yao.py
+def find_depth_hypotheses(dataset_name):
+    module_name = 'datasets.{}'.format(dataset_name)
+    module = importlib.import_module(module_name)
+    return getattr(module, "depth_hypotheses")
@@ -0,0 +1,39 @@
+from torch.utils.data import Sampler
+
+
+def sample_bytes(shape):
+    """ rough memory of a sample of shape (views, height, width, depths): its float32 images and one float32
+    volume of its depth hypotheses at the image size """
+    views, height, width, depths = shape
+    return 4 * height * width * (3 * views + depths)
+
+
+class BucketBatchSampler(Sampler):
+    """ batch sampler grouping the samples of a dataset by dataset.sample_shape(idx)
+
+    Only samples of the same shape are batched, as many as fit in max_bytes (at least one), so the eval datasets with
+    adaptive scaling can be run with batches larger than one. Batches are yielded in the order of their first sample.
+    """
+
+    def __init__(self, dataset, max_bytes, max_batch_size=None, indices=None):
+        if not hasattr(dataset, 'sample_shape'):
+            raise ValueError('{} does not give the shape of its samples'.format(type(dataset).__module__))
+        if indices is None:
+            indices = range(len(dataset))
+        buckets = {}
+        for idx in indices:
+            buckets.setdefault(dataset.sample_shape(idx), []).append(idx)
+        self.batches = []
+        for shape, bucket in buckets.items():
+            batch_size = max(int(max_bytes // sample_bytes(shape)), 1)
+            if max_batch_size is not None:
+                batch_size = min(batch_size, max_batch_size)
+            self.batches += [bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size)]
+        self.batches.sort(key=lambda batch: batch[0])
+        self.shapes = sorted(buckets, key=lambda shape: buckets[shape][0])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
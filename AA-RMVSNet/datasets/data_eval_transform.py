@@ -1,17 +1,18 @@
 from torch.utils.data import Dataset
 import numpy as np
 import os
-from PIL import Image
 from datasets.data_io import *
 
 from datasets.preprocess import *
+from datasets.image_cache import SharedImageCache
 
 
 # Test any dataset with scale and center crop
 
 class MVSDataset(Dataset):
     def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True,
-                 adaptive_scaling=True, max_h=1200, max_w=1600, sample_scale=1, base_image_size=8, **kwargs):
+                 adaptive_scaling=True, max_h=1200, max_w=1600, sample_scale=1, base_image_size=8, image_cache_bytes=0,
+                 **kwargs):
         super(MVSDataset, self).__init__()
 
         self.datapath = datapath
@@ -30,6 +31,13 @@ class MVSDataset(Dataset):
 
         assert self.mode == "test"
         self.metas = self.build_list()
+        self.cam_tables = build_cam_tables(self.datapath, self.metas, self.read_cam_file, self.ndepths,
+                                           self.inverse_depth, self.adaptive_scaling, self.max_h, self.max_w,
+                                           self.base_image_size)
+        # scaled and cropped float32 images shared by the DataLoader workers, keyed by (scan, view, scale)
+        self.image_cache = None
+        if image_cache_bytes > 0:
+            self.image_cache = SharedImageCache(image_cache_bytes, self.max_h * self.max_w * 3 * 4)
         print('Data Loader : data_eval_transform **************')
 
     def build_list(self):
@@ -55,36 +63,23 @@ class MVSDataset(Dataset):
     def __len__(self):
         return len(self.metas)
 
+    def sample_shape(self, idx):
+        scan, ref_view, src_views = self.metas[idx]
+        return cam_table_sample_shape(self.cam_tables[scan], [ref_view] + src_views[:self.nviews - 1], self.max_h,
+                                      self.max_w, self.base_image_size)
+
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
 
         # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
+        depth_min = depth_params[0]
+        depth_interval = depth_params[1] * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval
 
-    def read_img(self, filename):
-        img = Image.open(filename)
-
-        mat = np.array(img, dtype=np.float32)
-
-        return self.center_img(mat)
-
-    def center_img(self, img):  # this is very important for batch normalization
-        img = img.astype(np.float32)
-        var = np.var(img, axis=(0, 1), keepdims=True)
-        mean = np.mean(img, axis=(0, 1), keepdims=True)
-        return (img - mean) / (np.sqrt(var))
-
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return np.array(read_pfm_mmap(filename)[0], dtype=np.float32)
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -96,76 +91,32 @@ class MVSDataset(Dataset):
         # use only the reference view and first nviews-1 source views
         view_ids = [ref_view] + src_views[:self.nviews - 1]
 
-        imgs = []
-        mask = None
-        depth = None
-        depth_values = None
-        proj_matrices = []
-        cams = []
-        extrinsics_list = []
-
-        for i, vid in enumerate(view_ids):
-            img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
-            proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
-
-            imgs.append(self.read_img(img_filename))
-            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
-            cams.append(intrinsics)
-            # multiply intrinsics and extrinsics to get projection matrix
-            extrinsics_list.append(extrinsics)
-
-            if i == 0:  # reference view
-                if self.inverse_depth:  # slice inverse depth
-                    print('Process {} inverse depth'.format(idx))
-                    depth_end = depth_interval * (self.ndepths - 1) + depth_min  # wether depth_end is this
-                    depth_values = np.linspace(1.0 / depth_min, 0.0, self.ndepths, endpoint=False)
-                    depth_values = 1.0 / depth_values
-                    depth_values = depth_values.astype(np.float32)
-                else:
-                    depth_values = np.arange(depth_min, depth_interval * self.ndepths + depth_min, depth_interval,
-                                             dtype=np.float32)
-
-                    depth_end = depth_interval * self.ndepths + depth_min
-
-        imgs = np.stack(imgs).transpose([0, 3, 1, 2])  # B,C,H,W
-
-        ##TO DO determine a proper scale to resize input
-        resize_scale = 1
-        if self.adaptive_scaling:
-            h_scale = 0
-            w_scale = 0
-            for view in range(self.nviews):
-                height_scale = float(self.max_h) / imgs[view].shape[1]
-                width_scale = float(self.max_w) / imgs[view].shape[2]
-                if height_scale > h_scale:
-                    h_scale = height_scale
-                if width_scale > w_scale:
-                    w_scale = width_scale
-            if h_scale > 1 or w_scale > 1:
-                print("max_h, max_w should < W and H!")
-                exit(-1)
-            resize_scale = h_scale
-            if w_scale > h_scale:
-                resize_scale = w_scale
-
-        imgs = imgs.transpose(0, 2, 3, 1)
-
-        scaled_input_imgs, scaled_input_cams = scale_mvs_input(imgs, cams, scale=resize_scale, view_num=self.nviews)
+        cam_table = self.cam_tables[scan]
+        rows = [cam_table['rows'][vid] for vid in view_ids]
 
-        # TO DO crop to fit network
-        croped_imgs, croped_cams = crop_mvs_input(scaled_input_imgs, scaled_input_cams, view_num=self.nviews,
-                                                  max_h=self.max_h, max_w=self.max_w,
-                                                  base_image_size=self.base_image_size)
+        if self.inverse_depth:
+            print('Process {} inverse depth'.format(idx))
+        depth_values = cam_table['depth_values'][rows[0]].copy()
 
-        croped_imgs = croped_imgs.transpose(0, 3, 1, 2)
+        # the views are scaled together by the largest resize scale, the projection matrices of build_cam_tables only
+        # match the images if the views share one size
+        image_sizes = cam_table['image_sizes'][rows]
+        assert (image_sizes == image_sizes[0]).all(), \
+            'views {} of scan {} differ in image size: {}'.format(view_ids, scan, image_sizes.tolist())
+        resize_scale = float(cam_table['resize_scales'][rows].max())
+        if resize_scale > 1:
+            print("max_h, max_w should < W and H!")
+            exit(-1)
 
-        new_proj_matrices = []
-        for id in range(self.nviews):
-            proj_mat = extrinsics_list[id]
-            proj_mat[:3, :4] = np.matmul(croped_cams[id], proj_mat[:3, :4])
-            new_proj_matrices.append(proj_mat)
+        # TO DO crop to fit network
+        croped_imgs = read_scaled_images(os.path.join(self.datapath, '{}/images/{:0>8}.jpg'), scan, view_ids,
+                                         resize_scale, self.image_cache, max_h=self.max_h, max_w=self.max_w,
+                                         base_image_size=self.base_image_size)
+        croped_imgs = np.stack(croped_imgs).transpose(0, 3, 1, 2)
 
-        new_proj_matrices = np.stack(new_proj_matrices)
+        new_proj_matrices = cam_table['proj_matrices'][rows]
 
         return {"imgs": croped_imgs, "proj_matrices": new_proj_matrices, "depth_values": depth_values,
-                "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
+                "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}",
+                # the image of a view only depends on these, samples sharing a view can share its features
+                "view_keys": ['{}/{:0>8}/{}'.format(scan, vid, resize_scale) for vid in view_ids]}
@@ -5,13 +5,15 @@ from PIL import Image
 from datasets.data_io import *
 
 from datasets.preprocess import *
+from datasets.image_cache import SharedImageCache
 
 
 # Test any dataset with scale and center crop
 
 class MVSDataset(Dataset):
     def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=True,
-                 adaptive_scaling=True, max_h=1200, max_w=1600, sample_scale=1, base_image_size=8, **kwargs):
+                 adaptive_scaling=True, max_h=1200, max_w=1600, sample_scale=1, base_image_size=8, image_cache_bytes=0,
+                 **kwargs):
         super(MVSDataset, self).__init__()
 
         self.datapath = datapath
@@ -30,6 +32,10 @@ class MVSDataset(Dataset):
 
         assert self.mode == "test"
         self.metas = self.build_list()
+        # scaled and cropped float32 images shared by the DataLoader workers, keyed by (scan, view, scale)
+        self.image_cache = None
+        if image_cache_bytes > 0:
+            self.image_cache = SharedImageCache(image_cache_bytes, self.max_h * self.max_w * 3 * 4)
         print('Data Loader : data_eval_transform_large **************')
 
     def build_list(self):
@@ -56,19 +62,14 @@ class MVSDataset(Dataset):
         return len(self.metas)
 
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # TODO Scale
         # intrinsics[:2, :] /= 4
         # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
-        depth_end = float(lines[11].split()[3])
+        depth_min = depth_params[0]
+        depth_interval = depth_params[1] * self.interval_scale
+        depth_end = depth_params[3]
         return intrinsics, extrinsics, depth_min, depth_interval, depth_end
 
     def read_img(self, filename):
@@ -81,9 +82,15 @@ class MVSDataset(Dataset):
         mean = np.mean(img, axis=(0, 1), keepdims=True)
         return (img - mean) / (np.sqrt(var))
 
+    def read_img_size(self, filename):
+        # only the image header is read
+        with Image.open(filename) as img:
+            w, h = img.size
+        return h, w
+
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return np.array(read_pfm_mmap(filename)[0], dtype=np.float32)
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -95,7 +102,7 @@ class MVSDataset(Dataset):
         # use only the reference view and first nviews-1 source views
         view_ids = [ref_view] + src_views[:self.nviews - 1]
 
-        imgs = []
+        image_sizes = []
         mask = None
         depth = None
         depth_values = None
@@ -107,7 +114,7 @@ class MVSDataset(Dataset):
             img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
             proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
 
-            imgs.append(self.read_img(img_filename))
+            image_sizes.append(self.read_img_size(img_filename))
             intrinsics, extrinsics, depth_min, depth_interval, depth_end_ori = self.read_cam_file(proj_mat_filename)
             cams.append(intrinsics)
             # multiply intrinsics and extrinsics to get projection matrix
@@ -131,7 +138,6 @@ class MVSDataset(Dataset):
                                              dtype=np.float32)  # the set is [)
                     depth_end = depth_interval * self.ndepths + depth_min  # depth_values = np.arange(depth_min, depth_interval * (self.ndepths - 0.5) + depth_min, depth_interval,  #                          dtype=np.float32)
 
-        imgs = np.stack(imgs).transpose([0, 3, 1, 2])  # B,C,H,W
         # proj_matrices = np.stack(proj_matrices)
 
         ##TO DO determine a proper scale to resize input
@@ -140,8 +146,8 @@ class MVSDataset(Dataset):
             h_scale = 0
             w_scale = 0
             for view in range(self.nviews):
-                height_scale = float(self.max_h) / imgs[view].shape[1]
-                width_scale = float(self.max_w) / imgs[view].shape[2]
+                height_scale = float(self.max_h) / image_sizes[view][0]
+                width_scale = float(self.max_w) / image_sizes[view][1]
                 if height_scale > h_scale:
                     h_scale = height_scale
                 if width_scale > w_scale:
@@ -153,23 +159,20 @@ class MVSDataset(Dataset):
             if w_scale > h_scale:
                 resize_scale = w_scale
 
-        imgs = imgs.transpose(0, 2, 3, 1)
-
-        scaled_input_imgs, scaled_input_cams = scale_mvs_input(imgs, cams, scale=resize_scale, view_num=self.nviews)
-
         # TO DO crop to fit network
-        croped_imgs, croped_cams = crop_mvs_input(scaled_input_imgs, scaled_input_cams, view_num=self.nviews,
-                                                  max_h=self.max_h, max_w=self.max_w,
-                                                  base_image_size=self.base_image_size)
+        croped_imgs = read_scaled_images(os.path.join(self.datapath, '{}/images/{:0>8}.jpg'), scan, view_ids,
+                                         resize_scale, self.image_cache, max_h=self.max_h, max_w=self.max_w,
+                                         base_image_size=self.base_image_size)
 
-        croped_imgs = croped_imgs.transpose(0, 3, 1, 2)
+        croped_imgs = np.stack(croped_imgs).transpose(0, 3, 1, 2)
 
         new_proj_matrices = []
         for id in range(self.nviews):
             proj_mat = extrinsics_list[id]  # .copy()
             # Down Scale
             # croped_cams[id][:2,:] /= 4
-            proj_mat[:3, :4] = np.matmul(croped_cams[id], proj_mat[:3, :4])
+            proj_mat = scale_crop_proj_matrix(cams[id], proj_mat, image_sizes[id], scale=resize_scale, max_h=self.max_h,
+                                              max_w=self.max_w, base_image_size=self.base_image_size)
             new_proj_matrices.append(proj_mat)
 
         new_proj_matrices = np.stack(new_proj_matrices)
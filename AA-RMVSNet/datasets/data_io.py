@@ -1,8 +1,10 @@
+import json
 import numpy as np
+import os
 import re
 import sys
-import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple
 
 import cv2
@@ -10,9 +12,15 @@ import cv2
 from PIL import Image
 
 
-def read_pfm(filename):
-    file = open(filename, 'rb')
+def read_pfm_header(file) -> Tuple[tuple, str, float]:
+    """Read the header of a PFM file opened in binary mode, leaving the file at the start of the payload
+
+    Args:
+        file: open PFM file
 
+    Returns:
+        Tuple with the map shape (HxW or HxWx3), the dtype of the payload and the scale
+    """
     header = file.readline().decode('utf-8').rstrip()
     if header == 'PF':
         color = True
@@ -34,8 +42,15 @@ def read_pfm(filename):
     else:
         endian = '>'  # big-endian
 
-    data = np.fromfile(file, endian + 'f')
     shape = (height, width, 3) if color else (height, width)
+    return shape, endian + 'f', scale
+
+
+def read_pfm(filename):
+    file = open(filename, 'rb')
+    shape, dtype, scale = read_pfm_header(file)
+
+    data = np.fromfile(file, dtype)
 
     data = np.reshape(data, shape)
     data = np.flipud(data)
@@ -43,6 +58,39 @@ def read_pfm(filename):
     return data, scale
 
 
+def read_pfm_mmap(filename: str, roi=None) -> Tuple[np.ndarray, float]:
+    """Read a PFM file like read_pfm, but memory-map the payload and return a flipped view of it instead of a copy
+
+    Args:
+        filename: pfm file path string
+        roi: optional region (top, bottom, left, right) of the map; only this region is read, into a new array
+
+    Returns:
+        Tuple with the map (a copy-on-write view of the file, or the region) and the scale
+    """
+    with open(filename, 'rb') as file:
+        shape, dtype, scale = read_pfm_header(file)
+        offset = file.tell()
+    data = np.flipud(np.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)).view(np.ndarray)
+    if roi is not None:
+        top, bottom, left, right = roi
+        data = np.array(data[top:bottom, left:right])
+    return data, scale
+
+
+def read_pfm_batch(filenames: List[str], roi=None) -> List[np.ndarray]:
+    """Read the maps of several PFM files, e.g. of the source views of a reference view, with read_pfm_mmap
+
+    Args:
+        filenames: pfm file path strings
+        roi: optional region (top, bottom, left, right) read from every map
+
+    Returns:
+        List of maps, without the scales
+    """
+    return [read_pfm_mmap(filename, roi)[0] for filename in filenames]
+
+
 def save_pfm(filename, image, scale=1):
     file = open(filename, "wb")
 
@@ -109,6 +157,57 @@ def read_image(filename: str, max_dim: int = -1) -> Tuple[np.ndarray, int, int]:
     return scale_to_max_dim(np_image, max_dim)
 
 
+def read_image_size(filename: str) -> Tuple[int, int]:
+    """Read the size of an image from its header, without decoding it
+
+    Args:
+        filename: image input file path string
+
+    Returns:
+        Tuple of image height and width
+    """
+    with Image.open(filename) as image:
+        width, height = image.size
+    return height, width
+
+
+def read_image_draft(filename: str, scale: float = 1, size: Tuple[int, int] = None, pad_h: int = 0) -> np.ndarray:
+    """Read an image resized by scale, decoding JPEGs directly at 1/2, 1/4 or 1/8 resolution (PIL draft mode)
+
+    The image is decoded at the smallest DCT reduction that is still at least as large as the output and resized to the
+    exact output size with cv2 linear interpolation, so the output has the same size as cv2.resize of the full image
+    with fx=fy=scale and the cameras are scaled exactly as before.
+
+    Args:
+        filename: image input file path string
+        scale: resize scale of the full resolution image
+        size: output height and width, instead of the size given by scale
+        pad_h: number of rows of zeros added at the top and the bottom of the full resolution image before resizing
+
+    Returns:
+        The resized uint8 image
+    """
+    with Image.open(filename) as image:
+        width, height = image.size
+        if size is None:
+            size = int(round((height + 2 * pad_h) * scale)), int(round(width * scale))
+        # the padding must stay a whole number of rows at the reduced resolution
+        reduction = 8
+        while reduction > 1 and ((height + 2 * pad_h) // reduction < size[0] or width // reduction < size[1]
+                                 or pad_h % reduction):
+            reduction //= 2
+        if reduction > 1:
+            # no-op for other formats than JPEG
+            image.draft(image.mode, (width // reduction, height // reduction))
+        np_image = np.array(image)
+    if pad_h > 0:
+        pad_rows = pad_h * np_image.shape[0] // height
+        np_image = np.pad(np_image, [(pad_rows, pad_rows)] + [(0, 0)] * (np_image.ndim - 1))
+    if np_image.shape[:2] != tuple(size):
+        np_image = cv2.resize(np_image, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+    return np_image
+
+
 def save_image(filename: str, image: np.ndarray) -> None:
     """Save images including binary mask (bool), float (0<= val <= 1), or int (as-is)
 
@@ -154,16 +253,201 @@ def read_cam_file(filename, interval_scale):
     Returns:
         Tuple with intrinsics matrix (3x3), extrinsics matrix (4x4), and depth params vector (min and max) if exists
     """
+    intrinsics, extrinsics, depth_params = read_cam_params(filename)
+    # depth min & depth_interval: line 11
+    depth_min = depth_params[0]
+    depth_interval = depth_params[1] * interval_scale
+    return intrinsics, extrinsics, depth_min, depth_interval
+
+
+CAM_BUNDLE_FILE = 'cams.npy'
+# one record per view of a scan; depth holds the values of the depth line of the cam file, NaN padded
+CAM_BUNDLE_DTYPE = np.dtype([('view', '<i8'), ('extrinsics', '<f4', (4, 4)), ('intrinsics', '<f4', (3, 3)),
+                             ('depth', '<f8', (4,))])
+_cam_bundles = {}
+
+
+def read_cam_text(filename: str) -> Tuple[np.ndarray, np.ndarray, List[float]]:
+    """Read camera intrinsics, extrinsics and the values of the depth line from a cam text file
+
+    Args:
+        filename: cam text file path string
+
+    Returns:
+        Tuple with intrinsics matrix (3x3), extrinsics matrix (4x4) and depth params (depth_min, depth_interval, ...)
+    """
     with open(filename) as f:
         lines = [line.rstrip() for line in f.readlines()]
     # extrinsics: line [1,5), 4x4 matrix
     extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
     # intrinsics: line [7-10), 3x3 matrix
     intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
-    # depth min & depth_interval: line 11
-    depth_min = float(lines[11].split()[0])
-    depth_interval = float(lines[11].split()[1]) * interval_scale
-    return intrinsics, extrinsics, depth_min, depth_interval
+    # depth min & depth_interval (& depth num & depth max): line 11
+    depth_params = [float(x) for x in lines[11].split()]
+    return intrinsics, extrinsics, depth_params
+
+
+def write_cam_bundle(cam_dir: str, views, extrinsics: np.ndarray, intrinsics: np.ndarray, depth_params) -> None:
+    """Write the cameras of a scan as one fixed layout record array, cam_dir/cams.npy
+
+    Args:
+        cam_dir: directory of the <view:08d>_cam.txt files
+        views: view id of every camera
+        extrinsics: extrinsics matrices (Nx4x4)
+        intrinsics: intrinsics matrices (Nx3x3)
+        depth_params: values of the depth line of every camera, at most 4 each
+    """
+    bundle = np.zeros(len(views), dtype=CAM_BUNDLE_DTYPE)
+    bundle['view'] = views
+    bundle['extrinsics'] = extrinsics
+    bundle['intrinsics'] = intrinsics
+    bundle['depth'] = np.nan
+    for record, params in zip(bundle, depth_params):
+        record['depth'][:len(params)] = params[:4]
+    path = os.path.join(cam_dir, CAM_BUNDLE_FILE)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, bundle)
+    os.replace(path + '.tmp', path)
+    _cam_bundles.pop(cam_dir, None)
+
+
+def build_cam_bundle(cam_dir: str) -> int:
+    """Pack the <view:08d>_cam.txt files of a directory into cam_dir/cams.npy
+
+    Args:
+        cam_dir: directory of the cam text files
+
+    Returns:
+        Number of packed cameras
+    """
+    names = sorted(name for name in os.listdir(cam_dir) if name.endswith('_cam.txt') and name.split('_')[0].isdigit())
+    cams = [read_cam_text(os.path.join(cam_dir, name)) for name in names]
+    write_cam_bundle(cam_dir, [int(name.split('_')[0]) for name in names], [cam[1] for cam in cams],
+                     [cam[0] for cam in cams], [cam[2] for cam in cams])
+    return len(cams)
+
+
+def read_cam_bundle(cam_dir: str):
+    """Memory-map the camera bundle of a directory, once per process
+
+    Args:
+        cam_dir: directory of the cam files
+
+    Returns:
+        Tuple with the bundle records and a dictionary of view id to record index, or None if there is no bundle
+    """
+    if cam_dir not in _cam_bundles:
+        path = os.path.join(cam_dir, CAM_BUNDLE_FILE)
+        if os.path.exists(path):
+            bundle = np.load(path, mmap_mode='r')
+            _cam_bundles[cam_dir] = (bundle, {int(view): i for i, view in enumerate(bundle['view'])})
+        else:
+            _cam_bundles[cam_dir] = None
+    return _cam_bundles[cam_dir]
+
+
+def read_cam_params(filename: str) -> Tuple[np.ndarray, np.ndarray, List[float]]:
+    """Read a camera from the bundle of its directory (see write_cam_bundle), or from the text file if the directory
+    has no bundle or the view is not in it
+
+    Args:
+        filename: cam text file path string, <cam_dir>/<view:08d>_cam.txt
+
+    Returns:
+        Tuple with intrinsics matrix (3x3), extrinsics matrix (4x4) and depth params (depth_min, depth_interval, ...)
+    """
+    cam_dir, name = os.path.split(filename)
+    bundle = read_cam_bundle(cam_dir)
+    view = name.split('_')[0]
+    if bundle is not None and view.isdigit() and int(view) in bundle[1]:
+        record = bundle[0][bundle[1][int(view)]]
+        depth = record['depth']
+        return np.array(record['intrinsics']), np.array(record['extrinsics']), \
+            [float(d) for d in depth[~np.isnan(depth)]]
+    return read_cam_text(filename)
+
+
+# a packed scan is one raw file <scan>.bin of fixed layout arrays, described by the index <scan>.json
+PACK_ALIGN = 64
+_packed_scans = {}
+
+
+def create_packed_scan(pack_dir: str, scan: str, layout: Dict[str, Tuple[tuple, str]]) -> Dict[str, np.ndarray]:
+    """Create the raw file of a packed scan and map its arrays for writing, see commit_packed_scan
+
+    Args:
+        pack_dir: output directory
+        scan: scan name
+        layout: shape and dtype of every array
+
+    Returns:
+        Dictionary of writable memory-mapped arrays
+    """
+    offset = 0
+    arrays = {}
+    for name, (shape, dtype) in layout.items():
+        offset = -(-offset // PACK_ALIGN) * PACK_ALIGN
+        arrays[name] = (offset, tuple(shape), np.dtype(dtype))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    path = os.path.join(pack_dir, scan + '.bin.tmp')
+    with open(path, 'wb') as f:
+        f.truncate(offset)
+    return {name: np.memmap(path, dtype=dtype, mode='r+', offset=start, shape=shape)
+            for name, (start, shape, dtype) in arrays.items()}
+
+
+def commit_packed_scan(pack_dir: str, scan: str, arrays: Dict[str, np.ndarray], meta: dict) -> None:
+    """Flush the arrays of create_packed_scan, move the raw file in place and write the index of the scan
+
+    Args:
+        pack_dir: output directory
+        scan: scan name
+        arrays: arrays returned by create_packed_scan
+        meta: JSON serializable scan description, stored in the index next to the array layout
+    """
+    index = dict(meta)
+    index['arrays'] = {}
+    for name, array in arrays.items():
+        array.flush()
+        index['arrays'][name] = {'offset': array.offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+    path = os.path.join(pack_dir, scan)
+    os.replace(path + '.bin.tmp', path + '.bin')
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def read_packed_index(pack_dir: str, scan: str) -> dict:
+    """Read the index of a packed scan
+
+    Args:
+        pack_dir: directory of the packed scans
+        scan: scan name
+
+    Returns:
+        Scan description with the array layout under 'arrays'
+    """
+    with open(os.path.join(pack_dir, scan + '.json')) as f:
+        return json.load(f)
+
+
+def read_packed_scan(pack_dir: str, scan: str) -> Dict[str, np.ndarray]:
+    """Memory-map the arrays of a packed scan read-only, once per process
+
+    Args:
+        pack_dir: directory of the packed scans
+        scan: scan name
+
+    Returns:
+        Dictionary of arrays
+    """
+    key = (pack_dir, scan)
+    if key not in _packed_scans:
+        path = os.path.join(pack_dir, scan + '.bin')
+        _packed_scans[key] = {name: np.memmap(path, dtype=np.dtype(array['dtype']), mode='r', offset=array['offset'],
+                                              shape=tuple(array['shape']))
+                              for name, array in read_packed_index(pack_dir, scan)['arrays'].items()}
+    return _packed_scans[key]
 
 
 def read_pair_file(filename: str) -> List[Tuple[int, List[int]]]:
@@ -232,18 +516,18 @@ def read_bin(path: str) -> np.ndarray:
         data: array of shape (H, W, C) representing loaded depth map
     """
     with open(path, 'rb') as fid:
-        width, height, channels = np.genfromtxt(fid, delimiter='&', max_rows=1,
-                                                usecols=(0, 1, 2), dtype=int)
-        fid.seek(0)
-        num_delimiter = 0
-        byte = fid.read(1)
-        while True:
-            if byte == b'&':
-                num_delimiter += 1
-                if num_delimiter >= 3:
-                    break
-            byte = fid.read(1)
+        # header: width&height&channels&
+        header = b''
+        while header.count(b'&') < 3:
+            chunk = fid.read(64)
+            if not chunk:
+                raise Exception('Malformed bin header.')
+            header += chunk
+        fields = header.split(b'&', 3)
+        width, height, channels = (int(x) for x in fields[:3])
+        fid.seek(len(header) - len(fields[3]))
         data = np.fromfile(fid, np.float32)
+    # the payload is column major (width, height, channels)
     data = data.reshape((width, height, channels), order='F')
     data = np.transpose(data, (1, 0, 2))
     return data
@@ -267,18 +551,42 @@ def save_bin(filename: str, data: np.ndarray):
     else:
         raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
 
-    with open(filename, 'w') as fid:
-        fid.write(str(width) + '&' + str(height) + '&' + str(channels) + '&')
+    with open(filename, 'wb') as fid:
+        fid.write((str(width) + '&' + str(height) + '&' + str(channels) + '&').encode())
+        # column major (width, height, channels) is row major (channels, height, width)
+        payload = data.reshape((height, width, channels)).transpose((2, 0, 1))
+        np.ascontiguousarray(payload, dtype='<f4').tofile(fid)
+
+
+def read_bin_batch(paths: List[str], workers: int = 4) -> List[np.ndarray]:
+    """Read the depth maps of several Colmap .bin files, e.g. of a whole scan, with a thread pool
+
+    Args:
+        paths: .bin file path strings
+        workers: number of reading threads
+
+    Returns:
+        List of arrays of shape (H, W, C), in the order of paths
+    """
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        return list(pool.map(read_bin, paths))
+
+
+def save_bin_batch(filenames: List[str], data: List[np.ndarray], workers: int = 4) -> None:
+    """Save several depth maps, e.g. of a whole scan, to Colmap .bin files with a thread pool
+
+    Args:
+        filenames: output .bin file path strings
+        data: depth maps to save, each of shape (H,W) or (H,W,C)
+        workers: number of writing threads
+    """
+    if len(filenames) != len(data):
+        raise Exception('One file name per depth map is required.')
+    with ThreadPoolExecutor(max(workers, 1)) as pool:
+        list(pool.map(save_bin, filenames, data))
 
-    with open(filename, 'ab') as fid:
-        if len(data.shape) == 2:
-            image_trans = np.transpose(data, (1, 0))
-        else:
-            image_trans = np.transpose(data, (1, 0, 2))
-        data_1d = image_trans.reshape(-1, order='F')
-        data_list = data_1d.tolist()
-        endian_character = '<'
-        format_char_sequence = ''.join(['f'] * len(data_list))
-        byte_data = struct.pack(endian_character + format_char_sequence, *data_list)
-        fid.write(byte_data)
 
+if __name__ == '__main__':
+    # pack existing cam text files into camera bundles: python datasets/data_io.py <cam_dir> [<cam_dir> ...]
+    for cam_dir in sys.argv[1:]:
+        print(cam_dir, build_cam_bundle(cam_dir), 'cameras')
@@ -3,6 +3,25 @@ import numpy as np
 import os
 from PIL import Image
 from .data_io import *
+from .preprocess import center_images
+
+
+def depth_hypotheses(depth_min, depth_interval, ndepths, inverse_depth=False, fix_range=False):
+    # depth values of the reference view and the end of its depth range
+    if not fix_range:
+        depth_end = depth_interval * (ndepths - 1) + depth_min  # sample: 0:n-1
+    else:
+        depth_end = 935  # pre-defined in DTU dataset
+    if inverse_depth:  # slice inverse depth
+        depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, ndepths)
+        depth_values = 1.0 / depth_values
+        depth_values = depth_values.astype(np.float32)
+    else:
+        depth_values = np.linspace(depth_min, depth_end, ndepths)
+        depth_values = depth_values.astype(np.float32)
+
+        # depth_values = np.concatenate((depth_values,depth_values[::-1]),axis=0)
+    return depth_values, depth_end
 
 
 # the DTU dataset preprocessed by Yao Yao (only for training)
@@ -62,29 +81,28 @@ class MVSDataset(Dataset):
         return len(self.metas)
 
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # depth_min & depth_interval: line 11
         if self.image_scale == 0.5:  # origin: 0.25
             intrinsics[:2, :] *= 2
         elif self.image_scale == 1.0:
             intrinsics[:2, :] *= 4
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
+        depth_min = depth_params[0]
+        depth_interval = depth_params[1] * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval
 
     def read_img(self, filename):
+        # scale 0~255 to 0~1
+        return self.center_img(self.load_img(filename))
+
+    def load_img(self, filename):
+        # the resized uint8 image, as stored by pack_dataset.py
         img = Image.open(filename)
         if self.image_scale != 1.0:
             w, h = img.size
             img = img.resize((int(self.image_scale * w), int(self.image_scale * h)))  # origin: 0.25
-        # scale 0~255 to 0~1
-        return self.center_img(np.array(img, dtype=np.float32))
+        return np.array(img)
 
     def center_img(self, img):  # this is very important for batch normalization
         img = img.astype(np.float32)
@@ -94,7 +112,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return np.array(read_pfm_mmap(filename)[0], dtype=np.float32)
 
     def __getitem__(self, idx):
         meta = self.metas[idx]
@@ -126,7 +144,7 @@ class MVSDataset(Dataset):
             proj_mat_filename = os.path.join(self.datapath, 'Cameras/train/{:0>8}_cam.txt').format(vid)
             if i == 0:
                 depth_name = depth_filename
-            imgs.append(self.read_img(img_filename))
+            imgs.append(self.load_img(img_filename))
             intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
 
             # multiply intrinsics and extrinsics to get projection matrix
@@ -135,26 +153,17 @@ class MVSDataset(Dataset):
             proj_matrices.append(proj_mat)
 
             if i == 0:  # reference view
-                if not self.fix_range:
-                    depth_end = depth_interval * (self.ndepths - 1) + depth_min  # sample: 0:n-1
-                else:
-                    depth_end = 935  # pre-defined in DTU dataset
-                if self.inverse_depth:  # slice inverse depth
+                if self.inverse_depth:
                     print('inverse depth')
-                    depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, self.ndepths)
-                    depth_values = 1.0 / depth_values
-                    depth_values = depth_values.astype(np.float32)
-                else:
-                    depth_values = np.linspace(depth_min, depth_end, self.ndepths)
-                    depth_values = depth_values.astype(np.float32)
-
-                    # depth_values = np.concatenate((depth_values,depth_values[::-1]),axis=0)
+                depth_values, depth_end = depth_hypotheses(depth_min, depth_interval, self.ndepths, self.inverse_depth,
+                                                           self.fix_range)
 
                 # mask = self.read_img(mask_filename)
                 depth = self.read_depth(depth_filename)
                 # mask = np.array((depth > depth_min+depth_interval) & (depth < depth_min+(self.ndepths-2)*depth_interval), dtype=np.float32)
                 mask = np.array((depth >= depth_min) & (depth <= depth_end), dtype=np.float32)
-        imgs = np.stack(imgs).transpose([0, 3, 1, 2])
+        # normalize all views in one pass
+        imgs = center_images(np.stack(imgs), eps=0.00000001).transpose([0, 3, 1, 2])
         proj_matrices = np.stack(proj_matrices)
 
         if (flip_flag and self.both) or (self.reverse and not self.both):
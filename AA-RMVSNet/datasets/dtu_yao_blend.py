@@ -6,6 +6,22 @@ from .data_io import *
 from .preprocess import *
 
 
+def depth_hypotheses(depth_min, depth_interval, ndepths, inverse_depth=False, fix_range=False):
+    # depth values of a reference view and the end of its depth range, fix_range only applies to DTU
+    if inverse_depth:  # slice inverse depth
+        # Origin version: depth_interval * n-1 + depth_min as the last clos
+        depth_end = depth_interval * (ndepths - 1) + depth_min
+        depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, ndepths, endpoint=False)
+        depth_values = 1.0 / depth_values
+        depth_values = depth_values.astype(np.float32)
+    else:
+        depth_values = np.arange(depth_min, depth_interval * (ndepths - 0.5) + depth_min,
+                                 depth_interval, dtype=np.float32)  # the set is [)
+        depth_values = np.concatenate((depth_values, depth_values[::-1]), axis=0)
+        depth_end = depth_interval * (ndepths - 1) + depth_min
+    return depth_values, depth_end
+
+
 # the DTU dataset preprocessed by Yao Yao (only for training)
 class MVSDataset(Dataset):
     def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=False,
@@ -28,6 +44,7 @@ class MVSDataset(Dataset):
 
         assert self.mode in ["train", "val", "test"]
         self.metas = self.build_list()
+        self.build_cam_tables()
 
     def build_list(self):
         metas = []
@@ -54,34 +71,64 @@ class MVSDataset(Dataset):
         print("dataset", self.mode, "metas:", len(metas))
         return metas
 
+    def build_cam_tables(self):
+        # read the cameras of every scan once: per view, the projection matrix, the depth hypotheses when it is the
+        # reference view and its depth range; the arrays are read-only and shared by the DataLoader workers
+        self.cam_tables = {}
+        scan_views = {}
+        for scan, ref_view, src_views, _ in self.metas:
+            scan_views.setdefault(scan, set()).update([ref_view] + src_views[:self.nviews - 1])
+        for scan, views in scan_views.items():
+            views = sorted(views)
+            proj_matrices, depth_values, depth_ranges = [], [], []
+            for vid in views:
+                proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
+                intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
+
+                # multiply intrinsics and extrinsics to get projection matrix
+                proj_mat = extrinsics.copy()
+                proj_mat[:3, :4] = np.matmul(intrinsics, proj_mat[:3, :4])
+                proj_matrices.append(proj_mat)
+
+                values, depth_end = depth_hypotheses(depth_min, depth_interval, self.ndepths, self.inverse_depth)
+                depth_values.append(values)
+                depth_ranges.append((depth_min, depth_interval, depth_end))
+
+            cam_table = {'proj_matrices': np.stack(proj_matrices)}
+            for array in list(cam_table.values()) + depth_values:
+                array.setflags(write=False)
+            cam_table['depth_values'] = depth_values
+            cam_table['depth_ranges'] = depth_ranges
+            cam_table['rows'] = {vid: i for i, vid in enumerate(views)}
+            self.cam_tables[scan] = cam_table
+
     def __len__(self):
         return len(self.metas)
 
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = f.readlines()
-            lines = [line.rstrip() for line in lines]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # depth_min & depth_interval: line 11
         if self.image_scale != 1.0:  # origin: 1.0
             intrinsics[:2, :] *= self.image_scale
 
-        depth_min = float(lines[11].split()[0])
-        depth_interval = float(lines[11].split()[1]) * self.interval_scale
+        depth_min = depth_params[0]
+        depth_interval = depth_params[1] * self.interval_scale
         return intrinsics, extrinsics, depth_min, depth_interval
 
     def read_img(self, filename):
+        # scale 0~255 to 0~1
+        # np_img = np.array(img, dtype=np.float32) / 255. # origin version on 2020/02/20
+        # return np_img
+        return self.center_img(self.load_img(filename))
+
+    def load_img(self, filename):
+        # the resized uint8 image, as stored by pack_dataset.py
         img = Image.open(filename)
         if self.image_scale != 1.0:
             w, h = img.size
             img = img.resize((int(self.image_scale * w), int(self.image_scale * h)))  # origin: 0.25
-        # scale 0~255 to 0~1
-        # np_img = np.array(img, dtype=np.float32) / 255. # origin version on 2020/02/20
-        # return np_img
-        return self.center_img(np.array(img, dtype=np.float32))
+        return np.array(img)
 
     def center_img(self, img):  # this is very important for batch normalization
         img = img.astype(np.float32)
@@ -91,7 +138,7 @@ class MVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        depth_image = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_image = np.array(read_pfm_mmap(filename)[0], dtype=np.float32)
         depth_image = scale_image(depth_image, scale=self.image_scale, interpolation='nearest')
         return depth_image
 
@@ -103,55 +150,29 @@ class MVSDataset(Dataset):
         # use only the reference view and first nviews-1 source views
         view_ids = [ref_view] + src_views[:self.nviews - 1]
 
+        cam_table = self.cam_tables[scan]
+        rows = [cam_table['rows'][vid] for vid in view_ids]
+
         imgs = []
-        mask = None
-        depth = None
-        depth_values = None
-        proj_matrices = []
-        for i, vid in enumerate(view_ids):
+        for vid in view_ids:
             # NOTE that the id in image file names is from 000000000
             img_filename = os.path.join(self.datapath, '{}/blended_images/{:0>8}.jpg'.format(scan, vid))
-            # if i == 0:
-            #     print('process in {}, {}'.format(idx, img_filename))
-            proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
-            depth_filename = os.path.join(self.datapath, '{}/rendered_depth_maps/{:0>8}.pfm'.format(scan, vid))
-
-            if i == 0:
-                depth_name = depth_filename
-            # print('debug in dtu_yao', i, depth_filename)
-            imgs.append(self.read_img(img_filename))
-            intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename)
-
-            # multiply intrinsics and extrinsics to get projection matrix
-            proj_mat = extrinsics.copy()
-            proj_mat[:3, :4] = np.matmul(intrinsics, proj_mat[:3, :4])
-            proj_matrices.append(proj_mat)
-
-            if i == 0:  # reference view
-                if self.inverse_depth:  # slice inverse depth
-                    print('inverse depth')
-                    depth_end = depth_interval * (
-                                self.ndepths - 1) + depth_min  # Origin version: depth_interval * n-1 + depth_min as the last clos
-                    depth_values = np.linspace(1.0 / depth_min, 1.0 / depth_end, self.ndepths, endpoint=False)
-                    depth_values = 1.0 / depth_values
-                    depth_values = depth_values.astype(np.float32)
-
-                    # depth_values = np.concatenate((depth_values[1::2],depth_values[::-2]),axis=0)
-
-                else:
-                    depth_values = np.arange(depth_min, depth_interval * (self.ndepths - 0.5) + depth_min,
-                                             depth_interval, dtype=np.float32)  # the set is [)
-
-                    depth_values = np.concatenate((depth_values, depth_values[::-1]), axis=0)
-
-                    depth_end = depth_interval * (self.ndepths - 1) + depth_min
-
-                # mask = self.read_img(mask_filename)
-                depth = self.read_depth(depth_filename)
-                # mask = np.array((depth > depth_min+depth_interval) & (depth < depth_min+(self.ndepths-2)*depth_interval), dtype=np.float32)
-                mask = np.array((depth >= depth_min) & (depth <= depth_end), dtype=np.float32)
-        imgs = np.stack(imgs).transpose([0, 3, 1, 2])
-        proj_matrices = np.stack(proj_matrices)
+            imgs.append(self.load_img(img_filename))
+        # normalize all views in one pass
+        imgs = center_images(np.stack(imgs), eps=0.00000001).transpose([0, 3, 1, 2])
+        proj_matrices = cam_table['proj_matrices'][rows]
+
+        # reference view
+        depth_name = os.path.join(self.datapath, '{}/rendered_depth_maps/{:0>8}.pfm'.format(scan, ref_view))
+        if self.inverse_depth:
+            print('inverse depth')
+        depth_values = cam_table['depth_values'][rows[0]].copy()
+        depth_min, _, depth_end = cam_table['depth_ranges'][rows[0]]
+        # depth_interval as returned so far: the one of the last view of the sample
+        depth_interval = cam_table['depth_ranges'][rows[-1]][1]
+        depth = self.read_depth(depth_name)
+        # mask = np.array((depth > depth_min+depth_interval) & (depth < depth_min+(self.ndepths-2)*depth_interval), dtype=np.float32)
+        mask = np.array((depth >= depth_min) & (depth <= depth_end), dtype=np.float32)
 
         if (flip_flag and self.both) or (self.reverse and not self.both):
             depth_values = np.array([depth_values[len(depth_values) - i - 1] for i in range(len(depth_values))])
@@ -0,0 +1,106 @@
+import ctypes
+import hashlib
+import multiprocessing as mp
+import numpy as np
+
+# dtypes an entry can have, the index is stored per slot
+CACHE_DTYPES = [np.dtype(np.uint8), np.dtype(np.float32)]
+CACHE_MAX_DIMS = 4
+SLOT_ALIGN = 64
+
+
+def cache_key(key):
+    """ 63 bit hash of a key such as (scan, view, scale) """
+    return int.from_bytes(hashlib.sha1(repr(key).encode()).digest()[:8], 'little') & 0x7fffffffffffffff
+
+
+class SharedImageCache(object):
+    """ LRU cache of preprocessed images in shared memory
+
+    The memory is allocated by the process that creates the cache (the main process of the DataLoader) and split into
+    fixed size slots, so the DataLoader workers share every entry. An image larger than a slot is never cached.
+    """
+
+    def __init__(self, max_bytes, slot_bytes):
+        slot_bytes = -(-int(slot_bytes) // SLOT_ALIGN) * SLOT_ALIGN
+        self.slot_bytes = slot_bytes
+        self.num_slots = int(max_bytes) // slot_bytes
+        self.lock = mp.Lock()
+        self.data = mp.RawArray(ctypes.c_uint8, self.num_slots * slot_bytes)
+        self.keys = mp.RawArray(ctypes.c_int64, self.num_slots)
+        self.shapes = mp.RawArray(ctypes.c_int64, self.num_slots * (CACHE_MAX_DIMS + 2))  # ndim, dtype, shape
+        self.ticks = mp.RawArray(ctypes.c_int64, self.num_slots)
+        self.counters = mp.RawArray(ctypes.c_int64, 4)  # clock, hits, misses, evictions
+        self._arrays()[0][:] = -1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_views', None)
+        return state
+
+    def _arrays(self):
+        # numpy views of the shared arrays, made once per process
+        if not hasattr(self, '_views'):
+            self._views = (np.frombuffer(self.keys, dtype=np.int64),
+                           np.frombuffer(self.shapes, dtype=np.int64).reshape(-1, CACHE_MAX_DIMS + 2),
+                           np.frombuffer(self.ticks, dtype=np.int64),
+                           np.frombuffer(self.counters, dtype=np.int64),
+                           np.frombuffer(self.data, dtype=np.uint8))
+        return self._views
+
+    def _slot_array(self, slot):
+        _, shapes, _, _, data = self._arrays()
+        ndim, dtype = shapes[slot, :2]
+        shape = tuple(shapes[slot, 2:2 + ndim])
+        dtype = CACHE_DTYPES[dtype]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        start = slot * self.slot_bytes
+        return data[start:start + nbytes].view(dtype).reshape(shape)
+
+    def get(self, key):
+        """ a copy of the cached image of key, None if it is not cached """
+        h = cache_key(key)
+        keys, _, ticks, counters, _ = self._arrays()
+        with self.lock:
+            slots = np.flatnonzero(keys == h)
+            if len(slots) == 0:
+                counters[2] += 1
+                return None
+            counters[0] += 1
+            counters[1] += 1
+            ticks[slots[0]] = counters[0]
+            return self._slot_array(slots[0]).copy()
+
+    def put(self, key, image):
+        """ cache image under key, evicting the least recently used entry if the cache is full """
+        image = np.ascontiguousarray(image)
+        if image.dtype not in CACHE_DTYPES or image.ndim > CACHE_MAX_DIMS or image.nbytes > self.slot_bytes \
+                or self.num_slots == 0:
+            return False
+        h = cache_key(key)
+        keys, shapes, ticks, counters, data = self._arrays()
+        with self.lock:
+            counters[0] += 1
+            slots = np.flatnonzero(keys == h)
+            if len(slots) > 0:  # stored by another worker in the meantime
+                ticks[slots[0]] = counters[0]
+                return True
+            slot = int(np.argmin(ticks))
+            if keys[slot] != -1:
+                counters[3] += 1
+            keys[slot] = h
+            ticks[slot] = counters[0]
+            shapes[slot, :2] = image.ndim, CACHE_DTYPES.index(image.dtype)
+            shapes[slot, 2:2 + image.ndim] = image.shape
+            start = slot * self.slot_bytes
+            data[start:start + image.nbytes] = image.reshape(-1).view(np.uint8)
+        return True
+
+    def stats(self):
+        """ hits, misses, evictions and the number of cached images, over all processes """
+        keys, _, _, counters, _ = self._arrays()
+        with self.lock:
+            hits, misses, evictions = (int(c) for c in counters[1:])
+            entries = int(np.count_nonzero(keys != -1))
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'entries': entries,
+                'slots': self.num_slots, 'hit_rate': hits / max(hits + misses, 1)}
@@ -0,0 +1,109 @@
+from torch.utils.data import Dataset
+import numpy as np
+import os
+from . import find_depth_hypotheses
+from .data_io import *
+from .preprocess import center_images
+
+
+# scans of dtu_yao or dtu_yao_blend packed by pack_dataset.py at the training image_scale (only for training)
+class MVSDataset(Dataset):
+    def __init__(self, datapath, listfile, mode, nviews, ndepths=192, interval_scale=1.06, inverse_depth=False,
+                 origin_size=False, light_idx=-1, image_scale=0.25, reverse=False, both=True, fix_range=False,
+                 **kwargs):
+        super(MVSDataset, self).__init__()
+        self.datapath = datapath
+        self.listfile = listfile
+        self.mode = mode
+        self.nviews = nviews
+        self.ndepths = ndepths
+        self.interval_scale = interval_scale
+        self.inverse_depth = inverse_depth
+        self.origin_size = origin_size
+        self.light_idx = light_idx
+        self.image_scale = image_scale  # the scale the scans were packed at
+        self.reverse = reverse
+        self.both = both
+        self.fix_range = fix_range
+        print('dataset: inverse_depth {}, origin_size {}, light_idx:{}, image_scale:{}, reverse: {}, both: {}'.format(
+            self.inverse_depth, self.origin_size, self.light_idx, self.image_scale, self.reverse, self.both))
+
+        assert self.mode in ["train", "val", "test"]
+        self.metas = self.build_list()
+
+    def build_list(self):
+        metas = []
+        self.scans = {}
+        with open(self.listfile) as f:
+            scans = f.readlines()
+            scans = [line.rstrip() for line in scans]
+
+        # scans
+        for scan in scans:
+            index = read_packed_index(self.datapath, scan)
+            if index['image_scale'] != self.image_scale:
+                raise ValueError('{} is packed at image_scale {}, not {}'.format(scan, index['image_scale'],
+                                                                                 self.image_scale))
+            index['rows'] = {vid: i for i, vid in enumerate(index['views'])}
+            # depth hypotheses of the dataset the scan was packed from
+            index['depth_hypotheses'] = find_depth_hypotheses(index['dataset'])
+            self.scans[scan] = index
+
+            # light conditions, one for blendedmvs
+            if self.light_idx == -1 or len(index['lights']) == 1:
+                light_idxs = index['lights']
+            else:
+                light_idxs = [self.light_idx]
+            for ref_view, src_views in index['pairs']:
+                if len(src_views) < self.nviews - 1:
+                    print('less ref_view small {}'.format(self.nviews - 1))
+                    continue
+                for light_idx in light_idxs:
+                    if self.both:
+                        metas.append((scan, light_idx, ref_view, src_views, 1))  # add 1, 0 for reverse depth
+                    metas.append((scan, light_idx, ref_view, src_views, 0))
+        print("dataset", self.mode, "metas:", len(metas))
+        return metas
+
+    def __len__(self):
+        return len(self.metas)
+
+    def __getitem__(self, idx):
+        meta = self.metas[idx]
+        scan, light_idx, ref_view, src_views, flip_flag = meta
+        # use only the reference view and first nviews-1 source views
+        view_ids = [ref_view] + src_views[:self.nviews - 1]
+
+        index = self.scans[scan]
+        packed = read_packed_scan(self.datapath, scan)
+        rows = [index['rows'][vid] for vid in view_ids]
+        light = index['lights'].index(light_idx)
+
+        # the images of all views in one read, normalized in one pass
+        imgs = center_images(packed['images'][rows, light], eps=0.00000001).transpose([0, 3, 1, 2])
+        proj_matrices = []
+        for row in rows:
+            # multiply intrinsics and extrinsics to get projection matrix
+            proj_mat = np.array(packed['extrinsics'][row])
+            proj_mat[:3, :4] = np.matmul(packed['intrinsics'][row], proj_mat[:3, :4])
+            proj_matrices.append(proj_mat)
+        proj_matrices = np.stack(proj_matrices)
+
+        # reference view
+        depth_min = float(packed['depth_params'][rows[0], 0])
+        ref_interval = float(packed['depth_params'][rows[0], 1]) * self.interval_scale
+        if self.inverse_depth:
+            print('inverse depth')
+        depth_values, depth_end = index['depth_hypotheses'](depth_min, ref_interval, self.ndepths, self.inverse_depth,
+                                                             self.fix_range)
+        depth = packed['depths'][rows[0]].astype(np.float32)
+        mask = np.array((depth >= depth_min) & (depth <= depth_end), dtype=np.float32)
+        # depth_interval as returned by the unpacked datasets: the one of the last view of the sample
+        depth_interval = float(packed['depth_params'][rows[-1], 1]) * self.interval_scale
+
+        if (flip_flag and self.both) or (self.reverse and not self.both):
+            depth_values = np.array([depth_values[len(depth_values) - i - 1] for i in range(len(depth_values))])
+
+        return {"imgs": imgs, "proj_matrices": proj_matrices, "depth": depth, "depth_values": depth_values,
+                # generate depth index
+                "mask": mask, "depth_interval": depth_interval, 'name': index['depth_names'][rows[0]], }
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import math
+import os
 import cv2
 import numpy as np
+from PIL import Image
+
+from .data_io import read_image_draft
 
 
 def scale_camera(cam, scale=1):
@@ -41,6 +45,40 @@ def scale_mvs_input(images, cams, depth_image=None, scale=1, view_num=5):
         return new_images, cams, depth_image
 
 
+def scaled_image_size(h, w, scale=1):
+    """ size of an image after scale_image, cv2.resize rounds to the nearest integer (half to even) """
+    return int(round(h * scale)), int(round(w * scale))
+
+
+def crop_window(h, w, max_h=1200, max_w=1600, base_image_size=8):
+    """ first row, first column, height and width of the center crop of crop_mvs_input """
+    new_h = h
+    new_w = w
+    if new_h > max_h:
+        new_h = max_h
+    else:
+        new_h = int(math.ceil(h / base_image_size) * base_image_size)
+    if new_w > max_w:
+        new_w = max_w
+    else:
+        new_w = int(math.ceil(w / base_image_size) * base_image_size)
+    start_h = int(math.ceil((h - new_h) / 2))
+    start_w = int(math.ceil((w - new_w) / 2))
+    return start_h, start_w, new_h, new_w
+
+
+def scale_crop_proj_matrix(intrinsics, extrinsics, image_size, scale=1, max_h=1200, max_w=1600, base_image_size=8):
+    """ projection matrix of a view after scale_mvs_input and crop_mvs_input, computed without the image """
+    cam = scale_camera(intrinsics, scale=scale)
+    h, w = scaled_image_size(image_size[0], image_size[1], scale=scale)
+    start_h, start_w, _, _ = crop_window(h, w, max_h=max_h, max_w=max_w, base_image_size=base_image_size)
+    cam[0][2] = cam[0][2] - start_w
+    cam[1][2] = cam[1][2] - start_h
+    proj_mat = np.copy(extrinsics)
+    proj_mat[:3, :4] = np.matmul(cam, proj_mat[:3, :4])
+    return proj_mat
+
+
 def crop_mvs_input(images, cams, depth_image=None, view_num=5, max_h=1200, max_w=1600, base_image_size=8):
     """ resize images and cameras to fit the network (can be divided by base image size) """
 
@@ -48,18 +86,7 @@ def crop_mvs_input(images, cams, depth_image=None, view_num=5, max_h=1200, max_w
     # crop images and cameras
     for view in range(view_num):
         h, w = images[view].shape[0:2]
-        new_h = h
-        new_w = w
-        if new_h > max_h:
-            new_h = max_h
-        else:
-            new_h = int(math.ceil(h / base_image_size) * base_image_size)
-        if new_w > max_w:
-            new_w = max_w
-        else:
-            new_w = int(math.ceil(w / base_image_size) * base_image_size)
-        start_h = int(math.ceil((h - new_h) / 2))
-        start_w = int(math.ceil((w - new_w) / 2))
+        start_h, start_w, new_h, new_w = crop_window(h, w, max_h=max_h, max_w=max_w, base_image_size=base_image_size)
         finish_h = start_h + new_h
         finish_w = start_w + new_w
 
@@ -74,3 +101,115 @@ def crop_mvs_input(images, cams, depth_image=None, view_num=5, max_h=1200, max_w
         return new_images, cams, depth_image
     else:
         return new_images, cams
+
+
+def center_images(images, eps=0.0, inplace=False):
+    """ center_img of every view of a (V, H, W, C) stack in one float32 pass, per view and channel
+    (a float32 stack is normalized in place if inplace) """
+    if inplace and images.dtype == np.float32:
+        imgs = images
+    else:
+        imgs = images.astype(np.float32)
+    imgs -= imgs.mean(axis=(1, 2), keepdims=True)
+    # variance of the centered images without a squared temporary
+    var = np.einsum('vhw...,vhw...->v...', imgs, imgs) / (imgs.shape[1] * imgs.shape[2])
+    imgs /= np.sqrt(var)[:, None, None] + eps
+    return imgs
+
+
+def center_crop_images(images, eps=0.0, max_h=1200, max_w=1600, base_image_size=8):
+    """ center_img and the center crop of crop_mvs_input of a list of (H, W, C) images, the images of the same size
+    are normalized together by center_images """
+    crops = [None] * len(images)
+    sizes = {}
+    for i, img in enumerate(images):
+        sizes.setdefault(img.shape, []).append(i)
+    for shape, indices in sizes.items():
+        imgs = center_images(np.stack([images[i] for i in indices]), eps=eps, inplace=True)
+        start_h, start_w, new_h, new_w = crop_window(shape[0], shape[1], max_h=max_h, max_w=max_w,
+                                                     base_image_size=base_image_size)
+        for i, img in zip(indices, imgs):
+            crops[i] = img[start_h:start_h + new_h, start_w:start_w + new_w]
+    return crops
+
+
+def read_scaled_images(image_template, scan, view_ids, scale, image_cache=None, eps=0.0, pad_h=0, max_h=1200,
+                       max_w=1600, base_image_size=8):
+    """ center_crop_images of the images image_template.format(scan, vid) of the views after scaling by scale, from
+    image_cache (see image_cache.py) if possible, keyed by (scan, vid, scale); the images missing from the cache are
+    decoded near the scaled size with pad_h rows of zeros at the top and the bottom and normalized together """
+    keys = [(scan, vid, scale) for vid in view_ids]
+    imgs = [None] * len(keys)
+    if image_cache is not None:
+        imgs = [image_cache.get(key) for key in keys]
+    missing = [i for i, img in enumerate(imgs) if img is None]
+    if missing:
+        # converted to float only for the normalization
+        decoded = [read_image_draft(image_template.format(scan, view_ids[i]), scale=scale, pad_h=pad_h)
+                   for i in missing]
+        crops = center_crop_images(decoded, eps=eps, max_h=max_h, max_w=max_w, base_image_size=base_image_size)
+        for i, img in zip(missing, crops):
+            imgs[i] = img
+            if image_cache is not None:
+                image_cache.put(keys[i], img)
+    return imgs
+
+
+def build_cam_tables(datapath, metas, read_cam_file, ndepths, inverse_depth=True, adaptive_scaling=True, max_h=1200,
+                     max_w=1600, base_image_size=8):
+    """ read the cameras of every scan of metas (scan, ref_view, src_views) once: per view, the projection matrix of
+    the scaled and cropped input, the depth hypotheses when it is the reference view, its resize scale and its image
+    size; the arrays are read-only and shared by the DataLoader workers
+    :param read_cam_file: intrinsics, extrinsics, depth_min and depth_interval of a cam file
+    :return: dict of the cam table of every scan, with the row of every view in 'rows'
+    """
+    cam_tables = {}
+    scan_views = {}
+    for scan, ref_view, src_views in metas:
+        scan_views.setdefault(scan, set()).update([ref_view] + src_views)
+    for scan, views in scan_views.items():
+        views = sorted(views)
+        proj_matrices, depth_values, resize_scales, image_sizes = [], [], [], []
+        for vid in views:
+            img_filename = os.path.join(datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
+            proj_mat_filename = os.path.join(datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
+            # only the image header is read
+            with Image.open(img_filename) as img:
+                w, h = img.size
+            image_sizes.append((h, w))
+            intrinsics, extrinsics, depth_min, depth_interval = read_cam_file(proj_mat_filename)
+
+            if inverse_depth:  # slice inverse depth
+                values = np.linspace(1.0 / depth_min, 0.0, ndepths, endpoint=False)
+                values = 1.0 / values
+                values = values.astype(np.float32)
+            else:
+                values = np.arange(depth_min, depth_interval * ndepths + depth_min, depth_interval, dtype=np.float32)
+            depth_values.append(values)
+
+            resize_scale = 1
+            if adaptive_scaling:
+                resize_scale = max(float(max_h) / h, float(max_w) / w)
+            resize_scales.append(resize_scale)
+            proj_matrices.append(scale_crop_proj_matrix(intrinsics, extrinsics, (h, w), scale=resize_scale,
+                                                        max_h=max_h, max_w=max_w, base_image_size=base_image_size))
+
+        # np.arange may give one hypothesis more or less per view, so the depth values are kept as a list
+        cam_table = {'proj_matrices': np.stack(proj_matrices), 'resize_scales': np.array(resize_scales),
+                     'image_sizes': np.array(image_sizes)}
+        for array in list(cam_table.values()) + depth_values:
+            array.setflags(write=False)
+        cam_table['depth_values'] = depth_values
+        cam_table['rows'] = {vid: i for i, vid in enumerate(views)}
+        cam_tables[scan] = cam_table
+    return cam_tables
+
+
+def cam_table_sample_shape(cam_table, view_ids, max_h=1200, max_w=1600, base_image_size=8):
+    """ number of views, height and width of the cropped images and number of depth hypotheses of a sample of the
+    views of a cam table of build_cam_tables; samples of the same shape can be batched (see bucketing.py) """
+    rows = [cam_table['rows'][vid] for vid in view_ids]
+    resize_scale = float(cam_table['resize_scales'][rows].max())
+    h, w = scaled_image_size(*cam_table['image_sizes'][rows[0]], scale=resize_scale)
+    _, _, new_h, new_w = crop_window(h, w, max_h=max_h, max_w=max_w, base_image_size=base_image_size)
+    return len(view_ids), new_h, new_w, len(cam_table['depth_values'][rows[0]])
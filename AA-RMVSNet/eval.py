@@ -7,9 +7,10 @@ import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 import time
 from datasets import find_dataset_def
+from datasets.bucketing import BucketBatchSampler
 from models import *
 from utils import *
-from datasets.data_io import read_pfm, save_pfm
+from datasets.data_io import read_pfm_mmap, read_pfm_batch, save_pfm, read_cam_params
 import ast
 
 # from datasets.data_io import read_cam_file, read_pair_file, read_image, read_map, save_image, save_map
@@ -40,6 +41,32 @@ parser.add_argument('--testpath', help='testing data path')
 parser.add_argument('--testlist', help='testing scan list')
 
 parser.add_argument('--batch_size', type=int, default=1, help='testing batch size')
+parser.add_argument('--image_cache', type=int, default=0,
+                    help='MB of shared memory for the preprocessed input images of the eval datasets, 0 to disable')
+parser.add_argument('--bucket_mb', type=int, default=0,
+                    help='batch the views of the same input shape up to about this many MB per batch instead of '
+                         '--batch_size, 0 to disable')
+parser.add_argument('--prefetch', type=int, default=2, help='batches loaded ahead while the model runs')
+parser.add_argument('--write_queue', type=int, default=8, help='depth maps waiting to be saved before the model waits')
+parser.add_argument('--device', default='cuda', help='device the model runs on, e.g. cuda, cuda:1 or cpu')
+parser.add_argument('--threads', type=int, default=0, help='intra-op threads of the cpu kernels, 0 for the torch default')
+parser.add_argument('--channels_last', help='True or False flag, run the model in channels-last memory format.',
+                    type=ast.literal_eval, default=False)
+parser.add_argument('--depth_chunk', type=int, default=1, help='depth planes warped and reweighted together')
+parser.add_argument('--chunk_mb', type=int, default=0,
+                    help='derive the depth chunk from this memory budget in MB, 0 to use --depth_chunk')
+parser.add_argument('--deform_backend', default=None, choices=['torchvision', 'native'],
+                    help='deformable convolution backend, torchvision if it is installed by default')
+parser.add_argument('--coarse_planes', type=int, default=0,
+                    help='planes of the coarse pass of the two-pass sweep, 0 for a single sweep over all planes')
+parser.add_argument('--fine_planes', type=int, default=32, help='per pixel planes of the fine pass')
+parser.add_argument('--band_sigma', type=float, default=3.0,
+                    help='half width of the fine band in standard deviations of the coarse plane index')
+parser.add_argument('--min_visible', type=int, default=0,
+                    help='skip the depth planes without a pixel seen by this many source views, 0 to sweep all planes')
+parser.add_argument('--feature_cache', type=int, default=0,
+                    help='MB of view features kept so that each image of a scan is encoded once, 0 to disable')
+parser.add_argument('--feature_spill', default=None, help='directory float16 features beyond --feature_cache spill to')
 parser.add_argument('--numdepth', type=int, default=256, help='the number of depth values')
 parser.add_argument('--interval_scale', type=float, default=0.8, help='the depth interval scale')
 
@@ -61,13 +88,8 @@ save_dir = args.outdir
 
 # read intrinsics and extrinsics
 def read_camera_parameters(filename):
-    with open(filename) as f:
-        lines = f.readlines()
-        lines = [line.rstrip() for line in lines]
-    # extrinsics: line [1,5), 4x4 matrix
-    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-    # intrinsics: line [7-10), 3x3 matrix
-    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # from the cams.npy bundle of the cam directory if there is one, else from the text file
+    intrinsics, extrinsics, _ = read_cam_params(filename)
     # TODO: assume the feature is 1/4 of the original image size
     #  check this (MVS used, but Cascade not used)
     # intrinsics[:2, :] /= 4
@@ -115,17 +137,32 @@ def save_depth():
     MVSDataset = find_dataset_def(args.dataset)
     test_dataset = MVSDataset(args.testpath, args.testlist, "test", 7, args.numdepth, args.interval_scale,
                               args.inverse_depth, adaptive_scaling=True, max_h=args.max_h, max_w=args.max_w,
-                              sample_scale=1, base_image_size=8)
-
-    TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=4, drop_last=False)
+                              sample_scale=1, base_image_size=8, image_cache_bytes=args.image_cache << 20)
 
-    model = AARMVSNet(image_scale=args.image_scale, max_h=args.max_h, max_w=args.max_w, return_depth=args.return_depth)
+    if args.bucket_mb > 0:
+        # samples of different shapes after adaptive scaling are never batched together
+        batch_sampler = BucketBatchSampler(test_dataset, args.bucket_mb << 20)
+        print('{} batches of shapes (views, height, width, depths) {}'.format(len(batch_sampler), batch_sampler.shapes))
+        TestImgLoader = DataLoader(test_dataset, batch_sampler=batch_sampler, num_workers=4)
+    else:
+        TestImgLoader = DataLoader(test_dataset, args.batch_size, shuffle=False, num_workers=4, drop_last=False)
+    # the next batches are loaded by the workers while the model runs, the outputs are saved in the background
+    TestImgLoader = Prefetcher(TestImgLoader, args.prefetch)
+    writer = AsyncWriter(args.write_queue)
+
+    if args.deform_backend is not None:
+        set_deform_backend(args.deform_backend)
+    model = AARMVSNet(image_scale=args.image_scale, max_h=args.max_h, max_w=args.max_w, return_depth=args.return_depth,
+                      depth_chunk=args.depth_chunk, chunk_bytes=args.chunk_mb * 2 ** 20,
+                      coarse_planes=args.coarse_planes, fine_planes=args.fine_planes, band_sigma=args.band_sigma,
+                      min_visible=args.min_visible)
 
     # load checkpoint file specified by args.loadckpt
     print("loading model {}".format(args.loadckpt))
 
     # Allow both keys xxx & module.xxx in dict
-    state_dict = torch.load(args.loadckpt)
+    device = setup_device(args.device, args.threads)
+    state_dict = torch.load(args.loadckpt, map_location=device)
     if "module.feature.conv0_0.0.weight" in state_dict['model'] or "module" in list(state_dict['model'].keys())[0]:
         print("With module in keys")
         model = nn.DataParallel(model)
@@ -135,8 +172,16 @@ def save_depth():
         print("No module in keys")
         model.load_state_dict(state_dict['model'], True)
         model = nn.DataParallel(model)
-    model.cuda()
+    if device.type != 'cuda' or device.index is not None:
+        # DataParallel only scatters over gpus and from cuda:0, an explicit device runs the bare model
+        model = model.module
+    model.to(device)
+    if args.channels_last:
+        model.to(memory_format=torch.channels_last)
     model.eval()
+    feature_cache = None
+    if args.feature_cache > 0:
+        feature_cache = FeatureCache(args.feature_cache * 2 ** 20, spill_dir=args.feature_spill)
 
     count = -1
     total_time = 0
@@ -148,11 +193,15 @@ def save_depth():
                 continue
             count += 1
             print('process', sample['filename'])
-            sample_cuda = tocuda(sample)
+            sample_cuda = todevice(sample, device)
             print('input shape: ', sample_cuda["imgs"].shape, sample_cuda["proj_matrices"].shape,
                   sample_cuda["depth_values"].shape)
             time_s = time.time()
-            outputs = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], sample_cuda["depth_values"])
+            features = None
+            if feature_cache is not None:
+                features = feature_cache.encode(getattr(model, 'module', model).feature, sample_cuda["imgs"],
+                                                sample["view_keys"])
+            outputs = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], sample_cuda["depth_values"], features)
 
             one_time = time.time() - time_s
             total_time += one_time
@@ -175,9 +224,17 @@ def save_depth():
                 os.makedirs(confidence_filename.rsplit('/', 1)[0], exist_ok=True)
                 # save depth maps
 #                 print(depth_est.shape)
-                save_pfm(depth_filename, depth_est.squeeze())
+                writer.put(save_pfm, depth_filename, depth_est.squeeze())
                 # save confidence maps
-                save_pfm(confidence_filename, photometric_confidence.squeeze())
+                writer.put(save_pfm, confidence_filename, photometric_confidence.squeeze())
+
+    writer.close()
+    print('pipeline:', TestImgLoader.stats(), writer.stats())
+    if getattr(test_dataset, 'image_cache', None) is not None:
+        print('image cache:', test_dataset.image_cache.stats())
+    if feature_cache is not None:
+        feature_cache.close()
+        print('feature cache:', feature_cache.stats())
 
 
 # project the reference point cloud into the source view, then project back
@@ -302,10 +359,10 @@ def filter_depth(scan_folder, out_folder, plyfilename):
         ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
         print('img shape', ref_img.shape)
         # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(ref_view)))[0]
+        ref_depth_est = read_pfm_mmap(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(ref_view)))[0]
         print('ref_depth_est shape', ref_depth_est.shape, ref_depth_est[:3, :3])
         # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(ref_view)))[0]
+        confidence = read_pfm_mmap(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(ref_view)))[0]
         print('confidence shape', confidence.shape, confidence.mean())
         # photo_mask = confidence > args.conf  # TODO: check （Cas = 0.9, MVS = 0.8)
         conf = min(0.4, confidence.mean())
@@ -318,12 +375,13 @@ def filter_depth(scan_folder, out_folder, plyfilename):
 
         # compute the geometric mask
         geo_mask_sum = 0
-        for src_view in src_views:
+        # the estimated depths of the source views, memory-mapped
+        src_depth_ests = read_pfm_batch([os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(src_view))
+                                         for src_view in src_views])
+        for src_view, src_depth_est in zip(src_views, src_depth_ests):
             # camera parameters of the source view
             src_intrinsics, src_extrinsics = read_camera_parameters(
                 os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)))
-            # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(src_view)))[0]
             # print('src_depth_est shape', src_depth_est.shape)
 
             geo_mask, depth_reprojected, x2d_src, y2d_src = check_geometric_consistency(ref_depth_est, ref_intrinsics,
@@ -3,7 +3,7 @@ import os
 import numpy as np
 from utils import print_args
 import sys
-from datasets.data_io import read_pfm
+from datasets.data_io import read_pfm_mmap, read_pfm_batch, read_cam_params, read_image_size, read_image_draft
 from plyfile import PlyData, PlyElement
 from PIL import Image
 import cv2
@@ -25,13 +25,8 @@ print_args(args)
 
 # read intrinsics and extrinsics
 def read_camera_parameters(filename, scale, index, flag):
-    with open(filename) as f:
-        lines = f.readlines()
-        lines = [line.rstrip() for line in lines]
-    # extrinsics: line [1,5), 4x4 matrix
-    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
-    # intrinsics: line [7-10), 3x3 matrix
-    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # from the cams.npy bundle of the cam directory if there is one, else from the text file
+    intrinsics, extrinsics, _ = read_cam_params(filename)
 
     intrinsics[:2, :] *= scale
 
@@ -156,28 +151,31 @@ def filter_depth(scan_folder, out_folder, plyfilename, photo_threshold):
 
     for ref_view, src_views in pair_data:
         # load the reference image
-        ref_img = read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view)))
+        ref_img_filename = os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(ref_view))
+        img_h, img_w = read_image_size(ref_img_filename)
         colored_ref_img = Image.open(os.path.join(scan_folder, 'colored/colored_{:0>8}.png'.format(ref_view)))
         colored_ref_img = np.array(colored_ref_img, dtype=np.float32)
         colored_ref_img = cv2.resize(colored_ref_img, (800, 600))
 #         print(ref_img.shape, colored_ref_img.shape)
         # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(ref_view)))[0]
+        ref_depth_est = read_pfm_mmap(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(ref_view)))[0]
 
         # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(ref_view)))[0]
+        confidence = read_pfm_mmap(os.path.join(out_folder, 'confidence_0/{:0>8}.pfm'.format(ref_view)))[0]
 
-        scale = float(confidence.shape[0]) / ref_img.shape[0]
-        index = int((int(ref_img.shape[1] * scale) - confidence.shape[1]) / 2)
-        index_p = (int(ref_img.shape[1] * scale) - confidence.shape[1]) - index
+        scale = float(confidence.shape[0]) / img_h
+        index = int((int(img_w * scale) - confidence.shape[1]) / 2)
+        index_p = (int(img_w * scale) - confidence.shape[1]) - index
         flag = 0
-        if confidence.shape[1] / ref_img.shape[1] > scale:
-            scale = float(confidence.shape[1]) / ref_img.shape[1]
-            index = int((int(ref_img.shape[0] * scale) - confidence.shape[0]) / 2)
-            index_p = (int(ref_img.shape[0] * scale) - confidence.shape[0]) - index
+        if confidence.shape[1] / img_w > scale:
+            scale = float(confidence.shape[1]) / img_w
+            index = int((int(img_h * scale) - confidence.shape[0]) / 2)
+            index_p = (int(img_h * scale) - confidence.shape[0]) - index
             flag = 1
 
-        ref_img = cv2.resize(ref_img, (int(ref_img.shape[1] * scale), int(ref_img.shape[0] * scale)))
+        # decoded near the size of the depth map, scale 0~255 to 0~1 only after resizing
+        ref_img = read_image_draft(ref_img_filename, size=(int(img_h * scale), int(img_w * scale)))
+        ref_img = ref_img.astype(np.float32) / 255.
         if flag == 0:
             ref_img = ref_img[:, index:ref_img.shape[1] - index_p, :]
         else:
@@ -199,9 +197,11 @@ def filter_depth(scan_folder, out_folder, plyfilename, photo_threshold):
         for src_view in src_views:
             n += 1
         ct = 0
-        for src_view in src_views:
+        # the estimated depths of the source views, memory-mapped
+        src_depth_ests = read_pfm_batch([os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(src_view))
+                                         for src_view in src_views])
+        for src_view, src_depth_est in zip(src_views, src_depth_ests):
             ct = ct + 1
-            src_depth_est = read_pfm(os.path.join(out_folder, 'depth_est_0/{:0>8}.pfm'.format(src_view)))[0]
 
             src_intrinsics, src_extrinsics = read_camera_parameters(
                 os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(src_view)), scale, index, flag)
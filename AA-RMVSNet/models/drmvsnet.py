@@ -92,6 +92,9 @@ class UNetConvLSTM(nn.Module):
         self.deconv_0 = deConvGnReLU(16, 16, kernel_size=3, stride=2, padding=1, bias=self.bias, output_padding=1)
         self.deconv_1 = deConvGnReLU(16, 16, kernel_size=3, stride=2, padding=1, bias=self.bias, output_padding=1)
         self.conv_0 = nn.Conv2d(8, 1, 3, 1, padding=1)
+        self.pool = nn.MaxPool2d((2, 2), stride=2)
+        # hidden and cell states of the inference sweep per (batch size, device), zeroed and updated in place
+        self._state_pool = {}
 
     def forward(self, input_tensor, hidden_state=None, idx=0, process_sq=True):
         """
@@ -107,8 +110,13 @@ class UNetConvLSTM(nn.Module):
         -------
         last_state_list, layer_output
         """
+        # without autograd the states are updated in place, the sweep then allocates them once
+        inplace = not torch.is_grad_enabled()
         if idx == 0:  # input the first layer of input image
-            hidden_state = self._init_hidden(batch_size=input_tensor.size(0))
+            if inplace:
+                hidden_state = self._pooled_hidden(batch_size=input_tensor.size(0), device=input_tensor.device)
+            else:
+                hidden_state = self._init_hidden(batch_size=input_tensor.size(0), device=input_tensor.device)
 
         layer_output_list = []
         last_state_list = []
@@ -119,20 +127,21 @@ class UNetConvLSTM(nn.Module):
 
         if process_sq:
 
-            h0, c0 = hidden_state[0] = self.cell_list[0](input_tensor=cur_layer_input, cur_state=hidden_state[0])
+            h0, c0 = hidden_state[0] = self.cell_list[0](input_tensor=cur_layer_input, cur_state=hidden_state[0],
+                                                         inplace=inplace)
 
-            h0_1 = nn.MaxPool2d((2, 2), stride=2)(h0)
-            h1, c1 = hidden_state[1] = self.cell_list[1](input_tensor=h0_1, cur_state=hidden_state[1])
+            h0_1 = self.pool(h0)
+            h1, c1 = hidden_state[1] = self.cell_list[1](input_tensor=h0_1, cur_state=hidden_state[1], inplace=inplace)
 
-            h1_0 = nn.MaxPool2d((2, 2), stride=2)(h1)
-            h2, c2 = hidden_state[2] = self.cell_list[2](input_tensor=h1_0, cur_state=hidden_state[2])
+            h1_0 = self.pool(h1)
+            h2, c2 = hidden_state[2] = self.cell_list[2](input_tensor=h1_0, cur_state=hidden_state[2], inplace=inplace)
             h2_0 = self.deconv_0(h2)  # auto reuse
 
             h2_1 = torch.cat([h2_0, h1], 1)
-            h3, c3 = hidden_state[3] = self.cell_list[3](input_tensor=h2_1, cur_state=hidden_state[3])
+            h3, c3 = hidden_state[3] = self.cell_list[3](input_tensor=h2_1, cur_state=hidden_state[3], inplace=inplace)
             h3_0 = self.deconv_1(h3)  # auto reuse
             h3_1 = torch.cat([h3_0, h0], 1)
-            h4, c4 = hidden_state[4] = self.cell_list[4](input_tensor=h3_1, cur_state=hidden_state[4])
+            h4, c4 = hidden_state[4] = self.cell_list[4](input_tensor=h3_1, cur_state=hidden_state[4], inplace=inplace)
 
             cost = self.conv_0(h4)  # auto reuse
 
@@ -141,10 +150,10 @@ class UNetConvLSTM(nn.Module):
             for t in range(seq_len):
                 h0, c0 = self.cell_list[0](input_tensor=cur_layer_input[:, t, :, :, :], cur_state=hidden_state[0])
                 hidden_state[0] = [h0, c0]
-                h0_1 = nn.MaxPool2d((2, 2), stride=2)(h0)
+                h0_1 = self.pool(h0)
                 h1, c1 = self.cell_list[1](input_tensor=h0_1, cur_state=hidden_state[1])
                 hidden_state[1] = [h1, c1]
-                h1_0 = nn.MaxPool2d((2, 2), stride=2)(h1)
+                h1_0 = self.pool(h1)
                 h2, c2 = self.cell_list[2](input_tensor=h1_0, cur_state=hidden_state[2])
                 hidden_state[2] = [h2, c2]
                 h2_0 = self.deconv_0(h2)  # auto reuse
@@ -166,10 +175,20 @@ class UNetConvLSTM(nn.Module):
 
             return prob_volume
 
-    def _init_hidden(self, batch_size):
+    def _init_hidden(self, batch_size, device=None):
         init_states = []
         for i in range(self.num_layers):
-            init_states.append(self.cell_list[i].init_hidden(batch_size))
+            init_states.append(self.cell_list[i].init_hidden(batch_size, device))
+        return init_states
+
+    def _pooled_hidden(self, batch_size, device=None):
+        key = (batch_size, str(device))
+        if key not in self._state_pool:
+            self._state_pool[key] = self._init_hidden(batch_size, device)
+        init_states = self._state_pool[key]
+        for h, c in init_states:
+            h.zero_()
+            c.zero_()
         return init_states
 
     @staticmethod
@@ -186,7 +205,8 @@ class UNetConvLSTM(nn.Module):
 
 
 class AARMVSNet(nn.Module):
-    def __init__(self, image_scale=0.25, max_h=960, max_w=480, return_depth=False):
+    def __init__(self, image_scale=0.25, max_h=960, max_w=480, return_depth=False, depth_chunk=1, chunk_bytes=0,
+                 coarse_planes=0, fine_planes=32, band_sigma=3.0, min_visible=0):
 
         super(AARMVSNet, self).__init__()
         self.feature = FeatNet()
@@ -201,37 +221,96 @@ class AARMVSNet(nn.Module):
         self.omega = InterViewAAModule(32)
 
         self.return_depth = return_depth
+        # depth planes whose source views are warped and reweighted together, derived from chunk_bytes if it is set
+        self.depth_chunk = depth_chunk
+        self.chunk_bytes = chunk_bytes
+        # two-pass test phase if coarse_planes > 0, see coarse_to_fine
+        self.coarse_planes = coarse_planes
+        self.fine_planes = fine_planes
+        self.band_sigma = band_sigma
+        # test phase sweeps skip the planes without a pixel seen by min_visible source views if it is > 0
+        self.min_visible = min_visible
+
+    def depth_chunk_size(self, ref_feature, num_src):
+        if not self.chunk_bytes:
+            return max(self.depth_chunk, 1)
+        batch, channels, height, width = ref_feature.shape
+        # warped features, their squared difference, its reordered and reweighted copies and the omega activations
+        plane_bytes = 4 * num_src * batch * height * width * (4 * channels + 8)
+        return max(int(self.chunk_bytes // plane_bytes), 1)
+
+    def variance_volumes(self, ref_feature, src_features, warper, depth_values):
+        """
+        reweighted variance volume of each depth plane, in order. The source views of a chunk of consecutive planes
+        are stacked along the batch dimension, so grid_sample and omega run once per chunk instead of once per plane
+        and source view, while the recurrent regularization still consumes the planes one by one.
+        """
+        num_depth = depth_values.shape[1]
+        num_src = len(src_features)
+        batch, channels, height, width = ref_feature.shape
+        chunk = self.depth_chunk_size(ref_feature, num_src)
+        src_volume = torch.cat(src_features, 0)  # [(nviews-1)*B, C, H, W]
+        ref_volume = ref_feature.view(1, batch, channels, 1, height, width)
+        blank = None
+
+        for d0 in range(0, num_depth, chunk):
+            d1 = min(d0 + chunk, num_depth)
+            grid = warper.chunk_grid(depth_values[:, d0:d1])
+            # [K, nviews-1, B], False where the plane projects outside of the source view for every pixel
+            visible = warper.inside(grid).view(num_src, batch, d1 - d0, -1).any(3).permute(2, 0, 1)
+
+            if visible.all():
+                warped_volume = F.grid_sample(src_volume, grid, mode='bilinear',
+                                              padding_mode='zeros').type(torch.float32)
+                warped_volume = warped_volume.view(num_src, batch, channels, d1 - d0, height, width)
+                warped_volume = (warped_volume - ref_volume).pow_(2)
+                # [K, nviews-1, B, C, H, W], one omega over all planes and source views of the chunk
+                warped_volume = warped_volume.permute(3, 0, 1, 2, 4, 5).contiguous()
+                reweight = self.omega(warped_volume.view(-1, channels, height, width))  # saliency
+                reweight = reweight.view(d1 - d0, num_src, batch, 1, height, width)
+                warped_volumes = ((reweight + 1) * warped_volume).sum(1)
+            else:
+                # an invisible plane warps to zeros, its term (omega(ref^2) + 1) * ref^2 is the same for every
+                # plane and source view and is computed once; only the visible ones are warped and reweighted
+                if blank is None:
+                    blank = ref_feature.pow(2)
+                    blank = (self.omega(blank) + 1) * blank
+                warped_volumes = blank.unsqueeze(0).unsqueeze(0).repeat(d1 - d0, num_src, 1, 1, 1, 1)
+                k, v, b = visible.nonzero(as_tuple=True)
+                if len(k) > 0:
+                    warped_volume = F.grid_sample(src_volume.view(num_src, batch, channels, height, width)[v, b],
+                                                  grid.view(num_src, batch, d1 - d0, height, width, 2)[v, b, k],
+                                                  mode='bilinear', padding_mode='zeros').type(torch.float32)
+                    warped_volume = (warped_volume - ref_feature[b]).pow_(2)
+                    reweight = self.omega(warped_volume)  # saliency
+                    warped_volumes[k, v, b] = (reweight + 1) * warped_volume
+                warped_volumes = warped_volumes.sum(1)
 
-    def forward(self, imgs, proj_matrices, depth_values):
-        imgs = torch.unbind(imgs, 1)  # len: nviews, size: (nviews, B, C=3, H=600, W=800)
-        proj_matrices = torch.unbind(proj_matrices, 1)
-        assert len(imgs) == len(proj_matrices), "Different number of images and projection matrices"
+            for volume_variance in torch.unbind(warped_volumes / num_src, 0):
+                yield volume_variance
 
-        num_depth = depth_values.shape[1]
+    def forward(self, imgs, proj_matrices, depth_values, features=None):
+        # features: the feature maps of the views if they are already encoded (see utils.FeatureCache), imgs is
+        # not used then
+        proj_matrices = torch.unbind(proj_matrices, 1)
 
         # in: images; out: 32-channel feature maps
-        features = [self.feature(img) for img in imgs]  # len: nviews, size: (nviews, B, 32, H=600, W=800)
+        if features is None:
+            imgs = torch.unbind(imgs, 1)  # len: nviews, size: (nviews, B, C=3, H=600, W=800)
+            features = [self.feature(img) for img in imgs]  # len: nviews, size: (nviews, B, 32, H=600, W=800)
+        assert len(features) == len(proj_matrices), "Different number of images and projection matrices"
         ref_feature, src_features = features[0], features[1:]
         ref_proj, src_projs = proj_matrices[0], proj_matrices[1:]
 
+        # warping geometry of the source views, shared by all depth planes
+        warper = DepthwiseWarper(src_projs, ref_proj, ref_feature.shape[2], ref_feature.shape[3])
+
         # Recurrent process i-th depth layer
         cost_reg_list = []
         hidden_state = None
 
         if not self.return_depth:  # Training Phase;
-            for d in range(num_depth):
-                ref_volume = ref_feature
-                warped_volumes = None
-                for src_fea, src_proj in zip(src_features, src_projs):
-                    warped_volume = homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_values[:, d])
-                    warped_volume = (warped_volume - ref_volume).pow_(2)
-                    reweight = self.omega(warped_volume)
-                    if warped_volumes is None:
-                        warped_volumes = (reweight + 1) * warped_volume
-                    else:
-                        warped_volumes = warped_volumes + (reweight + 1) * warped_volume
-
-                volume_variance = warped_volumes / len(src_features)
+            for d, volume_variance in enumerate(self.variance_volumes(ref_feature, src_features, warper, depth_values)):
                 cost_reg, hidden_state = self.cost_regularization(-1 * volume_variance, hidden_state, d)
                 cost_reg_list.append(cost_reg)
 
@@ -242,58 +321,103 @@ class AARMVSNet(nn.Module):
             return {'prob_volume': prob_volume}
 
         else:  # Test phase
-            shape = ref_feature.shape
-            depth_image = torch.zeros(shape[0], shape[2], shape[3]).cuda()  # B * H * W
-            max_prob_image = torch.zeros(shape[0], shape[2], shape[3]).cuda()
-            exp_sum = torch.zeros(shape[0], shape[2], shape[3]).cuda()
-
-            for d in range(num_depth):
-                ref_volume = ref_feature
-                warped_volumes = None
-                for src_fea, src_proj in zip(src_features, src_projs):
-                    warped_volume = homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_values[:, d])
-                    warped_volume = (warped_volume - ref_volume).pow_(2)
-                    reweight = self.omega(warped_volume)  # saliency
-
-                    if warped_volumes is None:
-                        warped_volumes = (reweight + 1) * warped_volume
-                    else:
-                        warped_volumes = warped_volumes + (reweight + 1) * warped_volume
-
-                    volume_variance = warped_volumes / len(src_features)
-
-                cost_reg, hidden_state = self.cost_regularization(-1 * volume_variance, hidden_state, d)
-                cost_reg_list.append(cost_reg)
-
-            for d in range(num_depth):
-                prob = torch.exp(cost_reg_list[d].squeeze(1))
-                exp_sum = exp_sum + prob
-
-            prob_sum = torch.zeros(shape[0], shape[2], shape[3]).cuda()
-
-            for d in range(num_depth):
-                prob = torch.exp(cost_reg_list[d].squeeze(1))
-
-                prob = prob / exp_sum
-
-                depth = depth_values[:, d]  # B
-                temp_depth_image = depth.view(shape[0], 1, 1).repeat(1, shape[2], shape[3])
-                update_flag_image = (max_prob_image < prob).type(torch.float)
-
-                new_max_prob_image = torch.mul(update_flag_image, prob) + torch.mul(1 - update_flag_image,
-                                                                                    max_prob_image)
-                new_depth_image = torch.mul(update_flag_image, temp_depth_image) + torch.mul(1 - update_flag_image,
-                                                                                             depth_image)
-                max_prob_image = new_max_prob_image
-                depth_image = new_depth_image
-
-                prob_sum = prob_sum + prob
+            if self.coarse_planes and self.coarse_planes < depth_values.shape[1]:
+                return self.coarse_to_fine(ref_feature, src_features, warper, depth_values)
+            return self.sweep(ref_feature, src_features, warper, depth_values)
 
-            forward_exp_sum = prob_sum  # + 1e-7
-
-            conf = max_prob_image / forward_exp_sum
+    def sweep(self, ref_feature, src_features, warper, depth_values, index_values=None):
+        """
+        recurrent sweep of the test phase over depth_values [B, D], or per pixel [B, D, H, W], with an online softmax:
+        only the running max cost, the exp-sum relative to it and the depth of the max are kept instead of all D cost
+        maps. With the plane indices index_values (D floats) the winner-take-all index and the standard deviation of
+        the index under the softmax are returned too. With min_visible > 0 a visibility pre-pass drops the planes no
+        pixel sees in min_visible source views.
+        """
+        if self.min_visible > 0:
+            # planes without a pixel seen by min_visible source views are not swept
+            keep = warper.visible_planes(depth_values, self.min_visible).any(0)
+            if keep.any() and not keep.all():
+                depth_values = depth_values[:, keep]
+                if index_values is not None:
+                    index_values = [index for index, kept in zip(index_values, keep.tolist()) if kept]
 
-            return {"depth": depth_image, "photometric_confidence": conf}
+        hidden_state = None
+        max_cost = None
+        for d, volume_variance in enumerate(self.variance_volumes(ref_feature, src_features, warper, depth_values)):
+            cost_reg, hidden_state = self.cost_regularization(-1 * volume_variance, hidden_state, d)
+            cost = cost_reg.squeeze(1)  # B * H * W
+            depth = depth_values[:, d]
+            if depth.dim() == 1:
+                depth = depth.view(-1, 1, 1)  # B
+
+            if max_cost is None:
+                max_cost = cost
+                exp_sum = torch.ones_like(cost)
+                depth_image = depth.expand_as(cost).contiguous()
+                if index_values is not None:
+                    index_image = torch.full_like(cost, index_values[d])
+                    index_sum = index_image.clone()
+                    index_sq_sum = index_image * index_values[d]
+                continue
+            # exp(-|cost - max|) rescales either the sum (new max) or the new term (old max), one exp per plane
+            update_flag_image = cost > max_cost
+            scale = torch.exp(-(cost - max_cost).abs_())
+            exp_sum = torch.where(update_flag_image, exp_sum * scale + 1, exp_sum + scale)
+            max_cost = torch.where(update_flag_image, cost, max_cost)
+            depth_image = torch.where(update_flag_image, depth, depth_image)
+            if index_values is not None:
+                index = index_values[d]
+                index_sum = torch.where(update_flag_image, index_sum * scale + index, index_sum + scale * index)
+                index_sq_sum = torch.where(update_flag_image, index_sq_sum * scale + index * index,
+                                           index_sq_sum + scale * (index * index))
+                index_image = torch.where(update_flag_image, torch.full_like(cost, index), index_image)
+
+        # softmax probability of the winner-take-all depth
+        outputs = {"depth": depth_image, "photometric_confidence": 1 / exp_sum}
+        if index_values is not None:
+            index_mean = index_sum / exp_sum
+            outputs['index'] = index_image
+            outputs['index_std'] = (index_sq_sum / exp_sum - index_mean * index_mean).clamp_(min=0).sqrt_()
+        return outputs
+
+    def coarse_to_fine(self, ref_feature, src_features, warper, depth_values):
+        """
+        two-pass test phase: a sweep over coarse_planes planes spread over depth_values [B, D] estimates the plane
+        index of each pixel and its uncertainty, then a sweep of fine_planes per pixel planes covers only the band
+        index +- max(band_sigma * std, coarse plane step) of the full depth_values (see fine_band_depths)
+        """
+        num_depth = depth_values.shape[1]
+        step = (num_depth - 1) / float(max(self.coarse_planes - 1, 1))
+        coarse_index = [int(round(i * step)) for i in range(max(self.coarse_planes, 2))]
+        coarse = self.sweep(ref_feature, src_features, warper, depth_values[:, coarse_index],
+                            index_values=[float(i) for i in coarse_index])
+
+        fine_depths = fine_band_depths(depth_values, coarse['index'], coarse['index_std'] * self.band_sigma, step,
+                                       self.fine_planes)
+
+        return self.sweep(ref_feature, src_features, warper, fine_depths)
+
+
+def fine_band_depths(depth_values, index, radius, min_radius, fine_planes):
+    """
+    fine_planes depths per pixel spread over the plane indices index +- radius of depth_values [B, D], with index and
+    radius [B, H, W] fractional plane indices; the band is moved inside [0, D - 1] rather than clipped, so the depths
+    of a pixel are distinct even if its index is near the nearest or farthest plane
+    :return: B * K * H * W depths
+    """
+    batch, num_depth = depth_values.shape
+    height, width = index.shape[1], index.shape[2]
+    radius = radius.clamp(min=min_radius).clamp_(max=(num_depth - 1) / 2.0).unsqueeze(1)
+    center = torch.min(torch.max(index.unsqueeze(1), radius), num_depth - 1 - radius)
+    offsets = torch.linspace(-1, 1, fine_planes, device=index.device).view(1, -1, 1, 1)
+    index = (center + radius * offsets).clamp_(0, num_depth - 1)
+    # depth values between the planes are interpolated linearly, so inverse depth sampling is kept
+    lower = index.floor().long().clamp_(max=num_depth - 2)
+    weight = index - lower.float()
+    plane_depths = depth_values.float().view(batch, num_depth, 1, 1).expand(-1, -1, height, width)
+    lower_depth = torch.gather(plane_depths, 1, lower)
+    upper_depth = torch.gather(plane_depths, 1, lower + 1)
+    return lower_depth + weight * (upper_depth - lower_depth)
 
 
 def mvsnet_cls_loss(prob_volume, depth_gt, mask, depth_value, return_prob_map=False):
@@ -3,6 +3,11 @@ import torch.nn as nn
 from torch.autograd import Variable
 import torch
 
+try:
+    from torchvision.ops import deform_conv2d
+except ImportError:  # no torchvision, DeformConv2d uses its native backend
+    deform_conv2d = None
+
 
 def homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_value):
     # src_fea: [B, C, H, W]
@@ -39,6 +44,73 @@ def homo_warping_depthwise(src_fea, src_proj, ref_proj, depth_value):
     return warped_src_fea
 
 
+class DepthwiseWarper(object):
+    """
+    homo_warping_depthwise of every source view of a sample, for many depth values. Only the depth changes between
+    the planes of the sweep, so rot @ xyz and trans of each source view are computed once and already scaled to the
+    normalized grid coordinates; each plane is then one multiply-add and one divide.
+    """
+
+    def __init__(self, src_projs, ref_proj, height, width):
+        # src_projs: nviews-1 * [B, 4, 4]
+        # ref_proj: [B, 4, 4]
+        self.height, self.width = height, width
+
+        with torch.no_grad():
+            y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=ref_proj.device),
+                                   torch.arange(0, width, dtype=torch.float32, device=ref_proj.device)])
+            y, x = y.contiguous(), x.contiguous()
+            y, x = y.view(height * width), x.view(height * width)
+            xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
+            # x / ((width - 1) / 2) - 1 is linear in x, fold the division into rot and trans
+            norm = torch.tensor([2. / (width - 1), 2. / (height - 1), 1.], dtype=torch.float32,
+                                device=ref_proj.device).view(1, 3, 1)
+
+            proj = torch.matmul(torch.stack(src_projs), torch.inverse(ref_proj))  # [nviews-1, B, 4, 4]
+            self.rot_xyz = torch.matmul(proj[:, :, :3, :3], xyz) * norm  # [nviews-1, B, 3, H*W]
+            self.trans = proj[:, :, :3, 3:4] * norm  # [nviews-1, B, 3, 1]
+
+    def chunk_grid(self, depth_values):
+        """
+        sampling grids of all source views at a chunk of depth values [B, K] or per pixel [B, K, H, W], the planes are
+        stacked along the height so that one grid_sample of the stacked source features [(nviews-1)*B, C, H, W] warps
+        the whole chunk
+        :return: grid [(nviews-1)*B, K*H, W, 2]
+        """
+        nsrc, batch = self.rot_xyz.shape[:2]
+        with torch.no_grad():
+            depth_values = depth_values.float().view(1, batch, 1, depth_values.shape[1], -1)
+            proj_xyz = self.rot_xyz.unsqueeze(3) * depth_values + self.trans.unsqueeze(3)  # [nviews-1, B, 3, K, H*W]
+            proj_z = proj_xyz[:, :, 2:3]
+            behind = proj_z <= 0
+            proj_z.masked_fill_(behind, 1)
+            grid = (proj_xyz[:, :, :2] / proj_z).sub_(1)
+            # points behind the source camera are sampled outside of its image, grid_sample gives them zeros
+            grid = grid.masked_fill_(behind, -2).permute(0, 1, 3, 4, 2)  # [nviews-1, B, K, H*W, 2]
+        return grid.reshape(nsrc * batch, -1, self.width, 2)
+
+    def inside(self, grid):
+        # True where a grid point samples at least one pixel of its source feature map, grid_sample gives zeros
+        # elsewhere; chunk_grid moves the points behind the source camera outside
+        return (grid[..., 0].abs() < 1 + 1. / self.width) & (grid[..., 1].abs() < 1 + 1. / self.height)
+
+    def visible_planes(self, depth_values, min_views=1, max_points=2 ** 24):
+        """
+        visibility pre-pass from the grids only, in chunks of at most max_points grid points
+        :param depth_values: [B, D] or per pixel [B, D, H, W]
+        :return: [B, D] True for the planes with a pixel that samples inside at least min_views source views
+        """
+        nsrc, batch = self.rot_xyz.shape[:2]
+        num_depth = depth_values.shape[1]
+        chunk = max(max_points // (nsrc * batch * self.height * self.width), 1)
+        visible = []
+        for d0 in range(0, num_depth, chunk):
+            d1 = min(d0 + chunk, num_depth)
+            inside = self.inside(self.chunk_grid(depth_values[:, d0:d1])).view(nsrc, batch, d1 - d0, -1)
+            visible.append((inside.sum(0) >= min_views).any(2))
+        return torch.cat(visible, 1)
+
+
 class ConvLSTMCell(nn.Module):
 
     def __init__(self, input_size, input_dim, hidden_dim, kernel_size, bias=True):
@@ -71,27 +143,42 @@ class ConvLSTMCell(nn.Module):
 
         self.conv = nn.Conv2d(in_channels=self.input_dim + self.hidden_dim, out_channels=4 * self.hidden_dim,
                               kernel_size=self.kernel_size, padding=self.padding, bias=self.bias)
+        self._combined = None  # concatenation buffer of the in-place update
 
-    def forward(self, input_tensor, cur_state):
+    def forward(self, input_tensor, cur_state, inplace=False):
+        # inplace: update cur_state in place and reuse the concatenation buffer, only without autograd
         h_cur, c_cur = cur_state
 
-        combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
+        if inplace:
+            shape = (h_cur.shape[0], self.input_dim + self.hidden_dim) + h_cur.shape[2:]
+            if self._combined is None or self._combined.shape != shape or self._combined.device != h_cur.device:
+                self._combined = torch.empty(shape, dtype=h_cur.dtype, device=h_cur.device)
+            combined = torch.cat([input_tensor, h_cur], dim=1, out=self._combined)
+        else:
+            combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
 
         combined_conv = self.conv(combined)
-        cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1)
-        i = torch.sigmoid(cc_i)
-        f = torch.sigmoid(cc_f)
-        o = torch.sigmoid(cc_o)
-        g = torch.tanh(cc_g)
-
-        c_next = f * c_cur + i * g
-        h_next = o * torch.tanh(c_next)
+        # i, f, o in one sigmoid and g in one tanh
+        if inplace:
+            gates = combined_conv[:, :3 * self.hidden_dim].sigmoid_()
+            g = combined_conv[:, 3 * self.hidden_dim:].tanh_()
+        else:
+            gates = torch.sigmoid(combined_conv[:, :3 * self.hidden_dim])
+            g = torch.tanh(combined_conv[:, 3 * self.hidden_dim:])
+        i, f, o = torch.split(gates, self.hidden_dim, dim=1)
+
+        if inplace:
+            c_next = c_cur.mul_(f).addcmul_(i, g)
+            h_next = torch.tanh(c_next, out=h_cur).mul_(o)
+        else:
+            c_next = f * c_cur + i * g
+            h_next = o * torch.tanh(c_next)
 
         return h_next, c_next
 
-    def init_hidden(self, batch_size):
-        return (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).cuda(),
-                Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).cuda())
+    def init_hidden(self, batch_size, device=None):
+        return (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width, device=device)),
+                Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width, device=device)))
 
 
 def convgnrelu(in_channels, out_channels, kernel_size=3, stride=1, dilation=1, bias=True, group_channel=8):
@@ -100,7 +187,18 @@ def convgnrelu(in_channels, out_channels, kernel_size=3, stride=1, dilation=1, b
         nn.GroupNorm(int(max(1, out_channels / group_channel)), out_channels), nn.ReLU(inplace=True))
 
 
+def set_deform_backend(backend):
+    """ 'torchvision' runs DeformConv2d with torchvision.ops.deform_conv2d, 'native' with the gather implementation """
+    if backend not in ('torchvision', 'native'):
+        raise ValueError('unknown deformable convolution backend {}'.format(backend))
+    if backend == 'torchvision' and deform_conv2d is None:
+        raise ImportError('the torchvision deformable convolution backend needs torchvision')
+    DeformConv2d.backend = backend
+
+
 class DeformConv2d(nn.Module):
+    backend = 'native' if deform_conv2d is None else 'torchvision'
+
     def __init__(self, inc, outc, kernel_size=3, padding=1, stride=1, bias=None, modulation=True):
         """
         Args:
@@ -122,6 +220,8 @@ class DeformConv2d(nn.Module):
             self.m_conv = nn.Conv2d(inc, kernel_size * kernel_size, kernel_size=3, padding=1, stride=stride)
             nn.init.constant_(self.m_conv.weight, 0)
             self.m_conv.register_backward_hook(self._set_lr)
+        # p_0 + p_n of the native backend for the last offset size and tensor type
+        self._p_base_key, self._p_base = None, None
 
     @staticmethod
     def _set_lr(module, grad_input, grad_output):
@@ -129,6 +229,10 @@ class DeformConv2d(nn.Module):
         grad_output = (grad_output[i] * 0.1 for i in range(len(grad_output)))
 
     def forward(self, x):
+        # same sampling as the native backend: its zero padding of 1 is the zero outside of deform_conv2d
+        if self.backend == 'torchvision' and self.padding == 1 and self.kernel_size % 2 == 1:
+            return self._forward_torchvision(x)
+
         offset = self.p_conv(x)
         if self.modulation:
             m = torch.sigmoid(self.m_conv(x))
@@ -186,6 +290,16 @@ class DeformConv2d(nn.Module):
 
         return out
 
+    def _forward_torchvision(self, x):
+        offset = self.p_conv(x)
+        b, _, h, w = offset.size()
+        # (b, 2N, h, w): all row offsets then all column offsets -> (row, column) offset pairs of each kernel point
+        offset = offset.view(b, 2, -1, h, w).transpose(1, 2).reshape(b, -1, h, w)
+        m = torch.sigmoid(self.m_conv(x)) if self.modulation else None
+
+        return deform_conv2d(x, offset, self.conv.weight, self.conv.bias, stride=self.stride,
+                             padding=(self.kernel_size - 1) // 2, mask=m)
+
     def _get_p_n(self, N, dtype):
         p_n_x, p_n_y = torch.meshgrid(torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
             torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1))
@@ -207,11 +321,14 @@ class DeformConv2d(nn.Module):
     def _get_p(self, offset, dtype):
         N, h, w = offset.size(1) // 2, offset.size(2), offset.size(3)
 
-        # (1, 2N, 1, 1)
-        p_n = self._get_p_n(N, dtype)
-        # (1, 2N, h, w)
-        p_0 = self._get_p_0(h, w, N, dtype)
-        p = p_0 + p_n + offset
+        key = (h, w, dtype)
+        if key != self._p_base_key:
+            # (1, 2N, 1, 1)
+            p_n = self._get_p_n(N, dtype)
+            # (1, 2N, h, w)
+            p_0 = self._get_p_0(h, w, N, dtype)
+            self._p_base_key, self._p_base = key, p_0 + p_n
+        p = self._p_base + offset
         return p
 
     def _get_x_q(self, x, q, N):
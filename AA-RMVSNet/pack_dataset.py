@@ -0,0 +1,131 @@
+import argparse
+import multiprocessing as mp
+import os
+
+import numpy as np
+
+from datasets import find_dataset_def
+from datasets.data_io import create_packed_scan, commit_packed_scan
+
+# dataset of the worker process, set by init_worker
+_dataset = None
+
+
+def dtu_yao_files(datapath, scan, image_scale):
+    """ pair file, light conditions and image, depth and cam file names of a scan, as read by datasets/dtu_yao.py """
+    pair_file = os.path.join(datapath, 'Cameras/pair.txt')
+
+    def img_file(vid, light_idx):
+        # NOTE that the id in image file names is from 1 to 49 (not 0~48)
+        return os.path.join(datapath, 'Rectified/{}_train/rect_{:0>3}_{}_r5000.png'.format(scan, vid + 1, light_idx))
+
+    def depth_file(vid):
+        if image_scale == 1.0:
+            return os.path.join(datapath, '../640_depth/{}/depth_map_{:0>4}.pfm'.format(scan, vid))
+        elif image_scale == 0.5:
+            return os.path.join(datapath, '../320_depth/{}/depth_map_{:0>4}_4.pfm'.format(scan, vid))
+        return os.path.join(datapath, 'Depths/{}_train/depth_map_{:0>4}.pfm'.format(scan, vid))
+
+    def cam_file(vid):
+        return os.path.join(datapath, 'Cameras/train/{:0>8}_cam.txt').format(vid)
+
+    return pair_file, list(range(7)), img_file, depth_file, cam_file
+
+
+def dtu_yao_blend_files(datapath, scan, image_scale):
+    """ pair file, light conditions and image, depth and cam file names of a scan, as read by datasets/dtu_yao_blend.py """
+    pair_file = os.path.join(datapath, '{}/cams/pair.txt'.format(scan))
+
+    def img_file(vid, light_idx):
+        return os.path.join(datapath, '{}/blended_images/{:0>8}.jpg'.format(scan, vid))
+
+    def depth_file(vid):
+        return os.path.join(datapath, '{}/rendered_depth_maps/{:0>8}.pfm'.format(scan, vid))
+
+    def cam_file(vid):
+        return os.path.join(datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
+
+    # blendedmvs has a single light condition
+    return pair_file, [0], img_file, depth_file, cam_file
+
+
+SCAN_FILES = {'dtu_yao': dtu_yao_files, 'dtu_yao_blend': dtu_yao_blend_files}
+
+
+def read_pairs(pair_file):
+    pairs = []
+    with open(pair_file) as f:
+        num_viewpoint = int(f.readline())
+        for view_idx in range(num_viewpoint):
+            ref_view = int(f.readline().rstrip())
+            src_views = [int(x) for x in f.readline().rstrip().split()[1::2]]
+            pairs.append((ref_view, src_views))
+    return pairs
+
+
+def init_worker(dataset, datapath, listfile, image_scale):
+    global _dataset
+    # the dataset decodes images, depth maps and cams exactly as during training; interval_scale is applied when loading
+    _dataset = find_dataset_def(dataset)(datapath, listfile, 'train', 1, interval_scale=1, image_scale=image_scale)
+
+
+def pack_scan(dataset, datapath, outdir, scan, image_scale, depth_dtype):
+    """
+    pack the resized uint8 images of every light condition, the depth maps and the cams of a scan into
+    outdir/<scan>.bin and outdir/<scan>.json
+    :return: number of packed views and size of the packed file
+    """
+    pair_file, lights, img_file, depth_file, cam_file = SCAN_FILES[dataset](datapath, scan, image_scale)
+    pairs = read_pairs(pair_file)
+    views = sorted(set(vid for ref_view, src_views in pairs for vid in [ref_view] + src_views))
+
+    img = _dataset.load_img(img_file(views[0], lights[0]))
+    depth = _dataset.read_depth(depth_file(views[0]))
+    arrays = create_packed_scan(outdir, scan, {'images': ((len(views), len(lights)) + img.shape, 'u1'),
+                                               'depths': ((len(views),) + depth.shape, depth_dtype),
+                                               'intrinsics': ((len(views), 3, 3), 'f4'),
+                                               'extrinsics': ((len(views), 4, 4), 'f4'),
+                                               'depth_params': ((len(views), 2), 'f8')})
+    for row, vid in enumerate(views):
+        for light, light_idx in enumerate(lights):
+            img = _dataset.load_img(img_file(vid, light_idx))
+            if img.shape != arrays['images'].shape[2:]:
+                raise ValueError('{}: all images of a scan must have the same size'.format(img_file(vid, light_idx)))
+            arrays['images'][row, light] = img
+        arrays['depths'][row] = _dataset.read_depth(depth_file(vid))
+        intrinsics, extrinsics, depth_min, depth_interval = _dataset.read_cam_file(cam_file(vid))
+        arrays['intrinsics'][row] = intrinsics
+        arrays['extrinsics'][row] = extrinsics
+        arrays['depth_params'][row] = depth_min, depth_interval
+
+    commit_packed_scan(outdir, scan, arrays, {'dataset': dataset, 'image_scale': image_scale, 'views': views,
+                                              'lights': lights, 'pairs': pairs,
+                                              'depth_names': [depth_file(vid) for vid in views]})
+    return len(views), os.path.getsize(os.path.join(outdir, scan + '.bin'))
+
+
+def pack_scan_job(job):
+    return job[3], pack_scan(*job)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Pack the scans of a training list into memory-mapped files for datasets/packed.py')
+    parser.add_argument('--dataset', default='dtu_yao_blend', choices=sorted(SCAN_FILES), help='dataset to pack')
+    parser.add_argument('--datapath', help='train datapath')
+    parser.add_argument('--listfile', help='list of the scans to pack')
+    parser.add_argument('--outdir', help='directory of the packed scans, the --trainpath of the packed dataset')
+    parser.add_argument('--image_scale', type=float, default=0.25, help='image scale used for training')
+    parser.add_argument('--depth_dtype', default='float16', choices=['float16', 'float32'],
+                        help='dtype of the stored depth maps')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='processes used to pack scans')
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    with open(args.listfile) as f:
+        scans = [line.rstrip() for line in f.readlines() if line.strip()]
+    jobs = [(args.dataset, args.datapath, args.outdir, scan, args.image_scale, args.depth_dtype) for scan in scans]
+    with mp.Pool(max(min(args.workers, len(jobs)), 1), initializer=init_worker,
+                 initargs=(args.dataset, args.datapath, args.listfile, args.image_scale)) as pool:
+        for scan, (num_views, size) in pool.imap_unordered(pack_scan_job, jobs):
+            print('{}: {} views, {:.1f} MB'.format(scan, num_views, size / 2 ** 20))
@@ -9,6 +9,12 @@ inverse_depth=False
 image_scale=0.25
 view_num=5
 BLEND_TRAINING=blendedmvs/
+# faster loading: pack the training and validation scans once at image_scale, then train with
+# --dataset=packed --trainpath=blendedmvs_packed/
+# python pack_dataset.py --dataset=dtu_yao_blend --datapath=$BLEND_TRAINING --listfile=lists/blendedmvs/training_list.txt \
+#         --outdir=blendedmvs_packed/ --image_scale=$image_scale
+# python pack_dataset.py --dataset=dtu_yao_blend --datapath=$BLEND_TRAINING --listfile=lists/blendedmvs/validation_list.txt \
+#         --outdir=blendedmvs_packed/ --image_scale=$image_scale
 
 CUDA_VISIBLE_DEVICES=0,1,2
 python train.py  \
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from models import fine_band_depths
+
+
+@pytest.mark.parametrize('index', [0.0, 0.4, 31.0, 30.7, 15.0])
+@pytest.mark.parametrize('radius', [1.0, 6.0, 100.0])
+def test_fine_depths_are_distinct_at_the_range_ends(index, radius):
+    # inverse depth sampling, as the eval datasets
+    depth_values = (1.0 / torch.linspace(1.0, 0.2, 32)).view(1, 32)
+    index_map = torch.full((1, 2, 3), index)
+    fine_depths = fine_band_depths(depth_values, index_map, torch.full((1, 2, 3), radius), 1.0, 16)
+
+    assert fine_depths.shape == (1, 16, 2, 3)
+    assert (fine_depths[:, 1:] > fine_depths[:, :-1]).all()
+    assert fine_depths.min() >= depth_values.min() and fine_depths.max() <= depth_values.max() + 1e-5
+
+
+def test_fine_band_is_unchanged_inside_the_range():
+    depth_values = torch.linspace(1.0, 4.0, 32).view(1, 32)
+    fine_depths = fine_band_depths(depth_values, torch.full((1, 1, 1), 15.0), torch.full((1, 1, 1), 0.5), 2.0, 5)
+    expected = 1.0 + torch.linspace(13.0, 17.0, 5) * 3.0 / 31
+    torch.testing.assert_close(fine_depths.view(5), expected)
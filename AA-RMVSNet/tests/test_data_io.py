@@ -0,0 +1,131 @@
+import importlib.util
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from datasets import data_io
+from datasets.data_io import read_bin, save_bin, read_bin_batch, save_bin_batch
+
+
+def load_cas_utils():
+    # the PFM readers of CasMVSNet+Transformer/datasets/utils.py, loaded alone since the CasMVSNet datasets package
+    # imports the whole CasMVSNet dataset stack
+    path = os.path.join(os.path.dirname(__file__), '..', '..', 'CasMVSNet+Transformer', 'datasets', 'utils.py')
+    spec = importlib.util.spec_from_file_location('cas_datasets_utils', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def old_read_bin(path):
+    # the byte-by-byte reader the vectorized read_bin replaced
+    with open(path, 'rb') as fid:
+        width, height, channels = np.genfromtxt(fid, delimiter='&', max_rows=1, usecols=(0, 1, 2), dtype=int)
+        fid.seek(0)
+        num_delimiter = 0
+        byte = fid.read(1)
+        while True:
+            if byte == b'&':
+                num_delimiter += 1
+                if num_delimiter >= 3:
+                    break
+            byte = fid.read(1)
+        data = np.fromfile(fid, np.float32)
+    data = data.reshape((width, height, channels), order='F')
+    return np.transpose(data, (1, 0, 2))
+
+
+def old_save_bin(filename, data):
+    # the struct.pack writer the vectorized save_bin replaced
+    if len(data.shape) == 2:
+        height, width = data.shape
+        channels = 1
+    else:
+        height, width, channels = data.shape
+    with open(filename, 'w') as fid:
+        fid.write(str(width) + '&' + str(height) + '&' + str(channels) + '&')
+    with open(filename, 'ab') as fid:
+        if len(data.shape) == 2:
+            image_trans = np.transpose(data, (1, 0))
+        else:
+            image_trans = np.transpose(data, (1, 0, 2))
+        data_list = image_trans.reshape(-1, order='F').tolist()
+        fid.write(struct.pack('<' + 'f' * len(data_list), *data_list))
+
+
+def depth_maps():
+    rng = np.random.RandomState(0)
+    volume = rng.rand(3, 41, 57).astype(np.float32)
+    yield 'hw', rng.rand(23, 31).astype(np.float32)
+    yield 'hw1', rng.rand(23, 31, 1).astype(np.float32)
+    yield 'hw3', rng.rand(23, 31, 3).astype(np.float32)
+    yield 'transposed_hw', rng.rand(31, 23).astype(np.float32).T
+    yield 'strided_hw', rng.rand(46, 62).astype(np.float32)[::2, 1::2]
+    yield 'channels_first_hw3', volume.transpose(1, 2, 0)
+    yield 'sliced_hw1', volume[1:2, 3:, :50].transpose(1, 2, 0)
+
+
+@pytest.mark.parametrize('name,data', list(depth_maps()))
+def test_bin_round_trip_matches_old_implementation(tmp_path, name, data):
+    new_path, old_path = str(tmp_path / 'new.bin'), str(tmp_path / 'old.bin')
+    save_bin(new_path, data)
+    old_save_bin(old_path, data)
+    with open(new_path, 'rb') as new_file, open(old_path, 'rb') as old_file:
+        assert new_file.read() == old_file.read()
+
+    expected = old_read_bin(old_path)
+    assert expected.shape == data.reshape(data.shape[0], data.shape[1], -1).shape
+    for read in (read_bin(old_path), read_bin(new_path)):
+        assert read.shape == expected.shape
+        np.testing.assert_array_equal(read, expected)
+
+
+def test_bin_batch_round_trip(tmp_path):
+    names, maps = zip(*depth_maps())
+    paths = [str(tmp_path / '{}.bin'.format(name)) for name in names]
+    save_bin_batch(paths, list(maps), workers=3)
+    for path, data, read in zip(paths, maps, read_bin_batch(paths, workers=3)):
+        np.testing.assert_array_equal(read, old_read_bin(path))
+        np.testing.assert_array_equal(read, data.reshape(read.shape))
+
+
+def write_pfm(path, data, endian, scale=2.5):
+    # a PFM file of a (H, W) or (H, W, 3) map with the given byte order, whatever the byte order of the machine
+    with open(path, 'wb') as fid:
+        fid.write(b'PF\n' if data.ndim == 3 else b'Pf\n')
+        fid.write('{} {}\n'.format(data.shape[1], data.shape[0]).encode('utf-8'))
+        fid.write('{:f}\n'.format(-scale if endian == '<' else scale).encode('utf-8'))
+        fid.write(np.flipud(data).astype(endian + 'f4').tobytes())
+
+
+@pytest.mark.parametrize('module', ['aa', 'cas'])
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('color', [False, True])
+def test_pfm_mmap_matches_read_pfm(tmp_path, module, endian, color):
+    io = data_io if module == 'aa' else load_cas_utils()
+    rng = np.random.RandomState(0)
+    maps = [rng.rand(*((19, 27, 3) if color else (19, 27))).astype(np.float32) for _ in range(3)]
+    paths = [str(tmp_path / '{}.pfm'.format(i)) for i in range(len(maps))]
+    for path, data in zip(paths, maps):
+        write_pfm(path, data, endian)
+
+    roi = (3, 15, 5, 22)
+    for path, data in zip(paths, maps):
+        expected, expected_scale = io.read_pfm(path)
+        np.testing.assert_array_equal(expected, data)
+        read, scale = io.read_pfm_mmap(path)
+        assert read.shape == expected.shape and read.dtype == expected.dtype and scale == expected_scale
+        np.testing.assert_array_equal(read, expected)
+        read, scale = io.read_pfm_mmap(path, roi)
+        assert read.dtype == expected.dtype and scale == expected_scale
+        np.testing.assert_array_equal(read, expected[3:15, 5:22])
+
+    for roi in (None, (3, 15, 5, 22)):
+        for read, path in zip(io.read_pfm_batch(paths, roi), paths):
+            expected = io.read_pfm(path)[0]
+            if roi is not None:
+                expected = expected[3:15, 5:22]
+            assert read.shape == expected.shape and read.dtype == expected.dtype
+            np.testing.assert_array_equal(read, expected)
@@ -0,0 +1,30 @@
+import threading
+
+import pytest
+
+from utils import Prefetcher
+
+
+def test_prefetcher_yields_every_batch():
+    prefetcher = Prefetcher(range(10), depth=2)
+    assert list(prefetcher) == list(range(10))
+    assert prefetcher.stats()['batches'] == 10
+
+
+def test_prefetcher_stops_with_the_consumer():
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        for batch in Prefetcher(range(1000), depth=2):
+            if batch == 3:
+                raise RuntimeError('model failed')
+    # the producer was blocked on the full queue, it must have given up
+    assert threading.active_count() == threads
+
+
+def test_prefetcher_raises_loader_errors():
+    def loader():
+        yield 0
+        raise IOError('unreadable image')
+
+    with pytest.raises(IOError):
+        list(Prefetcher(loader(), depth=2))
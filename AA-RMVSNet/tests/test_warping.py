@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from benchmark import synthetic_scene
+from models import AARMVSNet
+from models.module import homo_warping_depthwise, DepthwiseWarper
+
+
+def test_chunk_grid_matches_homo_warping_depthwise():
+    torch.manual_seed(0)
+    _, proj_matrices, depth_values, _ = synthetic_scene(2, 3, 32, 40, 8)
+    features = torch.rand(2, 3, 16, 32, 40)
+    projs = torch.unbind(proj_matrices, 1)
+    src_features = [features[:, view] for view in range(1, 3)]
+
+    warper = DepthwiseWarper(projs[1:], projs[0], 32, 40)
+    grid = warper.chunk_grid(depth_values)
+    warped = F.grid_sample(torch.cat(src_features, 0), grid, mode='bilinear', padding_mode='zeros')
+    warped = warped.view(2, 2, 16, 8, 32, 40)
+
+    for view, src_fea in enumerate(src_features):
+        for d in range(depth_values.shape[1]):
+            expected = homo_warping_depthwise(src_fea, projs[view + 1], projs[0], depth_values[:, d])
+            np.testing.assert_allclose(warped[view, :, :, d].numpy(), expected.numpy(), atol=1e-3)
+
+
+def test_training_sweep_backward():
+    torch.manual_seed(0)
+    model = AARMVSNet(image_scale=1.0, max_h=32, max_w=40).train()
+    imgs, proj_matrices, depth_values, _ = synthetic_scene(1, 3, 32, 40, 4)
+    imgs.requires_grad_(True)
+    model(imgs, proj_matrices, depth_values)['prob_volume'].sum().backward()
+    assert torch.isfinite(imgs.grad).all()
+
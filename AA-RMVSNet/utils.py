@@ -1,4 +1,11 @@
+import collections
 import numpy as np
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
 import torchvision.utils as vutils
 import torch
 import torch.nn.functional
@@ -66,6 +73,30 @@ def tocuda(vars):
         raise NotImplementedError("invalid input type {} for tensor2numpy".format(type(vars)))
 
 
+# move the tensors of nested dict/list/tuple variables to device, tocuda for any torch device
+def todevice(vars, device):
+    @make_recursive_func
+    def move(vars):
+        if isinstance(vars, torch.Tensor):
+            return vars.to(device, non_blocking=True)
+        elif isinstance(vars, str):
+            return vars
+        else:
+            raise NotImplementedError("invalid input type {} for todevice".format(type(vars)))
+
+    return move(vars)
+
+
+# torch device of the --device option; threads > 0 sets the intra-op threads used by the cpu kernels
+def setup_device(device, threads=0):
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError('--device {} but cuda is not available, use --device cpu'.format(device))
+    if threads > 0:
+        torch.set_num_threads(threads)
+    return device
+
+
 def save_scalars(logger, mode, scalar_dict, global_step):
     scalar_dict = tensor2float(scalar_dict)
     for key, value in scalar_dict.items():
@@ -121,6 +152,191 @@ class DictAverageMeter(object):
         return {k: v / self.count for k, v in self.data.items()}
 
 
+# iterate a DataLoader in a background thread, keeping up to depth batches ready while the model runs;
+# stall_time is the time the consumer waited for a batch (input-bound when it is a large part of the run).
+# Prefetcher and AsyncWriter are the same in AA-RMVSNet/utils.py and CasMVSNet+Transformer/pipeline.py, change both
+class Prefetcher(object):
+    def __init__(self, loader, depth=2):
+        self.loader = loader
+        self.depth = depth
+        self.batches = 0
+        self.stall_time = 0.0
+        self.ready = 0  # sum of the batches ready at each request
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(max(self.depth, 1))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # False once the consumer stopped, it will not take another batch
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(batch):
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.ready += batches.qsize()
+                start = time.time()
+                batch = batches.get()
+                self.stall_time += time.time() - start
+                if batch is done:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                self.batches += 1
+                yield batch
+        finally:
+            # also when the consumer stops early, e.g. on an exception in the model loop
+            stop.set()
+            thread.join()
+
+    def stats(self):
+        return {'batches': self.batches, 'input_stall_s': round(self.stall_time, 3),
+                'mean_ready': round(self.ready / max(self.batches, 1), 2)}
+
+
+# run save functions in a background thread fed by a queue of at most depth pending outputs;
+# stall_time is the time the producer waited for a free slot (output-bound when it is large)
+class AsyncWriter(object):
+    def __init__(self, depth=8):
+        self.queue = queue.Queue(max(depth, 1))
+        self.outputs = 0
+        self.stall_time = 0.0
+        self.pending = 0  # sum of the pending outputs at each put
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    item[0](*item[1])
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.pending += self.queue.qsize()
+        start = time.time()
+        self.queue.put((func, args))
+        self.stall_time += time.time() - start
+        self.outputs += 1
+
+    def close(self):
+        # wait until every output is written
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        return {'outputs': self.outputs, 'output_stall_s': round(self.stall_time, 3),
+                'mean_pending': round(self.pending / max(self.outputs, 1), 2)}
+
+
+# feature maps of the views of a scan keyed by the view keys of the eval datasets, so each image is encoded once and
+# not once per pair; kept on device (where they are computed if None), the least recently used features beyond
+# max_bytes are dropped, or spilled to spill_dir as float16
+class FeatureCache(object):
+    def __init__(self, max_bytes, device=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.spill_dir = tempfile.mkdtemp(prefix='features_', dir=spill_dir) if spill_dir is not None else None
+        self.features = collections.OrderedDict()
+        self.spilled = {}
+        self.nbytes = 0
+        self.spill_count = 0
+        self.hits, self.misses, self.spill_hits = 0, 0, 0
+
+    def get(self, key):
+        # the cached feature map of key (C, H, W), None if it is not cached
+        if key in self.features:
+            self.features.move_to_end(key)
+            self.hits += 1
+            return self.features[key]
+        if key in self.spilled:
+            self.spill_hits += 1
+            path = self.spilled.pop(key)
+            feature = torch.from_numpy(np.load(path).astype(np.float32))
+            # spilled again under a new name if it is evicted again
+            os.remove(path)
+            self.put(key, feature)
+            return self.features[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, feature):
+        # feature: (C, H, W)
+        feature = feature.detach() if self.device is None else feature.detach().to(self.device)
+        self.features[key] = feature
+        self.nbytes += feature.numel() * feature.element_size()
+        while self.nbytes > self.max_bytes and len(self.features) > 1:
+            old_key, old_feature = self.features.popitem(last=False)
+            self.nbytes -= old_feature.numel() * old_feature.element_size()
+            if self.spill_dir is not None:
+                self.spilled[old_key] = os.path.join(self.spill_dir, '{}.npy'.format(self.spill_count))
+                self.spill_count += 1
+                np.save(self.spilled[old_key], old_feature.cpu().numpy().astype(np.float16))
+
+    def encode(self, feature_net, imgs, view_keys):
+        """
+        feature maps of a batch, only the images that are not cached are encoded
+        :param feature_net: the feature network of the model, FeatNet
+        :param imgs: (B, V, 3, H, W) images of the batch
+        :param view_keys: V lists of the B view keys of the batch, as collated from the samples
+        :return: V feature maps (B, C, H, W) on the device of imgs, the features input of AARMVSNet
+        """
+        features = {}
+        missing = {}
+        for v, keys in enumerate(view_keys):
+            for b, key in enumerate(keys):
+                if key not in features and key not in missing:
+                    feature = self.get(key)
+                    if feature is None:
+                        missing[key] = (b, v)
+                    else:
+                        features[key] = feature
+        if missing:
+            # the new images of the batch in one forward
+            new_features = feature_net(torch.stack([imgs[b, v] for b, v in missing.values()]))
+            for key, feature in zip(missing, new_features):
+                features[key] = feature
+                self.put(key, feature)
+        return [torch.stack([features[key].to(imgs.device) for key in keys]) for keys in view_keys]
+
+    def close(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'spill_hits': self.spill_hits,
+                'cached_mb': round(self.nbytes / 2 ** 20, 1), 'spilled': len(self.spilled)}
+
+
 # a wrapper to compute metrics for each image individually
 def compute_metrics_for_each_image(metric_func):
     def wrapper(depth_est, depth_gt, mask, *args):
@@ -1,5 +1,5 @@
 from torch.utils.data import Dataset
-from .utils import read_pfm
+from .utils import read_pfm_mmap, read_cam_params
 import os
 import numpy as np
 from collections import defaultdict
@@ -80,16 +80,10 @@ class BlendedMVSDataset(Dataset):
                 self.proj_mats[scan][vid] = (proj_mat_ls, depth_min)
 
     def read_cam_file(self, scan, filename):
-        with open(filename) as f:
-            lines = [line.rstrip() for line in f.readlines()]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ')
-        extrinsics = extrinsics.reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ')
-        intrinsics = intrinsics.reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
+        depth_min = depth_params[0]
         if scan not in self.scale_factors:
             # use the first cam to determine scale factor
             self.scale_factors[scan] = 100 / depth_min
@@ -99,7 +93,7 @@ class BlendedMVSDataset(Dataset):
         return intrinsics, extrinsics, depth_min
 
     def read_depth_and_mask(self, scan, filename, depth_min):
-        depth = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth = np.array(read_pfm_mmap(filename)[0], dtype=np.float32)
         depth *= self.scale_factors[scan]
         if self.img_wh is not None:
             depth_0 = cv2.resize(depth, self.img_wh, interpolation=cv2.INTER_NEAREST)
@@ -0,0 +1,42 @@
+from torch.utils.data import Sampler
+
+
+def sample_shape(dataset, idx):
+    """Number of views, height and width of the images of a sample, from the metas of the dataset.
+    Every dataset resizes its images to img_wh, so only the number of source views can differ."""
+    if dataset.img_wh is None:
+        raise ValueError('img_wh must be set to batch the samples of a dataset')
+    scan, _, ref_view, src_views = dataset.metas[idx]
+    view_ids = [ref_view] + src_views[:dataset.n_views - 1]
+    return len(view_ids), dataset.img_wh[1], dataset.img_wh[0]
+
+
+def sample_bytes(shape, n_depths):
+    """Rough memory of a sample: its float32 images and one float32 volume of n_depths at the image size."""
+    views, height, width = shape
+    return 4 * height * width * (3 * views + n_depths)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of the samples of the same shape, as many as fit in max_bytes (at least one).
+    Batches are yielded in the order of their first sample."""
+
+    def __init__(self, dataset, max_bytes, n_depths, max_batch_size=None, indices=None):
+        if indices is None:
+            indices = range(len(dataset))
+        buckets = {}
+        for idx in indices:
+            buckets.setdefault(sample_shape(dataset, idx), []).append(idx)
+        self.batches = []
+        for shape, bucket in buckets.items():
+            batch_size = max(int(max_bytes // sample_bytes(shape, n_depths)), 1)
+            if max_batch_size is not None:
+                batch_size = min(batch_size, max_batch_size)
+            self.batches += [bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size)]
+        self.batches.sort(key=lambda batch: batch[0])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -1,5 +1,5 @@
 from torch.utils.data import Dataset
-from .utils import read_pfm
+from .utils import read_pfm_mmap, read_cam_params
 import os
 import numpy as np
 import cv2
@@ -72,20 +72,14 @@ class DTUDataset(Dataset):
         self.proj_mats = proj_mats
 
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = [line.rstrip() for line in f.readlines()]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ')
-        extrinsics = extrinsics.reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ')
-        intrinsics = intrinsics.reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
+        depth_min = depth_params[0]
         return intrinsics, extrinsics, depth_min
 
     def read_depth(self, filename):
-        depth = np.array(read_pfm(filename)[0], dtype=np.float32)  # (1200, 1600)
+        depth = np.array(read_pfm_mmap(filename)[0], dtype=np.float32)  # (1200, 1600)
         if self.img_wh is None:
             depth = cv2.resize(depth, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_NEAREST)  # (600, 800)
             depth_0 = depth[44:556, 80:720]  # (512, 640)
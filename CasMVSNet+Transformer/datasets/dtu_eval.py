@@ -1,5 +1,5 @@
 from torch.utils.data import Dataset
-from .utils import read_pfm
+from .utils import read_pfm, read_cam_params
 import os
 import numpy as np
 import cv2
@@ -70,16 +70,10 @@ class DTUEvalDataset(Dataset):
         self.proj_mats = proj_mats
 
     def read_cam_file(self, filename):
-        with open(filename) as f:
-            lines = [line.rstrip() for line in f.readlines()]
-        # extrinsics: line [1,5), 4x4 matrix
-        extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ')
-        extrinsics = extrinsics.reshape((4, 4))
-        # intrinsics: line [7-10), 3x3 matrix
-        intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ')
-        intrinsics = intrinsics.reshape((3, 3))
+        # from the cams.npy bundle of the cam directory if there is one, else from the text file
+        intrinsics, extrinsics, depth_params = read_cam_params(filename)
         # depth_min & depth_interval: line 11
-        depth_min = float(lines[11].split()[0])
+        depth_min = depth_params[0]
         return intrinsics, extrinsics, depth_min
 
     def define_transforms(self):
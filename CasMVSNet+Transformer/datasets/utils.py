@@ -1,10 +1,12 @@
 import numpy as np
+import os
 import re
 import sys
 
 
-def read_pfm(filename):
-    file = open(filename, 'rb')
+def read_pfm_header(file):
+    """Reads the header of a PFM file opened in binary mode, up to the payload.
+    Returns the map shape (HxW or HxWx3), the dtype of the payload and the scale."""
     color = None
     width = None
     height = None
@@ -32,8 +34,15 @@ def read_pfm(filename):
     else:
         endian = '>'  # big-endian
 
-    data = np.fromfile(file, endian + 'f')
     shape = (height, width, 3) if color else (height, width)
+    return shape, endian + 'f', scale
+
+
+def read_pfm(filename):
+    file = open(filename, 'rb')
+    shape, dtype, scale = read_pfm_header(file)
+
+    data = np.fromfile(file, dtype)
 
     data = np.reshape(data, shape)
     data = np.flipud(data)
@@ -41,6 +50,25 @@ def read_pfm(filename):
     return data, scale
 
 
+def read_pfm_mmap(filename, roi=None):
+    """Like read_pfm, but returns a flipped copy-on-write view of the memory-mapped payload instead of a copy.
+    With roi=(top, bottom, left, right) only that region of the map is read, into a new array."""
+    with open(filename, 'rb') as file:
+        shape, dtype, scale = read_pfm_header(file)
+        offset = file.tell()
+    data = np.flipud(np.memmap(filename, dtype=dtype, mode='c', offset=offset, shape=shape)).view(np.ndarray)
+    if roi is not None:
+        top, bottom, left, right = roi
+        data = np.array(data[top:bottom, left:right])
+    return data, scale
+
+
+def read_pfm_batch(filenames, roi=None):
+    """Reads the maps of several PFM files (e.g. the source views of a reference view) with read_pfm_mmap.
+    Returns the list of maps, without the scales."""
+    return [read_pfm_mmap(filename, roi)[0] for filename in filenames]
+
+
 def save_pfm(filename, image, scale=1):
     file = open(filename, "wb")
     color = None
@@ -69,3 +97,49 @@ def save_pfm(filename, image, scale=1):
 
     image.tofile(file)
     file.close()
+
+
+# per-scan camera bundle, same layout as AA-RMVSNet/datasets/data_io.py which writes it
+CAM_BUNDLE_FILE = 'cams.npy'
+CAM_BUNDLE_DTYPE = np.dtype([('view', '<i8'), ('extrinsics', '<f4', (4, 4)), ('intrinsics', '<f4', (3, 3)),
+                             ('depth', '<f8', (4,))])
+_cam_bundles = {}
+
+
+def read_cam_text(filename):
+    """Returns intrinsics (3x3), extrinsics (4x4) and the values of the depth line of a cam text file."""
+    with open(filename) as f:
+        lines = [line.rstrip() for line in f.readlines()]
+    # extrinsics: line [1,5), 4x4 matrix
+    extrinsics = np.fromstring(' '.join(lines[1:5]), dtype=np.float32, sep=' ').reshape((4, 4))
+    # intrinsics: line [7-10), 3x3 matrix
+    intrinsics = np.fromstring(' '.join(lines[7:10]), dtype=np.float32, sep=' ').reshape((3, 3))
+    # depth_min & depth_interval: line 11
+    depth_params = [float(x) for x in lines[11].split()]
+    return intrinsics, extrinsics, depth_params
+
+
+def read_cam_bundle(cam_dir):
+    """Memory-maps cam_dir/cams.npy once per process; None if there is no bundle."""
+    if cam_dir not in _cam_bundles:
+        path = os.path.join(cam_dir, CAM_BUNDLE_FILE)
+        if os.path.exists(path):
+            bundle = np.load(path, mmap_mode='r')
+            _cam_bundles[cam_dir] = (bundle, {int(view): i for i, view in enumerate(bundle['view'])})
+        else:
+            _cam_bundles[cam_dir] = None
+    return _cam_bundles[cam_dir]
+
+
+def read_cam_params(filename):
+    """Reads <cam_dir>/<view:08d>_cam.txt from the bundle of cam_dir, or from the text file if it is not bundled.
+    Returns intrinsics (3x3), extrinsics (4x4) and the depth params (depth_min, depth_interval, ...)."""
+    cam_dir, name = os.path.split(filename)
+    bundle = read_cam_bundle(cam_dir)
+    view = name.split('_')[0]
+    if bundle is not None and view.isdigit() and int(view) in bundle[1]:
+        record = bundle[0][bundle[1][int(view)]]
+        depth = record['depth']
+        return np.array(record['intrinsics']), np.array(record['extrinsics']), \
+            [float(d) for d in depth[~np.isnan(depth)]]
+    return read_cam_text(filename)
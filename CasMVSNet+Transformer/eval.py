@@ -1,7 +1,10 @@
 from datasets import dataset_dict
-from datasets.utils import save_pfm, read_pfm
+from datasets.utils import save_pfm, read_pfm_mmap
+from datasets.bucketing import BucketBatchSampler
+from pipeline import Prefetcher, AsyncWriter
 import cv2
 import torch
+from torch.utils.data import DataLoader
 import os, shutil
 import numpy as np
 from tqdm import tqdm
@@ -9,6 +12,7 @@ from argparse import ArgumentParser
 
 # for depth prediction
 from models.mvsnet import CascadeMVSNet
+from models.modules import set_deform_backend
 from utils import load_ckpt
 
 # for point cloud fusion
@@ -44,6 +48,13 @@ def get_opts():
                         help='pretrained checkpoint path to load')
     parser.add_argument('--save_visual', default=False, action='store_true',
                         help='save depth and proba visualization or not')
+    parser.add_argument('--bucket_mb', type=int, default=0,
+                        help='batch views of the same shape up to about this many MB per batch, 0 for one view per batch')
+    parser.add_argument('--num_workers', type=int, default=4, help='processes loading the views')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches loaded ahead while the model runs')
+    parser.add_argument('--write_queue', type=int, default=8, help='views waiting to be saved before the model waits')
+    parser.add_argument('--deform_backend', type=str, default=None, choices=['torchvision', 'native'],
+                        help='deformable convolution backend, torchvision if it is installed by default')
 
     # for point cloud fusion
     parser.add_argument('--conf', type=float, default=0.25, help='min confidence for pixel to be valid')
@@ -62,10 +73,13 @@ def get_opts():
 def decode_batch(batch):
     imgs = batch['imgs']
     proj_mats = batch['proj_mats']
-    init_depth_min = batch['init_depth_min'].item()
-    depth_interval = batch['depth_interval'].item()
-    scan, vid = batch['scan_vid']
-    return imgs, proj_mats, init_depth_min, depth_interval, scan, vid
+    init_depth_min = batch['init_depth_min']
+    depth_interval = batch['depth_interval']
+    if len(imgs) == 1:  # a single view as floats, (B, 1) tensors otherwise
+        init_depth_min = init_depth_min.item()
+        depth_interval = depth_interval.item()
+    scans, vids = batch['scan_vid']
+    return imgs, proj_mats, init_depth_min, depth_interval, scans, vids.tolist()
 
 
 # define read_image and read_proj_mat for each dataset
@@ -171,6 +185,8 @@ if __name__ == "__main__":
         scans = dataset.scans
 
     # Step 1. Create depth estimation and probability for each scan
+    if args.deform_backend is not None:
+        set_deform_backend(args.deform_backend)
     model = CascadeMVSNet(n_depths=args.n_depths, interval_ratios=args.interval_ratios, num_groups=args.num_groups)
     device = 'cpu' if args.cpu else 'cuda:0'
     model.to(device)
@@ -183,20 +199,14 @@ if __name__ == "__main__":
         data_range = [i for i, x in enumerate(dataset.metas) if x[0] == args.scan]
     else:
         data_range = range(len(dataset))
-    for i in tqdm(data_range):
-        imgs, proj_mats, init_depth_min, depth_interval, scan, vid = decode_batch(dataset[i])
+    # views of the same shape are batched up to --bucket_mb; the next batches are loaded by the workers while the
+    # model runs and the outputs are saved per view in the background
+    batch_sampler = BucketBatchSampler(dataset, args.bucket_mb << 20, max(args.n_depths), indices=data_range)
+    loader = Prefetcher(DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.num_workers), args.prefetch)
+    writer = AsyncWriter(args.write_queue)
 
+    def save_outputs(scan, vid, depth, proba):
         os.makedirs(os.path.join(depth_dir, scan), exist_ok=True)
-
-        with torch.no_grad():
-            imgs = imgs.unsqueeze(0).to(device)
-            proj_mats = proj_mats.unsqueeze(0).to(device)
-            results = model(imgs, proj_mats, init_depth_min, depth_interval)
-
-        depth = results['depth_0'][0].cpu().numpy()
-        depth = np.nan_to_num(depth)  # change nan to 0
-        proba = results['confidence_2'][0].cpu().numpy()  # NOTE: this is 1/4 scale!
-        proba = np.nan_to_num(proba)  # change nan to 0
         save_pfm(os.path.join(depth_dir, f'{scan}/depth_{vid:04d}.pfm'), depth)
         save_pfm(os.path.join(depth_dir, f'{scan}/proba_{vid:04d}.pfm'), proba)
         if args.save_visual:
@@ -208,7 +218,27 @@ if __name__ == "__main__":
             cv2.imwrite(os.path.join(depth_dir, f'{scan}/depth_visual_{vid:04d}.jpg'), depth_img)
             cv2.imwrite(os.path.join(depth_dir, f'{scan}/proba_visual_{vid:04d}.jpg'),
                         (255 * (proba > args.conf)).astype(np.uint8))
+
+    for batch in tqdm(loader):
+        imgs, proj_mats, init_depth_min, depth_interval, scans, vids = decode_batch(batch)
+
+        with torch.no_grad():
+            imgs = imgs.to(device)
+            proj_mats = proj_mats.to(device)
+            if torch.is_tensor(init_depth_min):
+                init_depth_min = init_depth_min.to(device)
+                depth_interval = depth_interval.to(device)
+            results = model(imgs, proj_mats, init_depth_min, depth_interval)
+
+        for b, (scan, vid) in enumerate(zip(scans, vids)):
+            depth = results['depth_0'][b].cpu().numpy()
+            depth = np.nan_to_num(depth)  # change nan to 0
+            proba = results['confidence_2'][b].cpu().numpy()  # NOTE: this is 1/4 scale!
+            proba = np.nan_to_num(proba)  # change nan to 0
+            writer.put(save_outputs, scan, vid, depth, proba)
         del imgs, proj_mats, results
+    writer.close()
+    print('pipeline:', loader.stats(), writer.stats())
     del model
     torch.cuda.empty_cache()
     ###################################################################################
@@ -237,10 +267,10 @@ if __name__ == "__main__":
                     image_ref = read_image(args.dataset_name, args.root_dir, scan, ref_vid)
                     image_ref = cv2.resize(image_ref, tuple(args.img_wh), interpolation=cv2.INTER_LINEAR)[:, :,
                                 ::-1]  # to RGB
-                    depth_ref = read_pfm(f'results/{args.dataset_name}/depth/' \
-                                         f'{scan}/depth_{ref_vid:04d}.pfm')[0]
-                proba_ref = read_pfm(f'results/{args.dataset_name}/depth/' \
-                                     f'{scan}/proba_{ref_vid:04d}.pfm')[0]
+                    depth_ref = read_pfm_mmap(f'results/{args.dataset_name}/depth/' \
+                                              f'{scan}/depth_{ref_vid:04d}.pfm')[0]
+                proba_ref = read_pfm_mmap(f'results/{args.dataset_name}/depth/' \
+                                          f'{scan}/proba_{ref_vid:04d}.pfm')[0]
                 proba_ref = cv2.resize(proba_ref, None, fx=4, fy=4, interpolation=cv2.INTER_LINEAR)
                 mask_conf = proba_ref > args.conf  # confidence mask
                 P_world2ref = read_proj_mat(args.dataset_name, dataset, scan, ref_vid)
@@ -258,8 +288,9 @@ if __name__ == "__main__":
                         image_src = read_image(args.dataset_name, args.root_dir, scan, src_vid)
                         image_src = cv2.resize(image_src, tuple(args.img_wh), interpolation=cv2.INTER_LINEAR)[:, :,
                                     ::-1]  # to RGB
-                        depth_src = read_pfm(f'results/{args.dataset_name}/depth/' \
-                                             f'{scan}/depth_{src_vid:04d}.pfm')[0]
+                        # cached as a copy, a memory map would keep its file open until the end of the scan
+                        depth_src = np.array(read_pfm_mmap(f'results/{args.dataset_name}/depth/' \
+                                                           f'{scan}/depth_{src_vid:04d}.pfm')[0])
                         depth_refined[src_vid] = depth_src
                     P_world2src = read_proj_mat(args.dataset_name, dataset, scan, src_vid)
                     depth_ref_reproj, mask_geo, image_src2ref = check_geo_consistency(depth_ref, P_world2ref, depth_src,
@@ -4,6 +4,11 @@ import torch.nn.functional as F
 from kornia.utils import create_meshgrid
 from einops import reduce, rearrange, repeat
 
+try:
+    from torchvision.ops import deform_conv2d
+except ImportError:  # no torchvision, DeformConv2d uses its native backend
+    deform_conv2d = None
+
 
 class ConvBnReLU(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size=3, stride=1, pad=1):
@@ -36,7 +41,18 @@ def convgnrelu(in_channels, out_channels, kernel_size=3, stride=1, dilation=1, b
     )
 
 
+def set_deform_backend(backend):
+    """ 'torchvision' runs DeformConv2d with torchvision.ops.deform_conv2d, 'native' with the gather implementation """
+    if backend not in ('torchvision', 'native'):
+        raise ValueError('unknown deformable convolution backend {}'.format(backend))
+    if backend == 'torchvision' and deform_conv2d is None:
+        raise ImportError('the torchvision deformable convolution backend needs torchvision')
+    DeformConv2d.backend = backend
+
+
 class DeformConv2d(nn.Module):
+    backend = 'native' if deform_conv2d is None else 'torchvision'
+
     def __init__(self, inc, outc, kernel_size=3, padding=1, stride=1, bias=None, modulation=True):
         """
         Args:
@@ -58,6 +74,8 @@ class DeformConv2d(nn.Module):
             self.m_conv = nn.Conv2d(inc, kernel_size * kernel_size, kernel_size=3, padding=1, stride=stride)
             nn.init.constant_(self.m_conv.weight, 0)
             self.m_conv.register_backward_hook(self._set_lr)
+        # p_0 + p_n of the native backend for the last offset size and tensor type
+        self._p_base_key, self._p_base = None, None
 
     @staticmethod
     def _set_lr(module, grad_input, grad_output):
@@ -65,6 +83,10 @@ class DeformConv2d(nn.Module):
         grad_output = (grad_output[i] * 0.1 for i in range(len(grad_output)))
 
     def forward(self, x):
+        # same sampling as the native backend: its zero padding of 1 is the zero outside of deform_conv2d
+        if self.backend == 'torchvision' and self.padding == 1 and self.kernel_size % 2 == 1:
+            return self._forward_torchvision(x)
+
         offset = self.p_conv(x)
         if self.modulation:
             m = torch.sigmoid(self.m_conv(x))
@@ -122,6 +144,16 @@ class DeformConv2d(nn.Module):
 
         return out
 
+    def _forward_torchvision(self, x):
+        offset = self.p_conv(x)
+        b, _, h, w = offset.size()
+        # (b, 2N, h, w): all row offsets then all column offsets -> (row, column) offset pairs of each kernel point
+        offset = offset.view(b, 2, -1, h, w).transpose(1, 2).reshape(b, -1, h, w)
+        m = torch.sigmoid(self.m_conv(x)) if self.modulation else None
+
+        return deform_conv2d(x, offset, self.conv.weight, self.conv.bias, stride=self.stride,
+                             padding=(self.kernel_size - 1) // 2, mask=m)
+
     def _get_p_n(self, N, dtype):
         p_n_x, p_n_y = torch.meshgrid(torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1),
             torch.arange(-(self.kernel_size - 1) // 2, (self.kernel_size - 1) // 2 + 1))
@@ -143,11 +175,14 @@ class DeformConv2d(nn.Module):
     def _get_p(self, offset, dtype):
         N, h, w = offset.size(1) // 2, offset.size(2), offset.size(3)
 
-        # (1, 2N, 1, 1)
-        p_n = self._get_p_n(N, dtype)
-        # (1, 2N, h, w)
-        p_0 = self._get_p_0(h, w, N, dtype)
-        p = p_0 + p_n + offset
+        key = (h, w, dtype)
+        if key != self._p_base_key:
+            # (1, 2N, 1, 1)
+            p_n = self._get_p_n(N, dtype)
+            # (1, 2N, h, w)
+            p_0 = self._get_p_0(h, w, N, dtype)
+            self._p_base_key, self._p_base = key, p_0 + p_n
+        p = self._p_base + offset
         return p
 
     def _get_x_q(self, x, q, N):
@@ -286,6 +321,7 @@ def homo_warp(src_feat, proj_mat, depth_values):
 
     # project negative depth pixels to somewhere outside the image
     negative_depth_mask = src_grid_d[:, 2:] <= 1e-7
+    in_front = rearrange(~negative_depth_mask, 'b 1 (d x) -> b d x', d=D)  # (B, D, H*W)
     src_grid_d[:, 0:1][negative_depth_mask] = W
     src_grid_d[:, 1:2][negative_depth_mask] = H
     src_grid_d[:, 2:3][negative_depth_mask] = 1
@@ -296,8 +332,18 @@ def homo_warp(src_feat, proj_mat, depth_values):
     src_grid[:, 1] = src_grid[:, 1] / ((H - 1) / 2) - 1  # scale to -1~1
     src_grid = rearrange(src_grid, 'b c (d h w) -> b d (h w) c', d=D, h=H, w=W)
 
-    warped_src_feat = F.grid_sample(src_feat, src_grid, mode='bilinear', padding_mode='zeros',
-                                    align_corners=True)  # (B, C, D, H*W)
+    # depth planes that project outside of the source image or behind it for every pixel only get zeros from
+    # grid_sample, only the visible ones are sampled
+    visible = in_front & (src_grid[..., 0].abs() < 1 + 2 / (W - 1)) & (src_grid[..., 1].abs() < 1 + 2 / (H - 1))
+    visible = visible.any(2).any(0)  # (D)
+    if visible.all():
+        warped_src_feat = F.grid_sample(src_feat, src_grid, mode='bilinear', padding_mode='zeros',
+                                        align_corners=True)  # (B, C, D, H*W)
+    else:
+        warped_src_feat = src_feat.new_zeros(B, C, D, H * W)
+        if visible.any():
+            warped_src_feat[:, :, visible] = F.grid_sample(src_feat, src_grid[:, visible], mode='bilinear',
+                                                           padding_mode='zeros', align_corners=True)
     warped_src_feat = rearrange(warped_src_feat, 'b c d (h w) -> b c d h w', h=H, w=W)
 
     return warped_src_feat
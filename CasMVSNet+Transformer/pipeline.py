@@ -0,0 +1,109 @@
+import queue
+import threading
+import time
+
+
+# iterate a DataLoader in a background thread, keeping up to depth batches ready while the model runs;
+# stall_time is the time the consumer waited for a batch (input-bound when it is a large part of the run).
+# Prefetcher and AsyncWriter are the same in AA-RMVSNet/utils.py and CasMVSNet+Transformer/pipeline.py, change both
+class Prefetcher(object):
+    def __init__(self, loader, depth=2):
+        self.loader = loader
+        self.depth = depth
+        self.batches = 0
+        self.stall_time = 0.0
+        self.ready = 0  # sum of the batches ready at each request
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(max(self.depth, 1))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # False once the consumer stopped, it will not take another batch
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(batch):
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.ready += batches.qsize()
+                start = time.time()
+                batch = batches.get()
+                self.stall_time += time.time() - start
+                if batch is done:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                self.batches += 1
+                yield batch
+        finally:
+            # also when the consumer stops early, e.g. on an exception in the model loop
+            stop.set()
+            thread.join()
+
+    def stats(self):
+        return {'batches': self.batches, 'input_stall_s': round(self.stall_time, 3),
+                'mean_ready': round(self.ready / max(self.batches, 1), 2)}
+
+
+# run save functions in a background thread fed by a queue of at most depth pending outputs;
+# stall_time is the time the producer waited for a free slot (output-bound when it is large)
+class AsyncWriter(object):
+    def __init__(self, depth=8):
+        self.queue = queue.Queue(max(depth, 1))
+        self.outputs = 0
+        self.stall_time = 0.0
+        self.pending = 0  # sum of the pending outputs at each put
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    item[0](*item[1])
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.pending += self.queue.qsize()
+        start = time.time()
+        self.queue.put((func, args))
+        self.stall_time += time.time() - start
+        self.outputs += 1
+
+    def close(self):
+        # wait until every output is written
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        return {'outputs': self.outputs, 'output_stall_s': round(self.stall_time, 3),
+                'mean_pending': round(self.pending / max(self.outputs, 1), 2)}
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+# models.modules needs the rest of the CasMVSNet dependencies
+pytest.importorskip('kornia')
+pytest.importorskip('einops')
+from models.modules import DeformConv2d, deform_conv2d  # noqa: E402
+
+
+def forward_with(backend, conv, x):
+    default = DeformConv2d.backend
+    DeformConv2d.backend = backend
+    try:
+        return conv(x)
+    finally:
+        DeformConv2d.backend = default
+
+
+@pytest.mark.skipif(deform_conv2d is None, reason='needs torchvision')
+@pytest.mark.parametrize('stride', [1, 2])
+@pytest.mark.parametrize('modulation', [True, False])
+def test_torchvision_backend_matches_native(stride, modulation):
+    torch.manual_seed(0)
+    conv = DeformConv2d(8, 16, stride=stride, modulation=modulation)
+    # the offset and modulation convolutions start at zero, give them weights that move the samples
+    for module in [conv.p_conv] + ([conv.m_conv] if modulation else []):
+        torch.nn.init.normal_(module.weight, std=0.5)
+    with torch.no_grad():
+        # a second input size replaces the cached sampling base of the native backend
+        for height, width in [(20, 24), (13, 17)]:
+            x = torch.randn(2, 8, height, width)
+            native = forward_with('native', conv, x)
+            torchvision = forward_with('torchvision', conv, x)
+            assert native.shape == torchvision.shape
+            assert (native - torchvision).abs().max() < 1e-5